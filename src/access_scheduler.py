@@ -0,0 +1,176 @@
+""" 按配额并发调度下载任务
+tushare每个接口有每分钟访问次数限制，jqdata有每日下载行数限制。这里用令牌桶描述配额，令牌桶状态保存在
+SQLite文件中，同时运行的多个下载进程共享同一份配额；任务在线程池中并发执行，网络延迟不再叠加在限流间隔上。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, Iterable, Iterator
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import sqlite3
+import os
+import random
+import time
+
+from src import db_access as dba
+
+# mode='rate'：令牌按limit/period的速度连续补充，最多积累burst个；mode='window'：每个period开始时令牌重置为limit
+Quota: NamedTuple = namedtuple('Quota', 'endpoint, limit, period, burst, mode')
+Scheduler_config: NamedTuple = namedtuple('Scheduler_config', 'state_path, workers, max_retries, backoff_base, \
+                                          backoff_cap')
+
+TUSHARE_ENDPOINTS: Tuple = ('daily', 'daily_basic', 'income', 'balancesheet', 'cashflow', 'fina_indicator',
+                            'namechange')
+RATE_LIMIT_MARKERS: Tuple = ('最多访问', '每分钟', '每小时', '每天', '频率', '频次', 'rate limit', 'too many', 'exceed')
+
+
+def scheduler_config() -> Scheduler_config:
+    return Scheduler_config(state_path=os.path.join(dba.data_dir(), 'access_quota.db'), workers=4, max_retries=6,
+                            backoff_base=2.0, backoff_cap=120.0)
+
+
+def tushare_quota(endpoint: Text, access_per_minute: int = 80) -> Quota:
+    return Quota(endpoint=endpoint, limit=access_per_minute, period=60, burst=1, mode='rate')
+
+
+def tushare_quotas(access_per_minute: int = 80) -> Dict[Text, Quota]:
+    return {endpoint: tushare_quota(endpoint, access_per_minute) for endpoint in TUSHARE_ENDPOINTS}
+
+
+def row_budget_quota(endpoint: Text = 'jqdata', rows_per_day: int = 1000000) -> Quota:
+    return Quota(endpoint=f'{endpoint}_rows', limit=rows_per_day, period=24 * 60 * 60, burst=rows_per_day,
+                 mode='window')
+
+
+def window_index(quota: Quota, t: float) -> int:
+    # 按本地时间划分窗口，每日配额在本地零点重置
+    return int((t - time.timezone) // quota.period)
+
+
+def refill(quota: Quota, tokens: float, stamp: float, now: float) -> float:
+    if quota.mode == 'window':
+        return float(quota.limit) if window_index(quota, stamp) < window_index(quota, now) else tokens
+    return min(float(quota.burst), tokens + max(now - stamp, 0.0) * quota.limit / quota.period)
+
+
+def seconds_until_available(quota: Quota, tokens: float, cost: float, now: float) -> float:
+    if quota.mode == 'window':
+        return (window_index(quota, now) + 1) * quota.period + time.timezone - now
+    return (max(cost, 1e-6) - tokens) * quota.period / quota.limit
+
+
+def is_rate_limited(e: Exception) -> bool:
+    message: Text = str(e).lower()
+    return any(marker in message for marker in RATE_LIMIT_MARKERS)
+
+
+def imp_open_state(state_path: Text) -> sqlite3.Connection:
+    conn = sqlite3.connect(state_path, timeout=60, isolation_level=None)
+    conn.execute('''CREATE TABLE IF NOT EXISTS quota_bucket (endpoint TEXT PRIMARY KEY, tokens REAL, stamp REAL)''')
+    return conn
+
+
+def imp_update_bucket(quota: Quota, state_path: Text,
+                      update: Callable[[float, float], Tuple[float, float]]) -> float:
+    """ 在一个写事务中读取、补充并更新令牌，BEGIN IMMEDIATE保证多个进程之间互斥
+
+    update接收补充后的令牌数和当前时间，返回新的令牌数和等待秒数
+    """
+    conn = imp_open_state(state_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT tokens, stamp FROM quota_bucket WHERE endpoint=?', (quota.endpoint,)).fetchone()
+        now: float = time.time()
+        tokens: float = refill(quota, row[0], row[1], now) if row is not None else float(quota.burst)
+        tokens, wait_seconds = update(tokens, now)
+        conn.execute('INSERT OR REPLACE INTO quota_bucket VALUES (?, ?, ?)', (quota.endpoint, tokens, now))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return wait_seconds
+
+
+def imp_acquire(quota: Quota, cost: float = 1.0, state_path: Optional[Text] = None) -> float:
+    """ 取得cost个令牌，配额不足时阻塞等待，返回等待的秒数
+    cost=0用于行数配额：只要还有剩余就放行，实际行数在下载完成后用imp_debit扣除
+    """
+    def take(tokens: float, now: float) -> Tuple[float, float]:
+        if tokens > 0 and tokens >= cost:
+            return tokens - cost, 0.0
+        return tokens, seconds_until_available(quota, tokens, cost, now)
+
+    waited: float = 0.0
+    while True:
+        wait_seconds = imp_update_bucket(quota, state_path or scheduler_config().state_path, take)
+        if wait_seconds <= 0:
+            return waited
+        # 分段等待，别的进程退回的令牌或重置的窗口能及时被看到
+        time.sleep(min(wait_seconds, 5.0))
+        waited += min(wait_seconds, 5.0)
+
+
+def imp_debit(quota: Quota, amount: float, state_path: Optional[Text] = None) -> Any:
+    imp_update_bucket(quota, state_path or scheduler_config().state_path,
+                      lambda tokens, now: (tokens - amount, 0.0))
+
+
+def imp_drain(quota: Quota, seconds: float, state_path: Optional[Text] = None) -> Any:
+    """ 服务器返回限流错误时清空令牌桶，所有进程在seconds秒内都不再访问该接口
+    """
+    imp_update_bucket(quota, state_path or scheduler_config().state_path,
+                      lambda tokens, now: (min(tokens, -seconds * quota.limit / quota.period)
+                                           if quota.mode == 'rate' else min(tokens, 0.0), 0.0))
+
+
+def imp_call_with_retry(func: Callable[[Any], Any], item: Any, quota: Quota,
+                        rows_quota: Optional[Quota] = None,
+                        row_count: Optional[Callable[[Any], int]] = None,
+                        sch_config: Optional[Scheduler_config] = None) -> Any:
+    cfg: Scheduler_config = sch_config or scheduler_config()
+    for attempt in range(cfg.max_retries + 1):
+        imp_acquire(quota, 1.0, cfg.state_path)
+        if rows_quota is not None:
+            imp_acquire(rows_quota, 0.0, cfg.state_path)
+        try:
+            rtn = func(item)
+        except Exception as e:
+            if is_rate_limited(e) is False or attempt == cfg.max_retries:
+                raise
+            delay: float = min(cfg.backoff_cap, cfg.backoff_base * 2 ** attempt) * (0.5 + random.random() / 2)
+            # 退避只记在令牌桶里，下一轮imp_acquire负责等待
+            imp_drain(quota, delay, cfg.state_path)
+            continue
+        if rows_quota is not None and row_count is not None:
+            imp_debit(rows_quota, row_count(rtn), cfg.state_path)
+        return rtn
+
+
+def imp_run_scheduled(items: Iterable, func: Callable[[Any], Any], quota: Quota,
+                      workers: Optional[int] = None,
+                      rows_quota: Optional[Quota] = None,
+                      row_count: Optional[Callable[[Any], int]] = None,
+                      sch_config: Optional[Scheduler_config] = None,
+                      on_error: Optional[Callable[[Any, Exception], Any]] = None) -> Iterator:
+    """ 并发执行func(item)，按完成顺序返回结果；同时在途的请求不超过workers个
+
+    重试后仍失败的任务打印错误后跳过，给出on_error时交给on_error(item, 错误)记录
+    """
+    cfg: Scheduler_config = sch_config or scheduler_config()
+    max_workers: int = workers or cfg.workers
+    item_iter: Iterator = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: Dict = {}
+        while True:
+            for item in item_iter:
+                pending[executor.submit(imp_call_with_retry, func, item, quota, rows_quota, row_count, cfg)] = item
+                if len(pending) >= max_workers:
+                    break
+            if len(pending) == 0:
+                return
+            done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    print(item, e)
+                    if on_error is not None:
+                        on_error(item, e)
@@ -0,0 +1,84 @@
+""" 由未复权价格和复权因子计算前复权、后复权价格
+日交易数据保存未复权价格，复权因子单独保存在adj_factor表中。后复权价格 = 价格 × 当日复权因子，前复权价格 = 后复权价格 ÷
+基准日（缺省为最后一个交易日）的复权因子。历史上的复权因子不会改变，分红送转以后只需下载新增的复权因子，已保存的价格
+不用重新下载。
+"""
+from typing import Text, Optional, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import panel_store as ps
+from src import tushare_data as td
+
+PRICE_FIELDS: Tuple = ('open', 'high', 'low', 'close', 'pre_close')
+
+
+def adjust_rows(rows: pd.DataFrame, how: Text = 'qfq', as_of: Optional[int] = None) -> pd.DataFrame:
+    """ rows为含ts_code、trade_date、价格字段和adj_factor的长表，返回复权后的同样的表
+
+    缺失的复权因子取该股票之前最近的值；涨跌额按复权后的收盘价和昨收价重算，涨跌幅、成交量和成交额不变
+    """
+    df: pd.DataFrame = rows.sort_values(['ts_code', 'trade_date']).reset_index(drop=True)
+    factor: pd.Series = df['adj_factor'].astype(np.float64).groupby(df['ts_code']).ffill()
+    if how == 'qfq':
+        known: pd.Series = factor if as_of is None else factor.where(df['trade_date'].astype(np.int64) <= as_of)
+        factor = factor / known.groupby(df['ts_code']).transform('last')
+    elif how != 'hfq':
+        raise ValueError(f'不支持的复权方式{how}')
+    for field in PRICE_FIELDS:
+        if field in df.columns:
+            df[field] = df[field].astype(np.float64) * factor
+    if 'change' in df.columns and 'close' in df.columns and 'pre_close' in df.columns:
+        df['change'] = df['close'] - df['pre_close']
+    return df
+
+
+def adjust_panel(prices: pd.DataFrame, factors: pd.DataFrame, how: Text = 'qfq',
+                 as_of: Optional[int] = None) -> pd.DataFrame:
+    """ prices、factors为同样行列的(trade_date × ts_code)面板，factors应从prices之前的交易日开始以便向后填充
+    """
+    filled: pd.DataFrame = factors.reindex(index=factors.index.union(prices.index)).ffill()
+    if how == 'hfq':
+        return prices * filled.reindex(index=prices.index)
+    if how != 'qfq':
+        raise ValueError(f'不支持的复权方式{how}')
+    known: pd.DataFrame = filled if as_of is None else filled.loc[:as_of]
+    base: pd.Series = known.iloc[-1] if len(known) > 0 else pd.Series(np.nan, index=filled.columns)
+    return prices * filled.reindex(index=prices.index) / base
+
+
+def imp_adjusted_frame(field: Text, how: Text = 'qfq',
+                       start_date: Optional[int] = None,
+                       end_date: Optional[int] = None,
+                       codes: Optional[List[Text]] = None,
+                       as_of: Optional[int] = None,
+                       root: Optional[Text] = None) -> pd.DataFrame:
+    """ 从面板取复权后的价格，参数同panel_store.panel_frame；as_of为前复权的基准日，缺省为复权因子面板的最后一个交易日
+    """
+    prices: pd.DataFrame = ps.panel_frame(td.db_config().tbl_daily_trading_data, field, start_date, end_date, codes,
+                                          root)
+    factors: pd.DataFrame = ps.panel_frame(td.db_config().tbl_adj_factor, 'adj_factor', None,
+                                           None if how == 'qfq' else end_date, list(prices.columns), root)
+    return adjust_panel(prices.astype(np.float64), factors.astype(np.float64), how, as_of)
+
+
+def imp_adjusted_daily(codes: List[Text], start_date: Text, end_date: Text, how: Text = 'qfq',
+                       as_of: Optional[int] = None) -> pd.DataFrame:
+    """ 从数据库取若干股票的复权日交易数据；前复权时读到as_of（缺省为全部）为止的复权因子作为基准
+    """
+    in_codes: Text = ','.join('?' * len(codes))
+    rows: pd.DataFrame = td.imp_get_records_from_db(
+        f"SELECT d.*, a.adj_factor FROM {td.db_config().tbl_daily_trading_data} d LEFT JOIN \
+        {td.db_config().tbl_adj_factor} a ON a.ts_code = d.ts_code AND a.trade_date = d.trade_date \
+        WHERE d.ts_code IN ({in_codes}) AND d.trade_date >= ? AND d.trade_date <= ?",
+        (*codes, start_date, end_date))
+    if how == 'hfq' or rows is None or rows.empty:
+        return adjust_rows(rows, how) if rows is not None and rows.empty is False else rows
+    # 基准复权因子可能在end_date之后，作为一行没有价格的数据参与计算，算完后去掉
+    base: pd.DataFrame = td.imp_get_records_from_db(
+        f"SELECT ts_code, MAX(trade_date) AS trade_date, adj_factor FROM {td.db_config().tbl_adj_factor} \
+        WHERE ts_code IN ({in_codes}) AND trade_date <= ? GROUP BY ts_code", (*codes, as_of or 99991231))
+    base = base[base['trade_date'].astype(np.int64) > int(end_date)]
+    adjusted: pd.DataFrame = adjust_rows(pd.concat([rows, base], ignore_index=True, sort=False), how, as_of)
+    return adjusted[adjusted['trade_date'].astype(np.int64) <= int(end_date)].reset_index(drop=True)
@@ -0,0 +1,168 @@
+""" 按调仓日样本池的因子回测
+每个调仓日按因子得分把样本池中的股票分成若干分位组合（或取得分最高的N只），等权买入并持有到下一个调仓日。日收益用
+累计对数收益矩阵整段计算，不逐日循环；输出各组合的日收益、净值、IC、换手率、分位收益差和最大回撤。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Dict, List, Set
+from collections import namedtuple
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import panel_store as ps
+from src import tushare_data as td
+
+# top_n为None时按quantiles分组；cost: 单边交易成本，按换手率在调仓后第一个交易日扣除
+Backtest_config: NamedTuple = namedtuple('Backtest_config', 'quantiles, top_n, cost, periods_per_year')
+# log_cum[t] = 第0到t个交易日的对数收益之和，任意两日之间的持有收益为exp(log_cum[t] - log_cum[s])
+Return_panel: NamedTuple = namedtuple('Return_panel', 'dates, codes, log_cum')
+Backtest_result: NamedTuple = namedtuple('Backtest_result', 'returns, nav, ic, turnover, summary')
+
+
+def backtest_config() -> Backtest_config:
+    return Backtest_config(quantiles=5, top_n=None, cost=0.0, periods_per_year=252)
+
+
+def prepare_returns(pct_chg: pd.DataFrame) -> Return_panel:
+    """ pct_chg为(trade_date × ts_code)的涨跌幅(%)面板，多次回测可以共用同一个Return_panel
+
+    停牌日和退市以后没有数据，日收益按0计，即持仓按最后的价格保留在组合中
+    """
+    daily: np.ndarray = np.nan_to_num(pct_chg.values.astype(np.float64) / 100, nan=0.0)
+    return Return_panel(dates=pct_chg.index.values.astype(np.int64), codes=pct_chg.columns.values.astype(str),
+                        log_cum=np.cumsum(np.log1p(np.maximum(daily, -0.99)), axis=0))
+
+
+def rebalance_periods(dates: np.ndarray, rebalance_dates: List[Text]) -> List[Tuple[int, int, Text]]:
+    """ 返回(调仓日位置, 持有期最后一日位置, 调仓日)列表；调仓日不是交易日时取之前最近的交易日
+    """
+    keys: List[Text] = sorted(rebalance_dates, key=int)
+    pos: np.ndarray = np.searchsorted(dates, np.array([int(k) for k in keys], dtype=np.int64), 'right') - 1
+    starts: List[Tuple[int, Text]] = [(int(p), k) for p, k in zip(pos, keys) if 0 <= p < len(dates) - 1]
+    return [(a, starts[i + 1][0] if i + 1 < len(starts) else len(dates) - 1, k) for i, (a, k) in enumerate(starts)
+            if i + 1 == len(starts) or starts[i + 1][0] > a]
+
+
+def assign_buckets(score: np.ndarray, eligible: np.ndarray, quantiles: int, top_n: Optional[int]) -> np.ndarray:
+    """ 得分从低到高分为0..quantiles-1组，top_n时得分最高的N只为0组，其余为-1
+    """
+    valid: np.ndarray = np.flatnonzero(eligible & np.isfinite(score))
+    order: np.ndarray = valid[np.argsort(score[valid], kind='mergesort')]
+    buckets: np.ndarray = np.full(len(score), -1, dtype=np.int64)
+    if top_n is not None:
+        buckets[order[-top_n:] if top_n > 0 else order[:0]] = 0
+    elif len(order) > 0:
+        buckets[order] = np.arange(len(order)) * quantiles // len(order)
+    return buckets
+
+
+def bucket_weights(buckets: np.ndarray, n_buckets: int) -> np.ndarray:
+    weights: np.ndarray = np.zeros((len(buckets), n_buckets))
+    held: np.ndarray = buckets >= 0
+    weights[np.flatnonzero(held), buckets[held]] = 1.0
+    counts: np.ndarray = weights.sum(axis=0)
+    return np.divide(weights, counts, out=np.zeros_like(weights), where=counts > 0)
+
+
+def rank_ic(score: np.ndarray, forward: np.ndarray) -> float:
+    if len(score) < 3:
+        return np.nan
+    return float(np.corrcoef(pd.Series(score).rank().values, pd.Series(forward).rank().values)[0, 1])
+
+
+def max_drawdown(nav: pd.DataFrame) -> pd.Series:
+    return (nav / nav.cummax() - 1).min()
+
+
+def summarize(returns: pd.DataFrame, nav: pd.DataFrame, turnover: pd.DataFrame, ic: pd.Series,
+              periods_per_year: int) -> pd.DataFrame:
+    years: float = len(returns) / periods_per_year
+    summary: pd.DataFrame = pd.DataFrame({'annual_return': nav.iloc[-1] ** (1 / years) - 1 if years > 0 else np.nan,
+                                          'annual_vol': returns.std() * np.sqrt(periods_per_year),
+                                          'sharpe': returns.mean() / returns.std() * np.sqrt(periods_per_year),
+                                          'max_drawdown': max_drawdown(nav),
+                                          'mean_turnover': turnover.mean().reindex(returns.columns)})
+    summary['ic_mean'] = ic.mean()
+    summary['ic_ir'] = ic.mean() / ic.std() if len(ic) > 1 else np.nan
+    return summary
+
+
+def run_backtest(pool: Dict[Text, Tuple[Any, Set]], scores: pd.DataFrame, returns: Return_panel,
+                 cfg: Optional[Backtest_config] = None) -> Backtest_result:
+    """ pool为sample.build_sample_pool的结果，scores为(trade_date × ts_code)的因子得分，得分越高越好
+
+    调仓日收盘按当日及以前最近一天的得分建仓，持有到下一个调仓日收盘；IC为调仓日得分与持有期收益的秩相关系数
+    """
+    cfg = cfg or backtest_config()
+    n_buckets: int = 1 if cfg.top_n is not None else cfg.quantiles
+    labels: List[Text] = ['top'] if cfg.top_n is not None else [f'q{b + 1}' for b in range(n_buckets)]
+    score_dates: np.ndarray = scores.index.values.astype(np.int64)
+    score_values: np.ndarray = scores.reindex(columns=returns.codes).values.astype(np.float64)
+    code_index: pd.Index = pd.Index(returns.codes)
+
+    daily: np.ndarray = np.full((len(returns.dates), n_buckets), np.nan)
+    periods: List[Tuple[int, int, Text]] = rebalance_periods(returns.dates, list(pool.keys()))
+    ic: Dict[int, float] = {}
+    turnover: Dict[int, np.ndarray] = {}
+    held: Optional[np.ndarray] = None
+    for a, b, key in periods:
+        i: int = int(np.searchsorted(score_dates, returns.dates[a], 'right')) - 1
+        score: np.ndarray = score_values[i] if i >= 0 else np.full(len(returns.codes), np.nan)
+        members: np.ndarray = code_index.get_indexer(list(pool[key][1]))
+        eligible: np.ndarray = np.zeros(len(returns.codes), dtype=bool)
+        eligible[members[members >= 0]] = True
+        weights: np.ndarray = bucket_weights(assign_buckets(score, eligible, cfg.quantiles, cfg.top_n), n_buckets)
+
+        # growth[s, j]: 第j只股票从调仓日到持有期第s天的累计收益
+        growth: np.ndarray = np.exp(returns.log_cum[a:b + 1] - returns.log_cum[a])
+        value: np.ndarray = growth @ weights
+        with np.errstate(invalid='ignore', divide='ignore'):
+            daily[a + 1:b + 1] = value[1:] / value[:-1] - 1
+        turnover[int(returns.dates[a])] = 0.5 * np.abs(weights - held).sum(axis=0) if held is not None \
+            else weights.sum(axis=0)
+        daily[a + 1] -= turnover[int(returns.dates[a])] * cfg.cost
+        drifted: np.ndarray = weights * growth[-1][:, None]
+        held = np.divide(drifted, drifted.sum(axis=0), out=np.zeros_like(drifted), where=drifted.sum(axis=0) > 0)
+
+        valid: np.ndarray = eligible & np.isfinite(score)
+        ic[int(returns.dates[a])] = rank_ic(score[valid], growth[-1][valid] - 1)
+
+    first: int = periods[0][0] + 1 if len(periods) > 0 else len(returns.dates)
+    rtn: pd.DataFrame = pd.DataFrame(daily[first:], index=returns.dates[first:], columns=labels)
+    if n_buckets > 1:
+        rtn['spread'] = rtn[labels[-1]] - rtn[labels[0]]
+    nav: pd.DataFrame = (1 + rtn.fillna(0)).cumprod()
+    turnover_frame: pd.DataFrame = pd.DataFrame.from_dict(turnover, orient='index', columns=labels)
+    ic_series: pd.Series = pd.Series(ic, name='ic', dtype=np.float64)
+    return Backtest_result(returns=rtn, nav=nav, ic=ic_series, turnover=turnover_frame,
+                           summary=summarize(rtn, nav, turnover_frame, ic_series.dropna(), cfg.periods_per_year))
+
+
+def imp_load_returns(root: Optional[Text] = None) -> Return_panel:
+    return prepare_returns(ps.panel_frame(td.db_config().tbl_daily_trading_data, 'pct_chg', root=root))
+
+
+def imp_save_returns(returns: Return_panel, directory: Text) -> Any:
+    os.makedirs(directory, exist_ok=True)
+    for name, values in returns._asdict().items():
+        np.save(os.path.join(directory, f'{name}.npy'), values)
+
+
+def imp_open_returns(directory: Text) -> Return_panel:
+    """ 以只读内存映射打开imp_save_returns保存的累计收益，多个进程共用操作系统的页缓存，不各自复制
+    """
+    return Return_panel(**{name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                           for name in Return_panel._fields})
+
+
+if __name__ == '__main__':
+    from src import sample
+    from src import factor_engine as fe
+    dates: List[Text] = list(sample.filter_updated_date(td.imp_get_trade_cal(start=sample.sample_config().start_date,
+                                                                             end=sample.sample_config().end_date)))
+    sample_pool: Dict = sample.impf_build_sample_pool(dates)
+    return_panel: Return_panel = imp_load_returns()
+    for name in fe.factor_config().factors:
+        if name.startswith('z_'):
+            print(name)
+            print(run_backtest(sample_pool, fe.factor_frame(name), return_panel).summary)
@@ -0,0 +1,379 @@
+""" 数据下载和样本构建的基准测试
+生成一个仿真的A股市场（股票列表、交易日历、含ST的名称变更、上市退市、日交易数据、每日指标和季度报表），通过gctp、
+imp_limit_access和build_samples接受的函数接口提供数据，在临时数据目录中离线运行真实的代码路径，不消耗tushare配额。
+结果追加到benchmark_results.jsonl，并与上一次结果比较，便于发现提交之间的性能退化。
+"""
+from typing import Any, Text, NamedTuple, Optional, Callable, Dict, List, Tuple
+from collections import namedtuple
+from functools import partial
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from src import db_access as dba
+
+Universe: NamedTuple = namedtuple('Universe', 'codes, days, calendar, companies, name_history, list_idx, delist_idx')
+Bench_config: NamedTuple = namedtuple('Bench_config', 'n_codes, n_days, persist_codes, seed, base_index')
+
+DAILY_COLUMNS: List[Text] = ['ts_code', 'trade_date', 'open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg',
+                             'vol', 'amount']
+DAILY_BASIC_COLUMNS: List[Text] = ['ts_code', 'trade_date', 'close', 'turnover_rate', 'turnover_rate_f', 'volume_ratio',
+                                   'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm', 'total_share', 'float_share', 'free_share',
+                                   'total_mv', 'circ_mv']
+INCOME_COLUMNS: List[Text] = ['ts_code', 'ann_date', 'f_ann_date', 'end_date', 'report_type', 'comp_type', 'basic_eps',
+                              'total_revenue', 'revenue', 'operate_profit', 'total_profit', 'n_income',
+                              'n_income_attr_p', 'update_flag']
+NAME_COLUMNS: List[Text] = ['ts_code', 'name', 'start_date', 'end_date', 'ann_date', 'change_reason']
+
+
+def bench_config() -> Bench_config:
+    return Bench_config(n_codes=4000, n_days=3500, persist_codes=4000, seed=7, base_index='399300.SZ')
+
+
+def noise(a: np.ndarray, b: np.ndarray, salt: float = 0.0) -> np.ndarray:
+    """ 由(a, b)确定的[0, 1)伪随机数，按股票或按日期切片取得的数据互相一致
+    """
+    x: np.ndarray = np.sin(np.asarray(a, dtype=np.float64) * 12.9898 + np.asarray(b, dtype=np.float64) * 78.233
+                           + salt * 37.719) * 43758.5453
+    return x - np.floor(x)
+
+
+def trading_days(n_days: int, start: Text = '20050104') -> np.ndarray:
+    days: pd.DatetimeIndex = pd.bdate_range(start=start, periods=int(n_days * 1.1) + 10)
+    # 剔除一些工作日作为节假日
+    keep: np.ndarray = noise(np.arange(len(days)), 0, 9.0) >= 0.045
+    return days[keep][:n_days].strftime('%Y%m%d').astype(np.int64).values
+
+
+def build_universe(cfg: Bench_config) -> Universe:
+    rng: np.random.RandomState = np.random.RandomState(cfg.seed)
+    codes: np.ndarray = np.array([f'{600000 + i:06d}.SH' if i % 2 == 0 else f'{i:06d}.SZ'
+                                  for i in range(cfg.n_codes)])
+    days: np.ndarray = trading_days(cfg.n_days)
+    all_days: pd.DatetimeIndex = pd.date_range(str(days[0]), str(days[-1]))
+    calendar: pd.DataFrame = pd.DataFrame({'exchange': 'SSE', 'cal_date': all_days.strftime('%Y%m%d'),
+                                           'is_open': np.isin(all_days.strftime('%Y%m%d').astype(np.int64),
+                                                              days).astype(int)})
+
+    # 六成在样本期之前上市，其余在样本期内陆续上市，约5%退市
+    listed_before: np.ndarray = rng.rand(cfg.n_codes) < 0.6
+    list_idx: np.ndarray = np.where(listed_before, -rng.randint(1, 3000, cfg.n_codes),
+                                    rng.randint(0, cfg.n_days - 20, cfg.n_codes))
+    delisted: np.ndarray = rng.rand(cfg.n_codes) < 0.05
+    delist_idx: np.ndarray = np.where(delisted, np.minimum(np.maximum(list_idx, 0) + rng.randint(250, cfg.n_days,
+                                                                                                 cfg.n_codes),
+                                                           cfg.n_days), cfg.n_days)
+    delisted = delisted & (delist_idx < cfg.n_days)
+
+    def day_text(idx: np.ndarray) -> np.ndarray:
+        ts_days: pd.DatetimeIndex = pd.to_datetime(str(days[0])) + pd.to_timedelta(np.minimum(idx, 0) * 1.45, 'D')
+        return np.where(idx >= 0, days[np.clip(idx, 0, cfg.n_days - 1)].astype(str), ts_days.strftime('%Y%m%d'))
+
+    list_date: np.ndarray = day_text(list_idx)
+    companies: pd.DataFrame = pd.DataFrame({'ts_code': codes, 'symbol': [c[:6] for c in codes],
+                                            'name': [f'股票{i}' for i in range(cfg.n_codes)], 'area': '',
+                                            'industry': '', 'list_date': list_date,
+                                            'delist_date': np.where(delisted, day_text(delist_idx), None)})
+
+    # 约一成股票在样本期内有一段ST时期
+    st: np.ndarray = np.flatnonzero(rng.rand(cfg.n_codes) < 0.1)
+    st_start: np.ndarray = np.clip(np.maximum(list_idx[st], 0) + rng.randint(30, cfg.n_days, len(st)), 0,
+                                   cfg.n_days - 2)
+    st_end: np.ndarray = np.minimum(st_start + rng.randint(120, 500, len(st)), cfg.n_days - 1)
+    plain: pd.DataFrame = pd.DataFrame({'ts_code': codes, 'name': companies['name'], 'start_date': list_date,
+                                        'end_date': None, 'ann_date': list_date, 'change_reason': '上市'})
+    plain.loc[st, 'end_date'] = days[st_start - 1].astype(str)
+    st_rows: pd.DataFrame = pd.DataFrame({'ts_code': codes[st], 'name': 'ST' + companies['name'].values[st],
+                                          'start_date': days[st_start].astype(str),
+                                          'end_date': days[st_end].astype(str),
+                                          'ann_date': days[st_start].astype(str), 'change_reason': 'ST'})
+    back: pd.DataFrame = pd.DataFrame({'ts_code': codes[st], 'name': companies['name'].values[st],
+                                       'start_date': days[np.minimum(st_end + 1, cfg.n_days - 1)].astype(str),
+                                       'end_date': None, 'ann_date': days[np.minimum(st_end + 1, cfg.n_days - 1)]
+                                      .astype(str), 'change_reason': '撤销ST'})
+    name_history: pd.DataFrame = pd.concat([plain, st_rows, back[st_end < cfg.n_days - 1]], ignore_index=True)
+    return Universe(codes=codes, days=days, calendar=calendar, companies=companies, name_history=name_history,
+                    list_idx=list_idx, delist_idx=delist_idx)
+
+
+def trade_grid(u: Universe, code_idx: np.ndarray, day_idx: np.ndarray) -> pd.DataFrame:
+    """ 股票和交易日的笛卡尔积中已上市、未退市且未停牌的部分，按(股票, 日期)排序
+    """
+    c: np.ndarray = np.repeat(code_idx, len(day_idx))
+    d: np.ndarray = np.tile(day_idx, len(code_idx))
+    alive: np.ndarray = (d >= u.list_idx[c]) & (d < u.delist_idx[c]) & (noise(c, d, 1.0) >= 0.02)
+    return pd.DataFrame({'c': c[alive], 'd': d[alive]})
+
+
+def close_price(c: np.ndarray, d: np.ndarray) -> np.ndarray:
+    base: np.ndarray = 4 + 46 * noise(c, 0, 2.0)
+    wave: np.ndarray = 1 + (0.2 + 0.3 * noise(c, 0, 3.0)) * np.sin(d / (20 + 80 * noise(c, 0, 4.0))
+                                                                    + 6.28 * noise(c, 0, 5.0))
+    return np.round(base * wave * (1 + 0.03 * (noise(c, d, 6.0) - 0.5)), 2)
+
+
+def daily_frame(u: Universe, grid: pd.DataFrame) -> pd.DataFrame:
+    c, d = grid['c'].values, grid['d'].values
+    pre: np.ndarray = close_price(c, d - 1)
+    close: np.ndarray = close_price(c, d)
+    # 约1%的交易日为一字涨停
+    limit_up: np.ndarray = noise(c, d, 7.0) < 0.01
+    close = np.where(limit_up, np.round(pre * 1.1, 2), close)
+    spread: np.ndarray = np.where(limit_up, 0, close * 0.02 * noise(c, d, 8.0))
+    vol: np.ndarray = np.round(1e4 + 1e6 * noise(c, d, 10.0), 2)
+    return pd.DataFrame({'ts_code': u.codes[c], 'trade_date': u.days[d].astype(str),
+                         'open': np.where(limit_up, close, np.round((pre + close) / 2, 2)),
+                         'high': np.round(close + spread, 2), 'low': np.round(close - spread, 2), 'close': close,
+                         'pre_close': pre, 'change': np.round(close - pre, 2),
+                         'pct_chg': np.round((close / pre - 1) * 100, 4), 'vol': vol,
+                         'amount': np.round(vol * close / 10, 3)}, columns=DAILY_COLUMNS)
+
+
+def daily_basic_frame(u: Universe, grid: pd.DataFrame) -> pd.DataFrame:
+    c, d = grid['c'].values, grid['d'].values
+    close: np.ndarray = close_price(c, d)
+    total_share: np.ndarray = np.round(5e3 + 5e5 * noise(c, 0, 11.0) ** 3, 4)
+    float_share: np.ndarray = np.round(total_share * (0.3 + 0.7 * noise(c, 0, 12.0)), 4)
+    pe: np.ndarray = np.round(5 + 95 * noise(c, d // 60, 13.0), 4)
+    return pd.DataFrame({'ts_code': u.codes[c], 'trade_date': u.days[d].astype(str), 'close': close,
+                         'turnover_rate': np.round(10 * noise(c, d, 14.0), 4),
+                         'turnover_rate_f': np.round(12 * noise(c, d, 14.0), 4),
+                         'volume_ratio': np.round(0.5 + 2 * noise(c, d, 15.0), 2), 'pe': pe, 'pe_ttm': pe,
+                         'pb': np.round(0.5 + 9.5 * noise(c, d // 60, 16.0), 4),
+                         'ps': np.round(0.2 + 19.8 * noise(c, d // 60, 17.0), 4),
+                         'ps_ttm': np.round(0.2 + 19.8 * noise(c, d // 60, 17.0), 4),
+                         'total_share': total_share, 'float_share': float_share, 'free_share': float_share,
+                         'total_mv': np.round(close * total_share, 4), 'circ_mv': np.round(close * float_share, 4)},
+                        columns=DAILY_BASIC_COLUMNS)
+
+
+def income_frame(u: Universe, code_idx: np.ndarray, start: int, end: int) -> pd.DataFrame:
+    """ 季度利润表，公告日期在报告期后30到110天，约3%的报告期在一年后有一次更正
+    """
+    quarters: pd.DatetimeIndex = pd.date_range('20040101', str(u.days[-1]), freq=pd.offsets.QuarterEnd())
+    q: np.ndarray = np.arange(len(quarters))
+    c: np.ndarray = np.repeat(code_idx, len(q))
+    k: np.ndarray = np.tile(q, len(code_idx))
+    end_date: pd.DatetimeIndex = quarters[k]
+    ann: pd.DatetimeIndex = end_date + pd.to_timedelta(30 + (80 * noise(c, k, 18.0)).astype(int), 'D')
+    restated: np.ndarray = noise(c, k, 19.0) < 0.03
+    c = np.concatenate([c, c[restated]])
+    k = np.concatenate([k, k[restated]])
+    end_date = end_date.append(end_date[restated])
+    ann = ann.append(ann[restated] + pd.to_timedelta(365, 'D'))
+    revenue: np.ndarray = np.round(1e7 + 1e10 * noise(c, k, 20.0), 2)
+    n_income: np.ndarray = np.round(revenue * (0.2 * noise(c, k, 21.0) - 0.05), 2)
+    ann_text: np.ndarray = ann.strftime('%Y%m%d').values
+    df: pd.DataFrame = pd.DataFrame({'ts_code': u.codes[c], 'ann_date': ann_text, 'f_ann_date': ann_text,
+                                     'end_date': end_date.strftime('%Y%m%d').values, 'report_type': '1',
+                                     'comp_type': '1', 'basic_eps': np.round(n_income / 1e9, 4),
+                                     'total_revenue': revenue, 'revenue': revenue,
+                                     'operate_profit': np.round(n_income * 1.2, 2),
+                                     'total_profit': np.round(n_income * 1.25, 2), 'n_income': n_income,
+                                     'n_income_attr_p': n_income, 'update_flag': '0'}, columns=INCOME_COLUMNS)
+    listed: np.ndarray = df['ann_date'].astype(np.int64).values >= np.maximum(
+        pd.Series(u.companies['list_date'].values[c]).astype(np.int64).values, start)
+    return df[listed & (df['ann_date'].astype(np.int64).values <= end)].reset_index(drop=True)
+
+
+def day_range(u: Universe, start: Text, end: Text) -> np.ndarray:
+    return np.arange(np.searchsorted(u.days, int(start), 'left'), np.searchsorted(u.days, int(end), 'right'))
+
+
+def synthetic_getter(u: Universe, task: tuple) -> Optional[pd.DataFrame]:
+    """ 与tushare_data.imp_get_data_from_tushare的接口相同，按(tbl_name, code, start_date, end_date)返回仿真数据
+    """
+    from src import tushare_data as td
+    tbl_name, code, start, end = task[0], task[1], task[2], task[3]
+    code_idx: np.ndarray = np.arange(len(u.codes)) if code is None else np.flatnonzero(u.codes == code)
+    if tbl_name in (td.db_config().tbl_daily_trading_data, td.db_config().tbl_daily_basic):
+        grid: pd.DataFrame = trade_grid(u, code_idx, day_range(u, start, end))
+        return daily_frame(u, grid) if tbl_name == td.db_config().tbl_daily_trading_data \
+            else daily_basic_frame(u, grid)
+    if tbl_name == td.db_config().tbl_income_statement:
+        return income_frame(u, code_idx, int(start), int(end))
+    if tbl_name == td.db_config().tbl_name_history:
+        return u.name_history[u.name_history['ts_code'].isin(u.codes[code_idx])][NAME_COLUMNS]
+    return None
+
+
+def index_daily_basic_frame(u: Universe, cfg: Bench_config, start: Text, end: Text) -> pd.DataFrame:
+    d: np.ndarray = day_range(u, start, end)
+    # 沪深300总市值（元），约为成分股平均市值的300倍
+    total_mv: np.ndarray = 2.5e13 * (1 + 0.4 * np.sin(d / 300.0))
+    return pd.DataFrame({'ts_code': cfg.base_index, 'trade_date': u.days[d].astype(str), 'total_mv': total_mv,
+                         'float_mv': total_mv * 0.7})
+
+
+def imp_seed_response_cache(u: Universe, cfg: Bench_config, rebalance_dates: List[Text]) -> Any:
+    """ 把仿真数据写入tushare响应缓存，离线回放模式下样本构建使用的tushare接口全部命中缓存
+    """
+    from src import response_cache as rc
+    from src import sample
+    fields: Text = 'ts_code, symbol,name,area,industry,list_date, delist_date'
+    status: pd.Series = pd.Series(np.where(u.companies['delist_date'].isnull(), 'L', 'D'))
+    for s in ['L', 'D', 'P']:
+        rc.imp_record('stock_basic', {'exchange': '', 'list_status': s, 'fields': fields},
+                      u.companies[(status == s).values].reset_index(drop=True))
+    start, end = sample.sample_config().start_date, sample.sample_config().end_date
+    rc.imp_record('trade_cal', {'exchange': '', 'start_date': start, 'end_date': end},
+                  u.calendar[(u.calendar['cal_date'] >= start) & (u.calendar['cal_date'] <= end)]
+                  .reset_index(drop=True))
+    for d in rebalance_dates:
+        rc.imp_record('index_dailybasic', {'ts_code': cfg.base_index, 'trade_date': d},
+                      index_daily_basic_frame(u, cfg, d, d))
+    rc.imp_record('index_dailybasic', {'ts_code': cfg.base_index, 'start_date': min(rebalance_dates),
+                                       'end_date': max(rebalance_dates)},
+                  index_daily_basic_frame(u, cfg, min(rebalance_dates), max(rebalance_dates)))
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(func: Callable[[], Any]) -> tuple:
+    start: float = time.perf_counter()
+    rtn: Any = func()
+    return rtn, time.perf_counter() - start
+
+
+def imp_bench_ingest(u: Universe, cfg: Bench_config) -> Dict[Text, float]:
+    from src import tushare_data as td
+    from src import access_scheduler as sch
+    getter: Callable = partial(synthetic_getter, u)
+    codes: List[Text] = list(u.codes[:cfg.persist_codes])
+    metrics: Dict[Text, float] = {}
+    td.imp_create_db_schema()
+    for tbl_name in [td.db_config().tbl_daily_trading_data, td.db_config().tbl_daily_basic,
+                     td.db_config().tbl_income_statement, td.db_config().tbl_name_history]:
+        quota: sch.Quota = sch.tushare_quota(f'bench_{tbl_name}', 10 ** 7)
+        tasks: List[Tuple] = [(tbl_name, code, td.sampling_config().start_date, td.sampling_config().end_date)
+                              for code in codes]
+        (stats, _), elapsed = timed(lambda: (td.imp_run_gctp_pipeline(
+            tasks, getter, partial(td.persist_cleaned, persistence=td.imp_persist_data), quota), td.imp_flush_db()))
+        metrics[f'persist_{tbl_name}_rows_per_s'] = stats[0]['rows'] / elapsed
+    return metrics
+
+
+def imp_bench_queries(u: Universe) -> Dict[Text, float]:
+    from src import tushare_data as td
+    mid: Text = str(u.days[len(u.days) // 2])
+    metrics: Dict[Text, float] = {}
+    _, metrics['query_daily_by_trade_date_s'] = timed(lambda: td.imp_get_records_from_db(
+        'SELECT * FROM daily_trading_data WHERE trade_date=?', (mid,)))
+    _, metrics['query_daily_by_code_s'] = timed(lambda: td.imp_get_records_from_db(
+        'SELECT * FROM daily_trading_data WHERE ts_code=?', (str(u.codes[0]),)))
+    _, metrics['query_coverage_s'] = timed(lambda: td.imp_get_coverage_in_db('daily_trading_data', 'trade_date'))
+    _, metrics['scan_daily_s'] = timed(lambda: sum(len(df) for df in td.imp_scan_table(
+        'daily_trading_data', ['ts_code', 'trade_date', 'close', 'pct_chg'])))
+    return metrics
+
+
+def imp_bench_samples(u: Universe, cfg: Bench_config) -> Dict[Text, float]:
+    from src import tushare_data as td
+    from src import sample
+    rebalance_dates: List[Text] = list(sample.filter_updated_date(
+        td.imp_get_trade_cal(sample.sample_config().start_date, sample.sample_config().end_date)))
+    build: Callable = partial(sample.build_samples,
+                              get_non_st_securities=sample.impf_get_non_st_securities_by_tushare_cache,
+                              get_companies_listed_for_many_years=
+                              sample.impf_get_companies_listed_for_many_years_by_tushare,
+                              get_tradable_securities=lambda d: sample.impf_get_tradable_securities(d)
+                              .pipe(lambda df: df[df['pct_chg'] < 9.6]),
+                              exclude_small_market_value_companies=
+                              sample.impf_exclude_small_market_value_companies_by_tushare_cache)
+    latencies: List[float] = [timed(partial(build, d))[1] for d in rebalance_dates]
+    _, pool_s = timed(lambda: sample.impf_build_sample_pool(rebalance_dates))
+    return {'build_samples_per_date_s': float(np.mean(latencies)) if len(latencies) > 0 else np.nan,
+            'build_sample_pool_s': pool_s, 'rebalance_dates': len(rebalance_dates)}
+
+
+def imp_git_commit() -> Optional[Text]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def imp_store_result(result: Dict, path: Text) -> Optional[Dict]:
+    """ 追加本次结果，返回同样规模参数下的上一次结果
+    """
+    previous: Optional[Dict] = None
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                record: Dict = json.loads(line)
+                if record.get('config') == result['config']:
+                    previous = record
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return previous
+
+
+def db_size_mb(db_path: Text) -> float:
+    # WAL模式下最近提交的页还在-wal文件中，没有合并进主文件
+    return sum(os.path.getsize(p) for p in (db_path, db_path + '-wal') if os.path.exists(p)) / 1024 ** 2
+
+
+def imp_run_benchmark(cfg: Bench_config, results_path: Text, work_dir: Optional[Text] = None) -> Dict:
+    saved: Dict[Text, Optional[Text]] = {name: os.environ.get(name) for name in ('AQF_DATA_DIR', 'AQF_TUSHARE_OFFLINE')}
+    try:
+        with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+            os.environ['AQF_DATA_DIR'] = tmp
+            os.environ['AQF_TUSHARE_OFFLINE'] = '1'
+            universe, generate_s = timed(lambda: build_universe(cfg))
+            metrics: Dict[Text, float] = {'generate_universe_s': generate_s}
+            metrics.update(imp_bench_ingest(universe, cfg))
+            metrics.update(imp_bench_queries(universe))
+            from src import sample
+            from src import tushare_data as td
+            imp_seed_response_cache(universe, cfg, list(sample.filter_updated_date(
+                universe.calendar[(universe.calendar['cal_date'] >= sample.sample_config().start_date) &
+                                  (universe.calendar['cal_date'] <= sample.sample_config().end_date)]
+                .itertuples(index=False, name='Trade_cal'))))
+            metrics.update(imp_bench_samples(universe, cfg))
+            dba.imp_flush_all()
+            metrics['db_size_mb'] = db_size_mb(td.db_config().db_path)
+            metrics['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        # 恢复调用前的环境变量，同一进程中之后的代码仍使用原来的数据目录
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    result: Dict = {'commit': imp_git_commit(), 'time': datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+                    'config': dict(cfg._asdict()), 'metrics': metrics}
+    previous: Optional[Dict] = imp_store_result(result, results_path)
+    for name, value in metrics.items():
+        before: Any = previous['metrics'].get(name) if previous is not None else None
+        change: Text = f'  ({(value / before - 1) * 100:+.1f}% vs {previous["commit"]})' \
+            if isinstance(before, (int, float)) and before and value is not None else ''
+        print(f'{name:45s} {value if value is not None else float("nan"):14.4f}{change}')
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='仿真数据上的下载和样本构建基准测试')
+    parser.add_argument('--codes', type=int, default=bench_config().n_codes)
+    parser.add_argument('--days', type=int, default=bench_config().n_days)
+    parser.add_argument('--persist-codes', type=int, default=bench_config().persist_codes)
+    parser.add_argument('--results', default=os.path.join(dba.data_dir(), 'benchmark_results.jsonl'))
+    parser.add_argument('--work-dir', default=None)
+    args = parser.parse_args()
+    imp_run_benchmark(bench_config()._replace(n_codes=args.codes, n_days=args.days,
+                                              persist_codes=min(args.persist_codes, args.codes)),
+                      args.results, args.work_dir)
@@ -0,0 +1,356 @@
+""" SQLite连接管理
+数据库使用WAL日志模式，读连接放在连接池中复用，研究查询可以与数据下载同时进行；所有写操作交给一个专用的写线程，
+多批executemany合并在一个事务中提交，避免每批数据一次fsync。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, List, Iterator, Sequence
+from collections import namedtuple
+from contextlib import contextmanager
+import sqlite3
+import threading
+import queue
+import atexit
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+Db_access_config: NamedTuple = namedtuple('Db_access_config', 'pool_size, txn_rows, group_seconds, queue_size, \
+                                          busy_timeout_ms, cache_kib, mmap_bytes, fetch_rows, begin_retries')
+# done: wait=True时事务提交或失败后置位; errors: wait=True时收集这一批的错误，否则为None，错误留到flush时抛出
+# after: 在同一个保存点中紧接着执行的(sql, 参数)，与这一批一起提交或回滚; on_error: 这一批失败时在写线程中调用，
+# 给出on_error的批次由调用者处理错误，不在flush时抛出
+Write_item: NamedTuple = namedtuple('Write_item', 'sql, rows, many, done, errors, after, on_error')
+
+
+def data_dir() -> Text:
+    # 本地数据目录，可以用环境变量AQF_DATA_DIR指向别处，例如基准测试使用的临时目录
+    return os.environ.get('AQF_DATA_DIR', '..\\data')
+
+
+def db_access_config() -> Db_access_config:
+    # txn_rows: 一个事务最多合并的行数; group_seconds: 写队列空闲时最多再等多久凑批; fetch_rows: 读取时每次从游标取的行数
+    # begin_retries: 其他进程长时间占用写锁、BEGIN超时后重试的次数
+    return Db_access_config(pool_size=4, txn_rows=200000, group_seconds=0.2, queue_size=256,
+                            busy_timeout_ms=60000, cache_kib=256 * 1024, mmap_bytes=1 << 30, fetch_rows=50000,
+                            begin_retries=3)
+
+
+def is_busy(e: Exception) -> bool:
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+
+def pragmas(cfg: Db_access_config) -> List[Text]:
+    return ['PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA temp_store=MEMORY',
+            f'PRAGMA cache_size=-{cfg.cache_kib}',
+            f'PRAGMA mmap_size={cfg.mmap_bytes}',
+            f'PRAGMA busy_timeout={cfg.busy_timeout_ms}']
+
+
+def imp_connect(db_path: Text, cfg: Db_access_config, query_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=cfg.busy_timeout_ms / 1000, check_same_thread=False,
+                           isolation_level=None)
+    for pragma in pragmas(cfg):
+        conn.execute(pragma)
+    if query_only is True:
+        conn.execute('PRAGMA query_only=ON')
+    return conn
+
+
+def column_dtype(values: Sequence) -> Optional[np.dtype]:
+    """ 一列值的类型：全为整数时为int64，整数含NULL或有小数时为float64，其他为object；全为NULL时无法判断，返回None
+    """
+    kinds: set = set(map(type, values))
+    has_null: bool = type(None) in kinds
+    kinds.discard(type(None))
+    if len(kinds) == 0:
+        return None
+    if kinds <= {int} and has_null is False:
+        return np.dtype(np.int64)
+    if kinds <= {int, float}:
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def typed_column(values: Sequence, dtype: Optional[np.dtype] = None) -> np.ndarray:
+    """ 把游标中一列的值转换成有类型的NumPy数组，NULL在float64列中为NaN；没有给出dtype时按这一列的值判断
+    """
+    inferred: Optional[np.dtype] = column_dtype(values)
+    if dtype is None:
+        dtype = inferred
+    elif dtype != object and np.result_type(dtype, inferred if inferred is not None else np.float64) != dtype:
+        raise ValueError(f'column values of type {inferred} or NULL do not fit {dtype}')
+    if dtype is not None and dtype != object:
+        return np.array(values, dtype=dtype)
+    column: np.ndarray = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def rows_to_columns(rows: List[Tuple], n_columns: int,
+                    dtypes: Optional[List[Optional[np.dtype]]] = None) -> List[np.ndarray]:
+    if len(rows) == 0:
+        return [np.empty(0, dtype=object) for _ in range(n_columns)]
+    return [typed_column(values, None if dtypes is None else dtypes[i]) for i, values in enumerate(zip(*rows))]
+
+
+def array_dtype(column: np.ndarray) -> Optional[np.dtype]:
+    # 全为NULL的object数组还不能确定类型
+    return None if column.dtype == object and all(v is None for v in column) else column.dtype
+
+
+def fixed_dtypes(names: List[Text], dtypes: Optional[Dict[Text, Any]]) -> List[Optional[np.dtype]]:
+    return [None if dtypes is None or dtypes.get(name) is None else np.dtype(dtypes[name]) for name in names]
+
+
+def concat_columns(chunks: List[List[np.ndarray]], n_columns: int) -> List[np.ndarray]:
+    if len(chunks) == 1:
+        return chunks[0]
+    columns: List[np.ndarray] = []
+    for i in range(n_columns):
+        parts: List[np.ndarray] = [chunk[i] for chunk in chunks]
+        # 各批次类型不同时按NumPy规则提升：int与float合并为float，与文本合并为object；全为NULL的批次不参与判断
+        known: List[np.ndarray] = [p for p in parts if array_dtype(p) is not None]
+        dtype: np.dtype = np.result_type(*[p.dtype for p in known]) if len(known) > 0 else np.dtype(object)
+        if dtype.kind == 'i' and len(known) < len(parts):
+            dtype = np.dtype(np.float64)
+        # 全为NULL的批次是None的object数组，转为float64时为NaN
+        columns.append(np.concatenate([p if dtype == object else p.astype(dtype, copy=False) if p.dtype != object
+                                       else np.array(p.tolist(), dtype=dtype) for p in parts])
+                       if len(parts) > 0 else np.empty(0, dtype=object))
+    return columns
+
+
+def project(sql: Text, columns: Optional[Sequence[Text]]) -> Text:
+    return sql if columns is None else f"SELECT {', '.join(columns)} FROM ({sql})"
+
+
+def iter_frames(conn: sqlite3.Connection, sql: Text, params: Sequence = (), chunk_rows: int = 50000,
+                columns: Optional[Sequence[Text]] = None,
+                dtypes: Optional[Dict[Text, Any]] = None) -> Iterator[pd.DataFrame]:
+    """ 按chunk_rows行一批返回DataFrame，各列直接由游标数据构建NumPy数组，全表扫描时内存占用与批大小相当
+
+    每列的类型只确定一次，所有批次相同：dtypes中给出的列按给出的类型(如表结构中声明的类型)，其他列按第一批有值的数据判断；
+    按第一批判断为int64的列在后面的批次出现NULL时抛出ValueError，可能含NULL的整数列应在dtypes中声明为float64
+    """
+    cursor: sqlite3.Cursor = conn.execute(project(sql, columns), params)
+    names: List[Text] = [description[0] for description in cursor.description]
+    fixed: List[Optional[np.dtype]] = fixed_dtypes(names, dtypes)
+    while True:
+        rows: List[Tuple] = cursor.fetchmany(chunk_rows)
+        if len(rows) == 0:
+            return
+        arrays: List[np.ndarray] = rows_to_columns(rows, len(names), fixed)
+        fixed = [dtype if dtype is not None else array_dtype(array) for dtype, array in zip(fixed, arrays)]
+        yield pd.DataFrame(dict(zip(names, arrays)), columns=names)
+
+
+def read_frame(conn: sqlite3.Connection, sql: Text, params: Sequence = (), chunk_rows: int = 50000,
+               columns: Optional[Sequence[Text]] = None,
+               dtypes: Optional[Dict[Text, Any]] = None) -> pd.DataFrame:
+    """ 读取全部结果，分批转换成列数组后再拼接，不保留全部行元组
+    """
+    cursor: sqlite3.Cursor = conn.execute(project(sql, columns), params)
+    names: List[Text] = [description[0] for description in cursor.description]
+    fixed: List[Optional[np.dtype]] = fixed_dtypes(names, dtypes)
+    chunks: List[List[np.ndarray]] = []
+    while True:
+        rows: List[Tuple] = cursor.fetchmany(chunk_rows)
+        if len(rows) == 0:
+            break
+        chunks.append(rows_to_columns(rows, len(names), fixed))
+    return pd.DataFrame(dict(zip(names, concat_columns(chunks, len(names)))), columns=names)
+
+
+class Db_access:
+    """ 一个数据库文件的读连接池和写线程
+
+    写入出错的批次回滚后记录下来：wait=True的写操作在返回时抛出这一批的错误，其他批次的错误在下一次flush时抛出；
+    failures为累计失败的批次数
+    """
+    def __init__(self, db_path: Text, cfg: Optional[Db_access_config] = None) -> None:
+        self.db_path: Text = db_path
+        self.cfg: Db_access_config = cfg or db_access_config()
+        self.readers: queue.LifoQueue = queue.LifoQueue(maxsize=self.cfg.pool_size)
+        self.writes: queue.Queue = queue.Queue(maxsize=self.cfg.queue_size)
+        self.failures: int = 0
+        self.errors: List[Exception] = []
+        self.errors_lock: threading.Lock = threading.Lock()
+        self.writer: threading.Thread = threading.Thread(target=self._write_loop, name=f'sqlite-writer:{db_path}',
+                                                         daemon=True)
+        self.writer.start()
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn: sqlite3.Connection = self.readers.get_nowait()
+        except queue.Empty:
+            conn = imp_connect(self.db_path, self.cfg, query_only=True)
+        try:
+            yield conn
+        finally:
+            try:
+                self.readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def execute(self, sql: Text, params: Sequence = ()) -> List[Tuple]:
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def read_frame(self, sql: Text, params: Sequence = (), columns: Optional[Sequence[Text]] = None,
+                   dtypes: Optional[Dict[Text, Any]] = None) -> pd.DataFrame:
+        with self.reader() as conn:
+            return read_frame(conn, sql, params, self.cfg.fetch_rows, columns, dtypes)
+
+    def iter_frames(self, sql: Text, params: Sequence = (), chunk_rows: Optional[int] = None,
+                    columns: Optional[Sequence[Text]] = None,
+                    dtypes: Optional[Dict[Text, Any]] = None) -> Iterator[pd.DataFrame]:
+        with self.reader() as conn:
+            yield from iter_frames(conn, sql, params, chunk_rows or self.cfg.fetch_rows, columns, dtypes)
+
+    def write(self, sql: Text, rows: Any = (), many: bool = False, wait: bool = False, after: Sequence[Tuple] = (),
+              on_error: Optional[Callable[[Exception], Any]] = None) -> Any:
+        """ 提交写操作；wait=True时等到所在事务提交后才返回，这一批写入失败时抛出错误
+        """
+        if self.writer.is_alive() is False:
+            raise sqlite3.OperationalError(f'{self.db_path}的写线程已经退出')
+        item: Write_item = Write_item(sql, rows, many, threading.Event() if wait is True else None,
+                                      [] if wait is True else None, tuple(after), on_error)
+        self.writes.put(item)
+        if item.done is not None:
+            # 写线程意外退出时不再等待
+            while item.done.wait(1.0) is False:
+                if self.writer.is_alive() is False:
+                    raise sqlite3.OperationalError(f'{self.db_path}的写线程已经退出')
+            if len(item.errors) > 0:
+                raise item.errors[0]
+
+    def write_many(self, sql: Text, rows: Sequence[Sequence], wait: bool = False, after: Sequence[Tuple] = (),
+                   on_error: Optional[Callable[[Exception], Any]] = None) -> Any:
+        self.write(sql, rows, many=True, wait=wait, after=after, on_error=on_error)
+
+    def flush(self) -> Any:
+        """ 等待已提交的写操作全部完成；之前有未等待的批次写入失败时抛出
+        """
+        self.write('', wait=True)
+        with self.errors_lock:
+            errors, self.errors = self.errors, []
+        if len(errors) > 0:
+            raise sqlite3.DatabaseError(f'{self.db_path}有{len(errors)}批数据写入失败，第一个错误：{errors[0]}')
+
+    def _record_error(self, item: Write_item, e: Exception) -> Any:
+        print(e)
+        with self.errors_lock:
+            self.failures += 1
+            if item.errors is not None:
+                item.errors.append(e)
+            elif item.on_error is None:
+                self.errors.append(e)
+        if item.on_error is not None:
+            try:
+                item.on_error(e)
+            except Exception as callback_error:
+                print(callback_error)
+
+    def _begin(self, conn: sqlite3.Connection) -> Any:
+        # busy_timeout内没有拿到写锁时重试，仍然失败时由调用者把取出的批次记为失败
+        for attempt in range(self.cfg.begin_retries + 1):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if is_busy(e) is False or attempt == self.cfg.begin_retries:
+                    raise
+
+    def _write_loop(self) -> Any:
+        conn: sqlite3.Connection = imp_connect(self.db_path, self.cfg)
+        while True:
+            item: Write_item = self.writes.get()
+            # 取出的批次先登记，任何一步出错都能置位done并记录错误，等待的调用者不会挂起
+            taken: List[Write_item] = [item]
+            failed: List[Write_item] = []
+            txn_rows: int = 0
+            deadline: float = time.time() + self.cfg.group_seconds
+            try:
+                self._begin(conn)
+                while True:
+                    txn_rows += self._apply(conn, item, failed)
+                    if item.done is not None or txn_rows >= self.cfg.txn_rows:
+                        break
+                    try:
+                        item = self.writes.get(timeout=max(deadline - time.time(), 0.0))
+                    except queue.Empty:
+                        break
+                    taken.append(item)
+                conn.execute('COMMIT')
+            except Exception as e:
+                try:
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                except sqlite3.Error as rollback_error:
+                    print(rollback_error)
+                # 整个事务没有提交，其中所有还没有记过错误的批次都算失败
+                for lost in taken:
+                    if lost.sql != '' and all(lost is not f for f in failed):
+                        self._record_error(lost, e)
+            finally:
+                for done in [t.done for t in taken if t.done is not None]:
+                    done.set()
+
+    def _apply(self, conn: sqlite3.Connection, item: Write_item, failed: List[Write_item]) -> int:
+        if item.sql == '':
+            return 0
+        # 每批数据一个保存点，出错的批次单独回滚，不影响同一事务中的其他批次
+        conn.execute('SAVEPOINT batch')
+        try:
+            if item.many is True:
+                rows: int = conn.executemany(item.sql, item.rows).rowcount
+            else:
+                rows = max(conn.execute(item.sql, item.rows).rowcount, 1)
+            for sql, params in item.after:
+                conn.execute(sql, params)
+            conn.execute('RELEASE batch')
+        except Exception as e:
+            conn.execute('ROLLBACK TO batch')
+            conn.execute('RELEASE batch')
+            failed.append(item)
+            self._record_error(item, e)
+            rows = 0
+        return max(rows, 0)
+
+
+_access: Dict[Text, Db_access] = {}
+_access_lock: threading.Lock = threading.Lock()
+
+
+def imp_db(db_path: Text) -> Db_access:
+    with _access_lock:
+        if db_path not in _access:
+            _access[db_path] = Db_access(db_path)
+        return _access[db_path]
+
+
+def imp_evict_lru(access: Db_access, tbl_name: Text, max_bytes: int) -> List[Text]:
+    """ 缓存表中条目的size合计超过max_bytes时按最近访问时间accessed从旧到新删除，返回删除的key
+
+    缓存表需要有key、size、accessed三列
+    """
+    entries: List = access.execute(f'SELECT key, size FROM {tbl_name} ORDER BY accessed DESC')
+    sizes: np.ndarray = np.array([size for _, size in entries], dtype=np.int64)
+    keep: int = int(np.searchsorted(np.cumsum(sizes), max_bytes, 'right'))
+    evicted: List[Text] = [key for key, _ in entries[keep:]]
+    if len(evicted) > 0:
+        access.write_many(f'DELETE FROM {tbl_name} WHERE key=?', [(key,) for key in evicted], wait=True)
+    return evicted
+
+
+@atexit.register
+def imp_flush_all() -> Any:
+    for access in list(_access.values()):
+        try:
+            access.flush()
+        except sqlite3.Error as e:
+            print(e)
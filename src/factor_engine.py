@@ -0,0 +1,199 @@
+""" 日频因子计算
+因子声明为有向无环图：每个节点给出输入（面板字段或其他节点）、回看窗口和一个作用在(trade_date × ts_code)面板上的
+向量化函数。共用的中间结果（如日收益率）每批只计算一次。结果保存在面板存储的factor表中；日交易数据追加新的交易日后，
+只用各因子所需的回看窗口重新计算尾部，不重算全部历史。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, List, Iterable
+from collections import namedtuple
+from functools import partial
+import math
+
+import numpy as np
+import pandas as pd
+
+from src import panel_store as ps
+from src import tushare_data as td
+
+# inputs: 面板字段名或其他因子名; window: 计算一行结果用到的输入行数（含当日），截面运算为1
+Factor: NamedTuple = namedtuple('Factor', 'name, inputs, window, compute')
+Factor_config: NamedTuple = namedtuple('Factor_config', 'table, base_table, dates_per_block, min_periods_ratio, \
+                                       factors')
+
+
+def factor_config() -> Factor_config:
+    # factors: 写入面板的因子，其余节点只作为中间结果
+    return Factor_config(table='factor', base_table=td.db_config().tbl_daily_trading_data, dates_per_block=500,
+                         min_periods_ratio=0.8,
+                         factors=('momentum_12_1', 'reversal_20', 'volatility_20', 'volatility_60', 'turnover_20',
+                                  'turnover_ratio_20_250', 'size', 'ep_rank', 'bp_rank', 'sp_rank',
+                                  'z_momentum_12_1', 'z_reversal_20', 'z_volatility_20', 'z_turnover_20', 'z_size',
+                                  'z_ep', 'z_bp', 'z_sp'))
+
+
+def source_fields() -> Dict[Text, Text]:
+    """ 面板字段到所在面板表的映射
+    """
+    return {field: table for table, fields in ps.panel_config().fields.items() for field in fields}
+
+
+def rolling(frame: pd.DataFrame, window: int) -> Any:
+    # 停牌日为NaN，窗口内有效数据不少于min_periods_ratio时才有结果
+    return frame.rolling(window, min_periods=max(1, math.ceil(window * factor_config().min_periods_ratio)))
+
+
+def reciprocal(frame: pd.DataFrame) -> pd.DataFrame:
+    return (1 / frame).replace([np.inf, -np.inf], np.nan)
+
+
+def cs_rank(frame: pd.DataFrame) -> pd.DataFrame:
+    """ 每个交易日的截面百分位
+    """
+    return frame.rank(axis=1, pct=True)
+
+
+def cs_zscore(frame: pd.DataFrame, clip: float = 3.0) -> pd.DataFrame:
+    """ 每个交易日的截面标准分，超过clip个标准差的截断
+    """
+    values: pd.DataFrame = frame.replace([np.inf, -np.inf], np.nan)
+    return values.sub(values.mean(axis=1), axis=0).div(values.std(axis=1), axis=0).clip(-clip, clip)
+
+
+def factor_graph() -> Dict[Text, Factor]:
+    factors: List[Factor] = [
+        Factor('ret', ('pct_chg',), 1, lambda pct: pct / 100),
+        Factor('log_ret', ('ret',), 1, np.log1p),
+        # 过去12个月剔除最近1个月的累计收益
+        Factor('momentum_12_1', ('log_ret',), 250, lambda r: rolling(r.shift(20), 230).sum()),
+        Factor('reversal_20', ('log_ret',), 20, lambda r: -rolling(r, 20).sum()),
+        Factor('volatility_20', ('ret',), 20, lambda r: rolling(r, 20).std()),
+        Factor('volatility_60', ('ret',), 60, lambda r: rolling(r, 60).std()),
+        Factor('turnover_20', ('turnover_rate',), 20, lambda t: rolling(t, 20).mean()),
+        Factor('turnover_250', ('turnover_rate',), 250, lambda t: rolling(t, 250).mean()),
+        Factor('turnover_ratio_20_250', ('turnover_20', 'turnover_250'), 1, lambda a, b: a / b),
+        Factor('size', ('total_mv',), 1, lambda mv: np.log(mv.where(mv > 0))),
+        Factor('ep', ('pe_ttm',), 1, reciprocal),
+        Factor('bp', ('pb',), 1, reciprocal),
+        Factor('sp', ('ps_ttm',), 1, reciprocal),
+        Factor('ep_rank', ('ep',), 1, cs_rank),
+        Factor('bp_rank', ('bp',), 1, cs_rank),
+        Factor('sp_rank', ('sp',), 1, cs_rank)]
+    zscores: List[Factor] = [Factor(f'z_{name}', (name,), 1, cs_zscore)
+                             for name in ('momentum_12_1', 'reversal_20', 'volatility_20', 'turnover_20', 'size',
+                                          'ep', 'bp', 'sp')]
+    return {factor.name: factor for factor in factors + zscores}
+
+
+def topo_order(graph: Dict[Text, Factor], targets: Iterable[Text]) -> List[Text]:
+    """ 计算targets需要的节点，按依赖顺序排列
+    """
+    order: List[Text] = []
+    visiting: set = set()
+
+    def visit(name: Text) -> Any:
+        if name in order or name not in graph:
+            return
+        if name in visiting:
+            raise ValueError(f'因子{name}的依赖有环')
+        visiting.add(name)
+        for dependency in graph[name].inputs:
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def lookback(graph: Dict[Text, Factor], name: Text) -> int:
+    """ 计算一行结果需要向前多读的输入行数，沿依赖链累加
+    """
+    if name not in graph:
+        return 0
+    return graph[name].window - 1 + max(lookback(graph, dependency) for dependency in graph[name].inputs)
+
+
+def compute_block(graph: Dict[Text, Factor], targets: Iterable[Text],
+                  load: Callable[[Text], pd.DataFrame]) -> Dict[Text, pd.DataFrame]:
+    """ 在一段连续交易日的面板上按依赖顺序计算，load按字段名返回同样行列的输入面板
+    """
+    frames: Dict[Text, pd.DataFrame] = {}
+    for name in topo_order(graph, targets):
+        inputs: List[pd.DataFrame] = []
+        for dependency in graph[name].inputs:
+            if dependency not in frames:
+                frames[dependency] = load(dependency)
+            inputs.append(frames[dependency])
+        frames[name] = graph[name].compute(*inputs)
+    return frames
+
+
+def long_rows(frames: Dict[Text, pd.DataFrame], fields: Tuple) -> pd.DataFrame:
+    """ 把各因子的宽表转成imp_write_rows使用的(trade_date, ts_code, 各因子)长表
+
+    全部为空的行也要写入：重新计算后变为空值的因子要覆盖面板中原来的值，整个交易日都为空时也要登记这个交易日
+    """
+    first: pd.DataFrame = frames[fields[0]]
+    return pd.DataFrame({'trade_date': np.repeat(first.index.values, first.shape[1]),
+                         'ts_code': np.tile(first.columns.values, first.shape[0]),
+                         **{field: frames[field].values.ravel() for field in fields}})
+
+
+def imp_load_field(field: Text, start_date: int, end_date: int, dates: np.ndarray, codes: np.ndarray,
+                   root: Optional[Text] = None) -> pd.DataFrame:
+    # 各面板表的交易日不完全相同，统一对齐到基准面板；股票列都按证券主表的编号排列，只是长度不同，按位置对齐
+    frame: pd.DataFrame = ps.panel_frame(source_fields()[field], field, start_date, end_date, root=root)
+    n: int = min(frame.shape[1], len(codes))
+    if np.array_equal(frame.columns.values[:n].astype(str), codes[:n].astype(str)) is False:
+        return frame.reindex(index=dates, columns=codes).astype(np.float64)
+    values: np.ndarray = np.full((len(frame), len(codes)), np.nan)
+    values[:, :n] = frame.values[:, :n]
+    return pd.DataFrame(values, index=frame.index, columns=codes).reindex(index=dates)
+
+
+def imp_update_factors(targets: Optional[Tuple] = None, since: Optional[int] = None,
+                       root: Optional[Text] = None) -> Optional[ps.Panel_meta]:
+    """ 计算基准面板中trade_date >= since的因子并写入factor面板
+
+    since缺省为factor面板中第一个缺少的交易日；since=0或要计算的因子与面板中已有的不同时重建整个factor面板
+    """
+    cfg: Factor_config = factor_config()
+    graph: Dict[Text, Factor] = factor_graph()
+    fields: Tuple = tuple(targets or cfg.factors)
+    meta: Optional[ps.Panel_meta] = ps.imp_read_meta(cfg.table, root)
+    if since == 0 or (meta is not None and tuple(meta.fields) != fields):
+        ps.imp_remove_panel(cfg.table, root)
+        since = 0
+
+    base: Optional[ps.Panel_meta] = ps.imp_read_meta(cfg.base_table, root)
+    dates: np.ndarray = ps.imp_dates(cfg.base_table, root, base)
+    codes: np.ndarray = ps.imp_codes(cfg.base_table, root, base)
+    done: np.ndarray = ps.imp_dates(cfg.table, root)
+    # 基准面板补录了中间的交易日时，从第一个缺少因子的交易日重新计算，之后的窗口都包含补录的日期
+    missing: np.ndarray = np.flatnonzero(~np.isin(dates, done))
+    start: int = int(np.searchsorted(dates, since, 'left')) if since is not None \
+        else int(missing[0]) if len(missing) > 0 else len(dates)
+    need: int = max(lookback(graph, field) for field in fields)
+
+    meta = ps.imp_read_meta(cfg.table, root)
+    for lo in range(start, len(dates), cfg.dates_per_block):
+        hi: int = min(lo + cfg.dates_per_block, len(dates))
+        first: int = max(lo - need, 0)
+        frames: Dict[Text, pd.DataFrame] = compute_block(
+            graph, fields, partial(imp_load_field, start_date=int(dates[first]), end_date=int(dates[hi - 1]),
+                                   dates=dates[first:hi], codes=codes, root=root))
+        rows: pd.DataFrame = long_rows({field: frames[field].iloc[lo - first:] for field in fields}, fields)
+        if rows.empty is False:
+            meta = ps.imp_write_rows(cfg.table, rows, fields, root)
+    return meta
+
+
+def factor_frame(name: Text, start_date: Optional[int] = None, end_date: Optional[int] = None,
+                 codes: Optional[List[Text]] = None, root: Optional[Text] = None) -> pd.DataFrame:
+    return ps.panel_frame(factor_config().table, name, start_date, end_date, codes, root)
+
+
+if __name__ == '__main__':
+    for tbl in ps.panel_config().fields:
+        ps.imp_sync_panel(tbl)
+    print(imp_update_factors())
@@ -0,0 +1,302 @@
+""" 日频面板数据的内存映射列式存储
+每个字段保存为一个(trade_date × ts_code)的稠密数组文件，日期和股票代码索引另存。读取时直接映射到内存，按日期或股票切片
+得到的是NumPy/pandas视图，不复制数据。SQLite中有新交易日的数据时增量追加，股票代码列预留空位，新上市的股票直接占用。
+股票列按证券主表的编号排列，各面板第j列都是编号为j的股票。
+扩容或补录中间的交易日要重写整个字段文件，重写的文件和索引作为新的一代写在g{n}子目录中，最后写meta.json切换到新的
+一代；中途失败或正在读取的进程看到的仍是上一代完整的文件。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Dict, List, Iterator
+from collections import namedtuple
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from src import db_access as dba
+from src import security_master as sm
+from src import tushare_data as td
+
+Panel_config: NamedTuple = namedtuple('Panel_config', 'root, dtype, code_block, dates_per_read, fields')
+# generation: 字段文件和索引所在的一代，0为表目录本身
+Panel_meta: NamedTuple = namedtuple('Panel_meta', 'n_dates, n_codes, capacity, fields, dtype, generation')
+
+
+def panel_config() -> Panel_config:
+    return Panel_config(root=os.path.join(dba.data_dir(), 'panel'), dtype='float32', code_block=512,
+                        dates_per_read=250,
+                        fields={td.db_config().tbl_daily_trading_data: ('open', 'high', 'low', 'close', 'pre_close',
+                                                                         'change', 'pct_chg', 'vol', 'amount'),
+                                td.db_config().tbl_daily_basic: ('turnover_rate', 'turnover_rate_f', 'volume_ratio',
+                                                                 'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm', 'total_share',
+                                                                 'float_share', 'free_share', 'total_mv', 'circ_mv'),
+                                td.db_config().tbl_adj_factor: ('adj_factor',)})
+
+
+def panel_path(table: Text, name: Text, root: Optional[Text] = None) -> Text:
+    return os.path.join(root or panel_config().root, table, name)
+
+
+def generation_path(table: Text, name: Text, generation: int, root: Optional[Text] = None) -> Text:
+    return panel_path(table, name if generation == 0 else os.path.join(f'g{generation}', name), root)
+
+
+def field_path(table: Text, field: Text, meta: Panel_meta, root: Optional[Text] = None) -> Text:
+    return generation_path(table, f'{field}.bin', meta.generation, root)
+
+
+def imp_read_meta(table: Text, root: Optional[Text] = None) -> Optional[Panel_meta]:
+    path: Text = panel_path(table, 'meta.json', root)
+    if os.path.exists(path) is False:
+        return None
+    with open(path, 'r') as f:
+        # 早先的meta.json没有generation，文件在表目录中
+        return Panel_meta(**{'generation': 0, **json.load(f)})
+
+
+def imp_write_meta(table: Text, meta: Panel_meta, root: Optional[Text] = None) -> Any:
+    # 先写临时文件再替换，meta.json是追加操作的提交点，读者只看得到n_dates以内的行
+    path: Text = panel_path(table, 'meta.json', root)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(meta._asdict()), f)
+    os.replace(path + '.tmp', path)
+
+
+def imp_write_index(table: Text, name: Text, values: np.ndarray, generation: int,
+                    root: Optional[Text] = None) -> Any:
+    path: Text = generation_path(table, name, generation, root)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, values)
+    os.replace(path + '.tmp', path)
+
+
+def imp_dates(table: Text, root: Optional[Text] = None, meta: Optional[Panel_meta] = None) -> np.ndarray:
+    meta = meta or imp_read_meta(table, root)
+    return np.load(generation_path(table, 'dates.npy', meta.generation, root))[:meta.n_dates] if meta is not None \
+        else np.array([], dtype=np.int64)
+
+
+def imp_codes(table: Text, root: Optional[Text] = None, meta: Optional[Panel_meta] = None) -> np.ndarray:
+    meta = meta or imp_read_meta(table, root)
+    return np.load(generation_path(table, 'codes.npy', meta.generation, root))[:meta.n_codes] if meta is not None \
+        else np.array([], dtype=str)
+
+
+def imp_open_field(table: Text, field: Text, root: Optional[Text] = None, mode: Text = 'r',
+                   meta: Optional[Panel_meta] = None) -> np.ndarray:
+    """ 把字段文件映射为(n_dates, capacity)的数组，mode='r'时只读；读取日期、代码和字段时应使用同一个meta
+    """
+    meta = meta or imp_read_meta(table, root)
+    if meta.n_dates == 0:
+        return np.empty((0, meta.capacity), dtype=meta.dtype)
+    return np.memmap(field_path(table, field, meta, root), dtype=meta.dtype, mode=mode,
+                     shape=(meta.n_dates, meta.capacity))
+
+
+def panel_frame(table: Text, field: Text,
+                start_date: Optional[int] = None,
+                end_date: Optional[int] = None,
+                codes: Optional[List[Text]] = None,
+                root: Optional[Text] = None) -> pd.DataFrame:
+    """ 取[start_date, end_date]之间的(trade_date × ts_code)面板
+
+    按日期切片是连续的行，返回的DataFrame直接引用映射的内存；指定codes时按列取值，会复制选中的列
+    """
+    meta: Panel_meta = imp_read_meta(table, root)
+    dates: np.ndarray = imp_dates(table, root, meta)
+    all_codes: np.ndarray = imp_codes(table, root, meta)
+    lo: int = int(np.searchsorted(dates, start_date, 'left')) if start_date is not None else 0
+    hi: int = int(np.searchsorted(dates, end_date, 'right')) if end_date is not None else len(dates)
+    values: np.ndarray = imp_open_field(table, field, root, meta=meta)[lo:hi, :len(all_codes)]
+    if codes is not None:
+        columns: np.ndarray = pd.Index(all_codes).get_indexer(codes)
+        values = np.where(columns >= 0, values[:, columns], np.nan)
+        return pd.DataFrame(values, index=dates[lo:hi], columns=codes, copy=False)
+    return pd.DataFrame(values, index=dates[lo:hi], columns=all_codes, copy=False)
+
+
+def date_row(table: Text, field: Text, trade_date: int, root: Optional[Text] = None) -> pd.Series:
+    meta: Panel_meta = imp_read_meta(table, root)
+    dates: np.ndarray = imp_dates(table, root, meta)
+    i: int = int(np.searchsorted(dates, trade_date, 'left'))
+    if i == len(dates) or dates[i] != trade_date:
+        raise KeyError(trade_date)
+    all_codes: np.ndarray = imp_codes(table, root, meta)
+    return pd.Series(imp_open_field(table, field, root, meta=meta)[i, :len(all_codes)], index=all_codes,
+                     name=trade_date, copy=False)
+
+
+def code_column(table: Text, field: Text, ts_code: Text, root: Optional[Text] = None) -> pd.Series:
+    meta: Panel_meta = imp_read_meta(table, root)
+    j: int = int(pd.Index(imp_codes(table, root, meta)).get_loc(ts_code))
+    return pd.Series(imp_open_field(table, field, root, meta=meta)[:, j], index=imp_dates(table, root, meta),
+                     name=ts_code, copy=False)
+
+
+def imp_new_generation(table: Text, meta: Panel_meta, root: Optional[Text] = None) -> Panel_meta:
+    # 上次写到一半的同号目录没有提交过，清空后重写
+    generation: int = meta.generation + 1
+    path: Text = generation_path(table, '', generation, root)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return meta._replace(generation=generation)
+
+
+def imp_remove_generations(table: Text, keep: Tuple, root: Optional[Text] = None) -> Any:
+    """ 删除keep以外的各代文件；保留上一代，刚读到旧meta.json的进程仍能打开它的文件
+    """
+    table_dir: Text = panel_path(table, '', root)
+    for name in os.listdir(table_dir):
+        match = re.fullmatch(r'g(\d+)', name)
+        if match is not None and int(match.group(1)) not in keep:
+            shutil.rmtree(os.path.join(table_dir, name), ignore_errors=True)
+    if 0 not in keep:
+        for name in os.listdir(table_dir):
+            if name.endswith('.bin') or name in ('dates.npy', 'codes.npy'):
+                os.remove(os.path.join(table_dir, name))
+
+
+def imp_grow_capacity(table: Text, meta: Panel_meta, capacity: int, root: Optional[Text] = None) -> Panel_meta:
+    """ 股票代码列的空位用完时按新的容量把字段文件重写为新的一代，逐行复制，内存占用与一行数据相当
+    """
+    if meta.n_dates == 0:
+        return meta._replace(capacity=capacity)
+    grown: Panel_meta = imp_new_generation(table, meta, root)._replace(capacity=capacity)
+    for field in meta.fields:
+        old: np.ndarray = np.memmap(field_path(table, field, meta, root), dtype=meta.dtype, mode='r',
+                                    shape=(meta.n_dates, meta.capacity))
+        new: np.ndarray = np.memmap(field_path(table, field, grown, root), dtype=meta.dtype, mode='w+',
+                                    shape=(meta.n_dates, capacity))
+        new[:, :meta.capacity] = old
+        new[:, meta.capacity:] = np.nan
+        new.flush()
+        del old, new
+    return grown
+
+
+def imp_insert_dates(table: Text, meta: Panel_meta, dates: np.ndarray, all_dates: np.ndarray,
+                     root: Optional[Text] = None) -> Panel_meta:
+    """ 补录的交易日落在面板中间时按新的日期序列把字段文件重写为新的一代，新日期的行为空；每次复制dates_per_read行
+    """
+    step: int = panel_config().dates_per_read
+    rows_at: np.ndarray = np.searchsorted(all_dates, dates)
+    inserted: Panel_meta = imp_new_generation(table, meta, root)._replace(n_dates=len(all_dates))
+    for field in meta.fields:
+        old: np.ndarray = np.memmap(field_path(table, field, meta, root), dtype=meta.dtype, mode='r',
+                                    shape=(meta.n_dates, meta.capacity))
+        new: np.ndarray = np.memmap(field_path(table, field, inserted, root), dtype=meta.dtype, mode='w+',
+                                    shape=(len(all_dates), meta.capacity))
+        new[:] = np.nan
+        for i in range(0, meta.n_dates, step):
+            new[rows_at[i:i + step]] = old[i:i + step]
+        new.flush()
+        del old, new
+    return inserted
+
+
+def imp_write_rows(table: Text, rows: pd.DataFrame, fields: Tuple, root: Optional[Text] = None) -> Panel_meta:
+    """ 把长表rows(trade_date, ts_code, 各字段)写入面板：已有的交易日原地覆盖，新的交易日追加在末尾，
+    早于面板最后一个交易日的新日期插入到相应位置
+    """
+    cfg: Panel_config = panel_config()
+    os.makedirs(os.path.join(root or cfg.root, table), exist_ok=True)
+    committed: Optional[Panel_meta] = imp_read_meta(table, root)
+    meta: Panel_meta = committed or Panel_meta(n_dates=0, n_codes=0, capacity=0, fields=list(fields), dtype=cfg.dtype,
+                                               generation=0)
+    dates: np.ndarray = imp_dates(table, root, committed)
+    codes: np.ndarray = imp_codes(table, root, committed)
+
+    row_dates: np.ndarray = rows['trade_date'].values.astype(np.int64)
+    new_dates: np.ndarray = np.setdiff1d(row_dates, dates)
+    # 面板已有的股票列先登记到主表（主表为空时按面板的顺序编号），之后两者的顺序必须一致
+    master: sm.Master_config = sm.master_config(root or cfg.root)
+    sm.imp_intern_codes(codes, master)
+    code_idx: np.ndarray = sm.imp_intern_codes(rows['ts_code'].values, master)
+    master_codes: np.ndarray = sm.imp_codes(master)
+    if np.array_equal(master_codes[:len(codes)], codes) is False:
+        raise ValueError(f'{table}面板的股票列与证券主表的编号不一致，请重建面板')
+    codes = master_codes
+    if len(codes) > meta.capacity:
+        meta = imp_grow_capacity(table, meta, -(-len(codes) // cfg.code_block) * cfg.code_block, root)
+    if len(new_dates) > 0 and len(dates) > 0 and new_dates[0] <= dates[-1]:
+        dates = np.union1d(dates, new_dates)
+        meta = imp_insert_dates(table, meta, imp_dates(table, root, committed), dates, root)
+        new_dates = new_dates[:0]
+
+    all_dates: np.ndarray = np.concatenate([dates, new_dates])
+    date_idx: np.ndarray = np.searchsorted(all_dates, row_dates)
+    appended: np.ndarray = date_idx >= len(dates)
+    for field in meta.fields:
+        values: np.ndarray = pd.to_numeric(rows[field], errors='coerce').values.astype(meta.dtype) \
+            if field in rows.columns else np.full(len(rows), np.nan, dtype=meta.dtype)
+        if (~appended).any():
+            # 容量和日期可能刚刚改变，meta.json还没有更新，按内存中的meta映射
+            existing: np.ndarray = np.memmap(field_path(table, field, meta, root), dtype=meta.dtype, mode='r+',
+                                             shape=(len(dates), meta.capacity))
+            existing[date_idx[~appended], code_idx[~appended]] = values[~appended]
+            existing.flush()
+            del existing
+        if len(new_dates) > 0:
+            block: np.ndarray = np.full((len(new_dates), meta.capacity), np.nan, dtype=meta.dtype)
+            block[date_idx[appended] - len(dates), code_idx[appended]] = values[appended]
+            with open(field_path(table, field, meta, root), 'ab') as f:
+                # 上次追加后没有写成meta.json时，文件末尾多出的行没有提交，先截掉再追加
+                f.truncate(len(dates) * meta.capacity * np.dtype(meta.dtype).itemsize)
+                f.write(block.tobytes())
+
+    # 同一代中追加只延长索引，已提交的前n_dates、n_codes项不变
+    imp_write_index(table, 'codes.npy', codes, meta.generation, root)
+    imp_write_index(table, 'dates.npy', all_dates, meta.generation, root)
+    meta = meta._replace(n_dates=len(all_dates), n_codes=len(codes))
+    imp_write_meta(table, meta, root)
+    if committed is not None and meta.generation != committed.generation:
+        imp_remove_generations(table, (committed.generation, meta.generation), root)
+    return meta
+
+
+def imp_remove_panel(table: Text, root: Optional[Text] = None) -> Any:
+    # 先删除提交点meta.json，中途失败时读者看到的是空面板
+    meta: Optional[Panel_meta] = imp_read_meta(table, root)
+    if meta is None:
+        return
+    os.remove(panel_path(table, 'meta.json', root))
+    imp_remove_generations(table, (), root)
+
+
+def imp_db_dates(table: Text, since: int = 0) -> np.ndarray:
+    days: Optional[pd.DataFrame] = td.imp_get_records_from_db(
+        f"SELECT DISTINCT trade_date FROM {table} WHERE trade_date >= ? ORDER BY trade_date", (str(since),))
+    return days['trade_date'].values.astype(np.int64) if days is not None and days.empty is False \
+        else np.array([], dtype=np.int64)
+
+
+def imp_read_rows(table: Text, fields: Tuple, days: np.ndarray) -> Iterator[pd.DataFrame]:
+    """ 从SQLite按交易日分批读取days中各交易日的数据，每批dates_per_read个交易日
+    """
+    step: int = panel_config().dates_per_read
+    for i in range(0, len(days), step):
+        batch: List[Text] = [str(d) for d in days[i:i + step]]
+        yield td.imp_get_records_from_db(
+            f"SELECT trade_date, ts_code, {', '.join(fields)} FROM {table} "
+            f"WHERE trade_date IN ({', '.join('?' * len(batch))})", tuple(batch))
+
+
+def imp_sync_panel(table: Text, since: Optional[int] = None, root: Optional[Text] = None) -> Optional[Panel_meta]:
+    """ 把SQLite中的数据同步到面板，since=0重建整个面板
+
+    since缺省时同步面板中还没有的交易日，包括补录到面板中间的日期；指定since时trade_date >= since的交易日全部
+    重新写入，已有的日期原地覆盖
+    """
+    fields: Tuple = tuple(panel_config().fields[table])
+    if since == 0:
+        imp_remove_panel(table, root)
+    db_dates: np.ndarray = imp_db_dates(table, since or 0)
+    days: np.ndarray = db_dates if since is not None else np.setdiff1d(db_dates, imp_dates(table, root))
+
+    meta: Optional[Panel_meta] = imp_read_meta(table, root)
+    for rows in imp_read_rows(table, fields, days):
+        if rows is not None and rows.empty is False:
+            meta = imp_write_rows(table, rows, fields, root)
+    return meta
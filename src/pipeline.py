@@ -0,0 +1,141 @@
+""" 分阶段的流式处理
+下载、清洗转换和写入各在自己的线程中运行，阶段之间用有界队列连接：写入慢时清洗阻塞在队列上，清洗慢时下载不再提交
+新的请求，内存中积压的数据不超过队列长度。每个阶段记录处理的条数、行数、忙碌时间和输入队列的深度，可以定期打印，
+看出瓶颈在网络还是磁盘。
+"""
+from typing import Any, Text, NamedTuple, Optional, Callable, Dict, List, Iterable
+from collections import namedtuple
+import threading
+import queue
+import time
+
+Pipeline_config: NamedTuple = namedtuple('Pipeline_config', 'queue_size, report_seconds')
+# func: 处理一条数据，返回None时不再向后传递; rows: 一条结果的行数，用于统计吞吐量
+Stage: NamedTuple = namedtuple('Stage', 'name, func, rows')
+
+END: object = object()
+
+
+def pipeline_config() -> Pipeline_config:
+    # queue_size: 阶段之间最多积压的条数; report_seconds: 定期打印各阶段统计的间隔，0为不打印
+    return Pipeline_config(queue_size=8, report_seconds=30)
+
+
+class Stage_stats:
+    """ 一个阶段的计数器，由本阶段的线程更新，其他线程读取快照
+    """
+    def __init__(self, name: Text, inbox: Optional[queue.Queue] = None) -> None:
+        self.name: Text = name
+        self.inbox: Optional[queue.Queue] = inbox
+        self.items: int = 0
+        self.rows: int = 0
+        self.errors: int = 0
+        self.busy_seconds: float = 0.0
+        self.max_depth: int = 0
+        self.started: float = time.time()
+        self.lock: threading.Lock = threading.Lock()
+
+    def record(self, rows: int, seconds: float, failed: bool = False) -> Any:
+        with self.lock:
+            self.items += 1
+            self.rows += rows
+            self.errors += int(failed)
+            self.busy_seconds += seconds
+
+    def observe_depth(self) -> Any:
+        if self.inbox is not None:
+            self.max_depth = max(self.max_depth, self.inbox.qsize())
+
+    def snapshot(self) -> Dict[Text, Any]:
+        with self.lock:
+            elapsed: float = max(time.time() - self.started, 1e-9)
+            return {'stage': self.name, 'items': self.items, 'rows': self.rows, 'errors': self.errors,
+                    'depth': self.inbox.qsize() if self.inbox is not None else 0, 'max_depth': self.max_depth,
+                    'rows_per_s': self.rows / elapsed, 'busy': self.busy_seconds / elapsed}
+
+
+def report_error(on_error: Optional[Callable[[Text, Any, Exception], Any]], name: Text, item: Any,
+                 e: Exception) -> Any:
+    # 记录失败本身出错时只打印，不能让阶段线程退出，否则下游收不到结束标记
+    if on_error is None:
+        return
+    try:
+        on_error(name, item, e)
+    except Exception as callback_error:
+        print(name, callback_error)
+
+
+def run_stage(stage: Stage, inbox: queue.Queue, outbox: Optional[queue.Queue], stats: Stage_stats,
+              on_error: Optional[Callable[[Text, Any, Exception], Any]] = None) -> Any:
+    while True:
+        stats.observe_depth()
+        item: Any = inbox.get()
+        if item is END:
+            break
+        start: float = time.time()
+        try:
+            rtn: Any = stage.func(item)
+            stats.record(stage.rows(rtn) if rtn is not None else 0, time.time() - start)
+        except Exception as e:
+            print(stage.name, e)
+            stats.record(0, time.time() - start, failed=True)
+            report_error(on_error, stage.name, item, e)
+            continue
+        if rtn is not None and outbox is not None:
+            outbox.put(rtn)
+    if outbox is not None:
+        outbox.put(END)
+
+
+def run_source(source: Iterable, rows: Callable[[Any], int], outbox: queue.Queue, stats: Stage_stats,
+               on_error: Optional[Callable[[Text, Any, Exception], Any]] = None) -> Any:
+    # 下载阶段：source通常是并发下载的生成器，队列满时put阻塞，生成器不再取下一个任务
+    try:
+        start: float = time.time()
+        for item in source:
+            stats.record(rows(item), time.time() - start)
+            outbox.put(item)
+            start = time.time()
+    except Exception as e:
+        # 生成器本身出错，剩下的任务都没有执行，item为None
+        print(stats.name, e)
+        stats.record(0, 0.0, failed=True)
+        report_error(on_error, stats.name, None, e)
+    finally:
+        outbox.put(END)
+
+
+def format_stats(snapshots: List[Dict[Text, Any]]) -> Text:
+    return '; '.join(f"{s['stage']}: {s['items']}条 {s['rows']}行 {s['rows_per_s']:.0f}行/秒 忙碌{s['busy']:.0%} "
+                     f"队列{s['depth']}/{s['max_depth']}" for s in snapshots)
+
+
+def imp_run_pipeline(source: Iterable, source_rows: Callable[[Any], int], stages: List[Stage],
+                     cfg: Optional[Pipeline_config] = None,
+                     report: Optional[Callable[[Text], Any]] = print,
+                     source_name: Text = 'fetch',
+                     on_error: Optional[Callable[[Text, Any, Exception], Any]] = None) -> List[Dict[Text, Any]]:
+    """ source的每一条数据依次经过stages，每个阶段一个线程；全部处理完后返回各阶段的统计
+
+    depth为阶段输入队列当前的长度，max_depth为运行中见到的最大长度；busy为阶段线程忙碌时间占运行时间的比例。
+    某一条数据在某个阶段出错时跳过这一条，调用on_error(阶段名, 数据, 错误)记录
+    """
+    cfg = cfg or pipeline_config()
+    queues: List[queue.Queue] = [queue.Queue(maxsize=cfg.queue_size) for _ in stages]
+    stats: List[Stage_stats] = [Stage_stats(source_name)] + [Stage_stats(s.name, q) for s, q in zip(stages, queues)]
+    threads: List[threading.Thread] = [threading.Thread(target=run_source, args=(source, source_rows, queues[0],
+                                                                                 stats[0], on_error),
+                                                        name=f'pipeline-{source_name}', daemon=True)]
+    threads += [threading.Thread(target=run_stage, args=(stage, queues[i], queues[i + 1] if i + 1 < len(stages)
+                                                         else None, stats[i + 1], on_error),
+                                 name=f'pipeline-{stage.name}', daemon=True) for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    while threads[-1].is_alive():
+        threads[-1].join(cfg.report_seconds or None)
+        if report is not None and cfg.report_seconds and threads[-1].is_alive():
+            report(format_stats([s.snapshot() for s in stats]))
+    snapshots: List[Dict[Text, Any]] = [s.snapshot() for s in stats]
+    if report is not None:
+        report(format_stats(snapshots))
+    return snapshots
@@ -0,0 +1,83 @@
+""" 财务报表的时点(point-in-time)索引
+保留同一报告期的各个公告版本，按“在日期D已经公告”的口径做向量化的as-of查询，一次得到(date × ts_code)的财务数据，
+不会用到D之后才公告的数据。
+"""
+from typing import Any, Text, NamedTuple, Optional, Dict, List, Sequence
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src import tushare_data as td
+
+# codes: 升序的股票代码; keys: 升序的code_id * KEY_BASE + 公告日期; frame: 与keys一一对应的报表版本
+Pit_index: NamedTuple = namedtuple('Pit_index', 'codes, keys, frame')
+
+KEY_BASE: int = 10 ** 8
+
+
+def build_pit_index(statements: pd.DataFrame) -> Pit_index:
+    """ statements至少包含ts_code、end_date和ann_date，有f_ann_date时以实际公告日期为准
+
+    公告日按报告期取累计最大值：某日之后新公告的是更早报告期的更正时，不替换已经公告的最新报告期；同一报告期的更正
+    公告后替换原来的版本
+    """
+    version: Text = td.statement_version_field(list(statements.columns))
+    known: pd.Series = pd.to_numeric(statements[version], errors='coerce')
+    if version == 'f_ann_date':
+        known = known.fillna(pd.to_numeric(statements['ann_date'], errors='coerce'))
+    df: pd.DataFrame = statements.assign(known_date=known, end_date=pd.to_numeric(statements['end_date'],
+                                                                                  errors='coerce'))
+    df = df[df['known_date'].notnull() & df['end_date'].notnull()]
+    df = df.astype({'known_date': np.int64, 'end_date': np.int64})
+    df = df.sort_values(['ts_code', 'known_date', 'end_date'], kind='mergesort').reset_index(drop=True)
+    df = df[df['end_date'] >= df.groupby('ts_code')['end_date'].cummax()].reset_index(drop=True)
+
+    codes: np.ndarray = np.unique(df['ts_code'].values.astype(str))
+    code_id: np.ndarray = np.searchsorted(codes, df['ts_code'].values.astype(str)).astype(np.int64)
+    return Pit_index(codes=codes, keys=code_id * KEY_BASE + df['known_date'].values, frame=df)
+
+
+def pit_positions(index: Pit_index, dates: Sequence, codes: Sequence[Text]) -> np.ndarray:
+    """ 返回(len(dates), len(codes))的版本位置矩阵，-1表示当日该股票还没有任何已公告的报表
+    """
+    query_codes: np.ndarray = np.asarray(codes, dtype=str)
+    code_id: np.ndarray = np.searchsorted(index.codes, query_codes)
+    known_code: np.ndarray = (code_id < len(index.codes)) & \
+        (index.codes[np.minimum(code_id, max(len(index.codes) - 1, 0))] == query_codes) \
+        if len(index.codes) > 0 else np.zeros(len(query_codes), dtype=bool)
+    grid: np.ndarray = code_id[None, :].astype(np.int64) * KEY_BASE + np.asarray(dates, dtype=np.int64)[:, None]
+    pos: np.ndarray = np.searchsorted(index.keys, grid, 'right') - 1
+    same_code: np.ndarray = (pos >= 0) & (index.keys[np.maximum(pos, 0)] // KEY_BASE == code_id[None, :]) \
+        if len(index.keys) > 0 else np.zeros(grid.shape, dtype=bool)
+    return np.where(same_code & known_code[None, :], pos, -1)
+
+
+def pit_as_of(index: Pit_index, dates: Sequence, fields: List[Text],
+              codes: Optional[Sequence[Text]] = None) -> Dict[Text, pd.DataFrame]:
+    """ 每个日期、每家公司在当日已公告的最新报告期的数据，每个字段一个(date × ts_code)的DataFrame
+
+    fields可以包含end_date和known_date，用来查看取到的是哪个报告期、哪天公告的版本
+    """
+    query_codes: Sequence[Text] = index.codes if codes is None else codes
+    query_dates: np.ndarray = np.asarray(dates, dtype=np.int64)
+    pos: np.ndarray = pit_positions(index, query_dates, query_codes)
+    found: np.ndarray = pos >= 0
+    rtn: Dict[Text, pd.DataFrame] = {}
+    for field in fields:
+        values: np.ndarray = index.frame[field].values
+        if values.dtype.kind in 'iub':
+            values = values.astype(np.float64)
+        picked: np.ndarray = values[np.maximum(pos, 0)] if len(values) > 0 \
+            else np.empty(pos.shape, dtype=values.dtype)
+        rtn[field] = pd.DataFrame(np.where(found, picked, np.nan if values.dtype.kind == 'f' else None),
+                                  index=query_dates, columns=query_codes)
+    return rtn
+
+
+def imp_build_pit_index(tbl_name: Text, fields: List[Text]) -> Pit_index:
+    sample: Optional[pd.DataFrame] = td.imp_get_records_from_db(f'SELECT * FROM {tbl_name} LIMIT 1')
+    version: Text = td.statement_version_field(list(sample.columns))
+    key_fields: List[Text] = ['ts_code', 'end_date', 'ann_date'] + (['f_ann_date'] if version == 'f_ann_date' else [])
+    columns: List[Text] = key_fields + [f for f in fields if f not in key_fields]
+    return build_pit_index(td.imp_get_records_from_db(f"SELECT {', '.join(columns)} FROM {tbl_name}"))
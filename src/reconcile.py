@@ -0,0 +1,289 @@
+""" 两个数据来源的逐表核对
+两边的表按主键顺序分批流式读取，每行按各字段的容差量化后求哈希，再按(ts_code, 年份)的固定分块把行哈希相加，得到每块的
+行数和哈希；块哈希再汇总为每只股票和整个表的哈希，形成三层的Merkle树，从根向下只比较不同的分支。内存占用只与分块数
+有关，不会把两边的数据都读进内存。上次核对过的块，两边的哈希都没有变化时不再逐行比较；哈希不同的块才按主键读出两边
+的行，按容差逐字段比较，差异和缺失的行写入核对日志表。
+"""
+from typing import Any, Text, NamedTuple, Optional, Dict, List, Tuple, Iterator, Iterable
+from collections import namedtuple
+import argparse
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import db_access as dba
+from src import schema as sc
+from src import tushare_data as td
+
+# tolerances: 各字段的绝对容差，未列出的数值字段取default_tolerance；文本和日期字段要求相同
+Reconcile_config: NamedTuple = namedtuple('Reconcile_config', 'db_path, tbl_log, tbl_block, chunk_rows, \
+                                           default_tolerance, tolerances')
+# 一个表在某个来源上的分块摘要：ts_code, year, n_rows, row_hash按(ts_code, year)排列
+Block_summary: NamedTuple = namedtuple('Block_summary', 'ts_code, year, n_rows, row_hash')
+
+NULL_VALUE: int = np.iinfo(np.int64).min
+
+
+def reconcile_config() -> Reconcile_config:
+    return Reconcile_config(db_path=os.path.join(dba.data_dir(), 'reconcile.db'), tbl_log='reconcile_log',
+                            tbl_block='reconcile_block', chunk_rows=200000, default_tolerance=1e-4,
+                            tolerances={'open': 0.005, 'high': 0.005, 'low': 0.005, 'close': 0.005,
+                                        'pre_close': 0.005, 'change': 0.005, 'pct_chg': 0.01, 'vol': 1.0,
+                                        'amount': 1.0, 'adj_factor': 1e-3})
+
+
+def tolerance(field: Text, cfg: Reconcile_config) -> float:
+    return cfg.tolerances.get(field, cfg.default_tolerance)
+
+
+def compare_columns(schema: sc.Table_schema, left_columns: List[Text], right_columns: List[Text]) -> List[Text]:
+    """ 两边都有的非主键列，另一个来源缺少的字段不比较
+    """
+    return [c for c in sc.column_names(schema)
+            if c not in schema.primary_key and c in left_columns and c in right_columns]
+
+
+def quantize(values: pd.Series, kind: Text, tol: float) -> np.ndarray:
+    """ 数值按容差取整，相差超过容差的两个值取整后一定不同；空值为NULL_VALUE
+    """
+    if kind == 'TEXT':
+        return values.fillna('').astype(str).values
+    numbers: np.ndarray = pd.to_numeric(values, errors='coerce').values.astype(np.float64)
+    if kind == 'REAL':
+        numbers = np.round(numbers / tol)
+    limit: float = float(np.iinfo(np.int64).max)
+    return np.where(np.isnan(numbers), NULL_VALUE, np.clip(np.nan_to_num(numbers), -limit, limit)).astype(np.int64)
+
+
+def row_hashes(chunk: pd.DataFrame, schema: sc.Table_schema, columns: List[Text],
+               cfg: Reconcile_config) -> np.ndarray:
+    kinds: Dict[Text, Text] = dict(schema.columns)
+    normalized: pd.DataFrame = pd.DataFrame({c: quantize(chunk[c], kinds[c], tolerance(c, cfg))
+                                             for c in list(schema.primary_key) + columns})
+    return pd.util.hash_pandas_object(normalized, index=False).values.astype(np.uint64)
+
+
+def block_sums(codes: np.ndarray, years: np.ndarray, hashes: np.ndarray) -> Block_summary:
+    """ codes、years已经按分块排列，相邻的同一块相加；uint64的加法按2^64取模，与行的顺序无关
+    """
+    if len(codes) == 0:
+        return Block_summary(np.array([], dtype=str), np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+                             np.array([], dtype=np.uint64))
+    starts: np.ndarray = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (years[1:] != years[:-1])])
+    return Block_summary(ts_code=codes[starts], year=years[starts],
+                         n_rows=np.diff(np.r_[starts, len(codes)]).astype(np.int64),
+                         row_hash=np.add.reduceat(hashes, starts).astype(np.uint64))
+
+
+def merge_summaries(parts: List[Block_summary]) -> Block_summary:
+    """ 分批的结果按顺序拼接，跨批的同一块再相加一次
+    """
+    if len(parts) == 0:
+        return block_sums(np.array([], dtype=str), np.array([], dtype=np.int64), np.array([], dtype=np.uint64))
+    joined: Block_summary = Block_summary(*[np.concatenate([getattr(p, f) for p in parts])
+                                            for f in Block_summary._fields])
+    merged: Block_summary = block_sums(joined.ts_code, joined.year, joined.row_hash)
+    starts: np.ndarray = np.flatnonzero(np.r_[True, (joined.ts_code[1:] != joined.ts_code[:-1]) |
+                                              (joined.year[1:] != joined.year[:-1])])
+    return merged._replace(n_rows=np.add.reduceat(joined.n_rows, starts))
+
+
+def block_digests(summary: Block_summary) -> np.ndarray:
+    """ Merkle树的叶子：块的位置、行数和行哈希一起求哈希
+    """
+    return pd.util.hash_pandas_object(pd.DataFrame(summary._asdict()), index=False).values.astype(np.uint64)
+
+
+def code_digests(summary: Block_summary) -> pd.Series:
+    """ Merkle树的中间层：每只股票各块摘要之和
+    """
+    digests: np.ndarray = block_digests(summary)
+    if len(digests) == 0:
+        return pd.Series([], dtype=object)
+    starts: np.ndarray = np.flatnonzero(np.r_[True, summary.ts_code[1:] != summary.ts_code[:-1]])
+    # 对齐两边时缺失的一边为NaN，用object保存，避免转成float64丢失哈希的低位
+    return pd.Series(np.add.reduceat(digests, starts).astype(object), index=summary.ts_code[starts])
+
+
+def root_digest(codes: pd.Series) -> int:
+    return int(np.add.reduce(codes.values.astype(np.uint64))) if len(codes) > 0 else 0
+
+
+def summary_frame(summary: Block_summary) -> pd.DataFrame:
+    # SQLite的INTEGER是有符号64位整数，哈希按位解释为int64
+    return pd.DataFrame({'n_rows': summary.n_rows.astype(object),
+                         'row_hash': summary.row_hash.view(np.int64).astype(object)},
+                        index=pd.MultiIndex.from_arrays([summary.ts_code, summary.year], names=['ts_code', 'year']))
+
+
+def changed_blocks(left: Block_summary, right: Block_summary) -> pd.DataFrame:
+    """ 从根向下比较：根相同则没有差异；否则只在哈希不同的股票中比较各块，返回两边不一致的块
+    """
+    left_codes: pd.Series = code_digests(left)
+    right_codes: pd.Series = code_digests(right)
+    columns: List[Text] = ['n_rows_l', 'row_hash_l', 'n_rows_r', 'row_hash_r']
+    if root_digest(left_codes) == root_digest(right_codes) and len(left_codes) == len(right_codes):
+        return pd.DataFrame(columns=columns)
+    codes: pd.DataFrame = pd.concat([left_codes.rename('l'), right_codes.rename('r')], axis=1)
+    differ: pd.Index = codes.index[(codes['l'] != codes['r']).values]
+    blocks: pd.DataFrame = summary_frame(left).join(summary_frame(right), how='outer', lsuffix='_l', rsuffix='_r')
+    blocks = blocks[blocks.index.get_level_values('ts_code').isin(differ)]
+    same: pd.Series = (blocks['n_rows_l'] == blocks['n_rows_r']) & (blocks['row_hash_l'] == blocks['row_hash_r'])
+    return blocks[~same.values][columns]
+
+
+def diff_rows(left: pd.DataFrame, right: pd.DataFrame, schema: sc.Table_schema, columns: List[Text],
+              cfg: Reconcile_config) -> List[Tuple]:
+    """ 逐行逐字段比较一块中两边的数据，返回(ts_code, row_key, field, kind, left_value, right_value)
+
+    kind: mismatch为字段差异超过容差，missing_left、missing_right为该行只在另一边有
+    """
+    key: List[Text] = list(schema.primary_key)
+    kinds: Dict[Text, Text] = dict(schema.columns)
+    merged: pd.DataFrame = left.merge(right, on=key, how='outer', suffixes=('_l', '_r'), indicator=True)
+    row_key: pd.Series = merged[key[1:]].astype(str).agg('|'.join, axis=1) if len(merged) > 0 \
+        else pd.Series([], dtype=str)
+    rtn: List[Tuple] = []
+    for side, kind in (('left_only', 'missing_right'), ('right_only', 'missing_left')):
+        for i in np.flatnonzero((merged['_merge'] == side).values):
+            rtn.append((merged['ts_code'].iat[i], row_key.iat[i], None, kind, None, None))
+    both: np.ndarray = (merged['_merge'] == 'both').values
+    for c in columns:
+        a: pd.Series = merged[f'{c}_l']
+        b: pd.Series = merged[f'{c}_r']
+        if kinds[c] == 'REAL':
+            x: pd.Series = pd.to_numeric(a, errors='coerce')
+            y: pd.Series = pd.to_numeric(b, errors='coerce')
+            bad: np.ndarray = ((x.isnull() != y.isnull()) | ((x - y).abs() > tolerance(c, cfg))).values
+        else:
+            bad = (a.fillna('').astype(str) != b.fillna('').astype(str)).values
+        for i in np.flatnonzero(bad & both):
+            rtn.append((merged['ts_code'].iat[i], row_key.iat[i], c, 'mismatch',
+                        None if pd.isnull(a.iat[i]) else str(a.iat[i]), None if pd.isnull(b.iat[i]) else str(b.iat[i])))
+    return rtn
+
+
+def imp_table_columns(db_path: Text, tbl_name: Text) -> List[Text]:
+    return [row[1] for row in dba.imp_db(db_path).execute(f'PRAGMA table_info({tbl_name})')]
+
+
+def imp_iter_sorted(db_path: Text, schema: sc.Table_schema, columns: List[Text],
+                    cfg: Reconcile_config) -> Iterator[pd.DataFrame]:
+    key: List[Text] = list(schema.primary_key)
+    # 来源中可能有无类型的旧表，各批都按object读取，由quantize统一转换
+    yield from dba.imp_db(db_path).iter_frames(f"SELECT {', '.join(key + columns)} FROM {schema.name} "
+                                               f"ORDER BY {', '.join(key)}", chunk_rows=cfg.chunk_rows,
+                                               dtypes={c: object for c in key + columns})
+
+
+def imp_block_summary(db_path: Text, schema: sc.Table_schema, columns: List[Text],
+                      cfg: Reconcile_config) -> Block_summary:
+    """ 流式计算一个来源上的分块摘要，分块为(ts_code, 主键中日期的年份)
+    """
+    parts: List[Block_summary] = []
+    for chunk in imp_iter_sorted(db_path, schema, columns, cfg):
+        years: np.ndarray = pd.to_numeric(chunk[schema.primary_key[1]], errors='coerce').fillna(0).values\
+            .astype(np.int64) // 10000
+        parts.append(block_sums(chunk['ts_code'].values.astype(str), years, row_hashes(chunk, schema, columns, cfg)))
+    return merge_summaries(parts)
+
+
+def imp_block_rows(db_path: Text, schema: sc.Table_schema, columns: List[Text], ts_code: Text,
+                   year: int) -> pd.DataFrame:
+    date: Text = schema.primary_key[1]
+    # 没有声明类型的列中日期是文本，文本总是大于整数，直接与整数比较选不出任何行
+    rows: pd.DataFrame = dba.imp_db(db_path).read_frame(
+        f"SELECT {', '.join(list(schema.primary_key) + columns)} FROM {schema.name} WHERE ts_code=? "
+        f"AND CAST({date} AS INTEGER) BETWEEN ? AND ?", (ts_code, year * 10000, year * 10000 + 9999))
+    # 两个来源的日期可能一边是整数一边是文本，主键统一为整数后再对齐
+    for name, kind in schema.columns:
+        if name in schema.primary_key and kind == 'INTEGER':
+            rows[name] = pd.to_numeric(rows[name], errors='coerce').fillna(0).astype(np.int64)
+    return rows
+
+
+def imp_create_tables(cfg: Reconcile_config) -> Any:
+    access: dba.Db_access = dba.imp_db(cfg.db_path)
+    access.write(f'''CREATE TABLE IF NOT EXISTS {cfg.tbl_block} (pair TEXT, tbl_name TEXT, ts_code TEXT,
+                     year INTEGER, left_rows INTEGER, left_hash INTEGER, right_rows INTEGER, right_hash INTEGER,
+                     checked_at TEXT, PRIMARY KEY (pair, tbl_name, ts_code, year)) WITHOUT ROWID''', wait=True)
+    access.write(f'''CREATE TABLE IF NOT EXISTS {cfg.tbl_log} (pair TEXT, tbl_name TEXT, ts_code TEXT, year INTEGER,
+                     row_key TEXT, field TEXT, kind TEXT, left_value TEXT, right_value TEXT, logged_at TEXT)''',
+                 wait=True)
+    access.write(f'CREATE INDEX IF NOT EXISTS idx_{cfg.tbl_log}_block ON {cfg.tbl_log} (pair, tbl_name, ts_code, year)',
+                 wait=True)
+
+
+def block_state(values: Iterable) -> Tuple:
+    # (左边行数, 左边哈希, 右边行数, 右边哈希)，一边没有这一块时为None
+    return tuple(None if pd.isnull(v) else int(v) for v in values)
+
+
+def imp_reconcile_table(tbl_name: Text, left_db: Text, right_db: Text,
+                        cfg: Optional[Reconcile_config] = None) -> Dict[Text, int]:
+    """ 核对两个数据库中的同名表，返回分块数、不一致的块数、本次逐行比较的块数和写入日志的行数
+    """
+    cfg = cfg or reconcile_config()
+    imp_create_tables(cfg)
+    schema: sc.Table_schema = td.schemas()[tbl_name]
+    columns: List[Text] = compare_columns(schema, imp_table_columns(left_db, tbl_name),
+                                          imp_table_columns(right_db, tbl_name))
+    left: Block_summary = imp_block_summary(left_db, schema, columns, cfg)
+    right: Block_summary = imp_block_summary(right_db, schema, columns, cfg)
+    changed: pd.DataFrame = changed_blocks(left, right)
+
+    pair: Text = f'{os.path.abspath(left_db)} <> {os.path.abspath(right_db)}'
+    access: dba.Db_access = dba.imp_db(cfg.db_path)
+    # 直接取行元组，有NULL的整数列转成DataFrame时会变成float64，丢失哈希的低位
+    checked: List[Tuple] = access.execute(f'SELECT ts_code, year, left_rows, left_hash, right_rows, right_hash \
+                                          FROM {cfg.tbl_block} WHERE pair=? AND tbl_name=?', (pair, tbl_name))
+    previous: Dict[Tuple, Tuple] = {(r[0], int(r[1])): block_state(r[2:]) for r in checked}
+    now: Text = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    block_rows: List[Tuple] = []
+    log_rows: List[Tuple] = []
+    diffed: int = 0
+    for (ts_code, year), r in changed.iterrows():
+        state: Tuple = block_state(r.values)
+        block_rows.append((pair, tbl_name, ts_code, int(year), *state, now))
+        if previous.pop((ts_code, int(year)), None) == state:
+            continue
+        # 块的内容有变化，重新比较并替换这一块以前的日志
+        diffed += 1
+        differences: List[Tuple] = diff_rows(imp_block_rows(left_db, schema, columns, ts_code, int(year)),
+                                             imp_block_rows(right_db, schema, columns, ts_code, int(year)),
+                                             schema, columns, cfg)
+        access.write(f'DELETE FROM {cfg.tbl_log} WHERE pair=? AND tbl_name=? AND ts_code=? AND year=?',
+                     (pair, tbl_name, ts_code, int(year)))
+        log_rows.extend((pair, tbl_name, code, int(year), key, field, kind, a, b, now)
+                        for code, key, field, kind, a, b in differences)
+
+    # 以前不一致、这次已经一致的块，删除其状态和日志
+    for ts_code, year in previous:
+        access.write(f'DELETE FROM {cfg.tbl_log} WHERE pair=? AND tbl_name=? AND ts_code=? AND year=?',
+                     (pair, tbl_name, ts_code, year))
+    access.write_many(f'DELETE FROM {cfg.tbl_block} WHERE pair=? AND tbl_name=? AND ts_code=? AND year=?',
+                      [(pair, tbl_name, ts_code, year) for ts_code, year in previous])
+    access.write_many(f'INSERT OR REPLACE INTO {cfg.tbl_block} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', block_rows)
+    access.write_many(f'INSERT INTO {cfg.tbl_log} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', log_rows)
+    access.flush()
+    return {'blocks': len(left.ts_code), 'changed_blocks': len(changed), 'diffed_blocks': diffed,
+            'logged_rows': len(log_rows)}
+
+
+def imp_get_reconcile_log(tbl_name: Optional[Text] = None, cfg: Optional[Reconcile_config] = None) -> pd.DataFrame:
+    cfg = cfg or reconcile_config()
+    imp_create_tables(cfg)
+    return dba.imp_db(cfg.db_path).read_frame(f"SELECT * FROM {cfg.tbl_log} {'WHERE tbl_name=?' if tbl_name else ''}",
+                                              (tbl_name,) if tbl_name else ())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='与另一个来源的数据库逐表核对')
+    parser.add_argument('other_db')
+    parser.add_argument('--tables', nargs='+', default=[td.db_config().tbl_daily_trading_data,
+                                                        td.db_config().tbl_daily_basic])
+    args = parser.parse_args()
+    for tbl in args.tables:
+        print(tbl, imp_reconcile_table(tbl, td.db_config().db_path, args.other_db))
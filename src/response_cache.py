@@ -0,0 +1,145 @@
+""" tushare接口返回数据的本地缓存
+以接口名和参数的哈希为键，把返回的DataFrame按列压缩保存在磁盘上。每个接口有各自的有效期，缓存总大小超过上限时淘汰
+最久未使用的条目。离线回放模式（环境变量AQF_TUSHARE_OFFLINE=1）只读缓存、不访问网络，重跑研究不消耗访问配额，
+测试和基准测试也可以用它代替tushare。
+"""
+from typing import Any, Text, NamedTuple, Optional, Callable, Dict, List
+from collections import namedtuple
+from functools import lru_cache
+import hashlib
+import json
+import os
+import pickle
+import time
+import zlib
+
+import pandas as pd
+import tushare as ts
+
+from src import config
+from src import db_access as dba
+
+Cache_config: NamedTuple = namedtuple('Cache_config', 'root, max_bytes, offline, default_ttl, ttl, empty_ttl')
+
+
+def cache_config() -> Cache_config:
+    # ttl: 各接口缓存的有效秒数，None表示永不过期; empty_ttl: 空结果的有效秒数，数据可能尚未发布，不能按接口的有效期缓存
+    return Cache_config(root=os.path.join(dba.data_dir(), 'tushare_cache'), max_bytes=2 * 1024 ** 3,
+                        offline=os.environ.get('AQF_TUSHARE_OFFLINE', '0') == '1',
+                        default_ttl=24 * 3600,
+                        ttl={'trade_cal': 24 * 3600,
+                             'stock_basic': 24 * 3600,
+                             'namechange': 7 * 24 * 3600,
+                             'index_dailybasic': 30 * 24 * 3600},
+                        empty_ttl=3600)
+
+
+def cache_key(endpoint: Text, params: Dict) -> Text:
+    return hashlib.sha1(json.dumps([endpoint, sorted(params.items())], default=str, ensure_ascii=False)
+                        .encode('utf-8')).hexdigest()
+
+
+def blob_path(key: Text, root: Text) -> Text:
+    return os.path.join(root, key[:2], f'{key}.bin')
+
+
+def encode_frame(df: pd.DataFrame) -> bytes:
+    columns: List[Text] = [str(c) for c in df.columns]
+    return zlib.compress(pickle.dumps({'columns': columns, 'data': [df[c].values for c in df.columns]},
+                                      protocol=pickle.HIGHEST_PROTOCOL), 6)
+
+
+def decode_frame(blob: bytes) -> pd.DataFrame:
+    payload: Dict = pickle.loads(zlib.decompress(blob))
+    return pd.DataFrame(dict(zip(payload['columns'], payload['data'])), columns=payload['columns'])
+
+
+def is_fresh(endpoint: Text, created: float, now: float, cfg: Cache_config, empty: bool = False) -> bool:
+    ttl: Optional[float] = cfg.empty_ttl if empty else cfg.ttl.get(endpoint, cfg.default_ttl)
+    return ttl is None or now - created <= ttl
+
+
+def imp_index(cfg: Cache_config) -> dba.Db_access:
+    return imp_open_index(cfg.root)
+
+
+@lru_cache(16)
+def imp_open_index(root: Text) -> dba.Db_access:
+    os.makedirs(root, exist_ok=True)
+    access: dba.Db_access = dba.imp_db(os.path.join(root, 'index.db'))
+    access.write('''CREATE TABLE IF NOT EXISTS cache_entry (key TEXT PRIMARY KEY, endpoint TEXT, params TEXT,
+                    created REAL, accessed REAL, size INTEGER, empty INTEGER DEFAULT 0)''', wait=True)
+    if 'empty' not in [row[1] for row in access.execute('PRAGMA table_info(cache_entry)')]:
+        # 早先建立的索引没有empty列
+        access.write('ALTER TABLE cache_entry ADD COLUMN empty INTEGER DEFAULT 0', wait=True)
+    return access
+
+
+def imp_lookup(endpoint: Text, params: Dict, cfg: Optional[Cache_config] = None) -> Optional[pd.DataFrame]:
+    """ 缓存中有未过期的条目时返回DataFrame；离线模式下忽略有效期
+    """
+    cfg = cfg or cache_config()
+    index: dba.Db_access = imp_index(cfg)
+    key: Text = cache_key(endpoint, params)
+    found: List = index.execute('SELECT created, empty FROM cache_entry WHERE key=?', (key,))
+    now: float = time.time()
+    if len(found) == 0 or (cfg.offline is False and is_fresh(endpoint, found[0][0], now, cfg,
+                                                            bool(found[0][1])) is False):
+        return None
+    try:
+        with open(blob_path(key, cfg.root), 'rb') as f:
+            df: pd.DataFrame = decode_frame(f.read())
+    except (OSError, zlib.error, pickle.UnpicklingError):
+        return None
+    index.write('UPDATE cache_entry SET accessed=? WHERE key=?', (now, key))
+    return df
+
+
+def imp_record(endpoint: Text, params: Dict, df: pd.DataFrame, cfg: Optional[Cache_config] = None) -> Any:
+    cfg = cfg or cache_config()
+    index: dba.Db_access = imp_index(cfg)
+    key: Text = cache_key(endpoint, params)
+    blob: bytes = encode_frame(df)
+    path: Text = blob_path(key, cfg.root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(blob)
+    os.replace(path + '.tmp', path)
+    now: float = time.time()
+    index.write('INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, endpoint, json.dumps(params, default=str, ensure_ascii=False), now, now, len(blob),
+                 int(len(df) == 0)), wait=True)
+    imp_evict(cfg)
+
+
+def imp_evict(cfg: Optional[Cache_config] = None) -> Any:
+    # 先删索引中的条目再删文件，查到的条目一定有文件
+    cfg = cfg or cache_config()
+    for key in dba.imp_evict_lru(imp_index(cfg), 'cache_entry', cfg.max_bytes):
+        try:
+            os.remove(blob_path(key, cfg.root))
+        except OSError:
+            pass
+
+
+def imp_cached_call(endpoint: Text, fetch: Callable[..., pd.DataFrame], params: Dict,
+                    cfg: Optional[Cache_config] = None) -> pd.DataFrame:
+    cfg = cfg or cache_config()
+    df: Optional[pd.DataFrame] = imp_lookup(endpoint, params, cfg)
+    if df is not None:
+        return df
+    if cfg.offline is True:
+        raise LookupError(f'离线回放模式下缓存中没有{endpoint}{params}')
+    df = fetch(**params)
+    # None表示请求出错，不记录；空结果按empty_ttl记录，离线回放时仍能命中
+    if df is not None:
+        imp_record(endpoint, params, df, cfg)
+    return df
+
+
+def cached_pro_api(endpoint: Text, cfg: Optional[Cache_config] = None) -> Callable[..., pd.DataFrame]:
+    """ 与ts.pro_api().<endpoint>用法相同，返回数据先查缓存
+    """
+    return lambda **params: imp_cached_call(endpoint,
+                                            lambda **p: getattr(ts.pro_api(config.tushare_token), endpoint)(**p),
+                                            params, cfg)
@@ -1,44 +1,64 @@
 """ 构建用于因子研究的股票样本数据池
 """
-from typing import NamedTuple, Iterator, Text, Tuple, Callable, List, Dict, Optional, Set
+from typing import NamedTuple, Iterator, Text, Tuple, Callable, List, Dict, Optional, Set, Union
 from collections import namedtuple
 from functools import partial, lru_cache, reduce
 import datetime
 
+import numpy as np
 import pandas as pd
 import tushare as ts
 
 from src import tushare_data as td
 from src import config
+from src import response_cache as rc
+from src import sample_cache as scache
+from src import security_master as sm
 
 Samples = Iterator[NamedTuple]  # 某一日的样本股集合
 Sample_pool = Iterator[Samples]  # 样本池
 
-Sample_config: NamedTuple = namedtuple('sample_config', 'start_date, end_date, updated_date1, updated_date2, \
-                                        base_index, low_market_to_base_index')
-Samples_info: NamedTuple = namedtuple('sample_info', 'date, mean_mv, median_mv, min_mv, count')
+Sample_config: NamedTuple = namedtuple('Sample_config', 'start_date, end_date, updated_date1, updated_date2, \
+                                        base_index, low_market_to_base_index, list_years')
+Samples_info: NamedTuple = namedtuple('Samples_info', 'date, mean_mv, median_mv, min_mv, count')
+
+# 指数每个交易日一行，每段1500个自然日约1000个交易日，低于index_dailybasic单次返回的行数上限
+INDEX_MV_ROWS_PER_CALL: int = 3000
+INDEX_MV_DAYS_PER_CALL: int = 1500
 
 
 def sample_config() -> Sample_config:
+    # low_market_to_base_index: 市值下限相对沪深300成分股平均市值的比例; list_years: 上市满几年
     return Sample_config(start_date='20050430', end_date='20190430', updated_date1='0430', updated_date2='1031',
-                         base_index='399300.SZ', low_market_to_base_index=0.05)
+                         base_index='399300.SZ', low_market_to_base_index=1 / 50, list_years=2)
+
+
+def low_market_value_limit(index_total_mv: Union[float, pd.Series],
+                           cfg: Optional[Sample_config] = None) -> Union[float, pd.Series]:
+    """ 市值下限(万元)：基准指数总市值(元)/300为成分股的平均总市值，再乘以low_market_to_base_index；
+    index_total_mv可以是一个数或按日期排列的pd.Series
+    """
+    cfg = cfg or sample_config()
+    return index_total_mv / 300 * cfg.low_market_to_base_index / 10000
 
 
-def filter_updated_date(trade_cal_iter: Iterator[Tuple[Text, Text]]) -> Iterator[Text]:
-    test_updated_date: Callable[[Text], bool] = lambda d: d.find(sample_config().updated_date1) == 4 \
-                                                          or d.find(sample_config().updated_date2) == 4
+def filter_updated_date(trade_cal_iter: Iterator[Tuple[Text, Text]],
+                        cfg: Optional[Sample_config] = None) -> Iterator[Text]:
+    cfg = cfg or sample_config()
+    test_updated_date: Callable[[Text], bool] = lambda d: d.find(cfg.updated_date1) == 4 \
+                                                          or d.find(cfg.updated_date2) == 4
     for exchange, cal_date, is_open in trade_cal_iter:
         if test_updated_date(cal_date) is True:
             if is_open == 1:
-                test_updated_date = lambda d: d.find(sample_config().updated_date1) == 4 \
-                                              or d.find(sample_config().updated_date2) == 4
+                test_updated_date = lambda d: d.find(cfg.updated_date1) == 4 \
+                                              or d.find(cfg.updated_date2) == 4
                 yield cal_date
             else:
                 test_updated_date = lambda d: True if is_open == 1 else False
 
 
 def impf_get_tradable_securities(trade_date: Text) -> Samples:
-    return td.imp_get_records_from_db(f"SELECT * FROM daily_trading_data WHERE trade_date='{trade_date}'")
+    return td.imp_get_records_from_db("SELECT * FROM daily_trading_data WHERE trade_date=?", (trade_date,))
 
 
 def securities_can_be_bought(sample_it: Samples) -> Samples:
@@ -86,7 +106,7 @@ def market_value_exceeds_low_limit(updated_it: Samples,
                                                                 and trade_date='{trade_date}'")
         return next(daily_basic_iter).total_mv
 
-    return filter(lambda r: index_market_value(r.trade_date) * sample_config().low_market_to_base_index <
+    return filter(lambda r: low_market_value_limit(index_market_value(r.trade_date)) <
                             stock_market_value(r.ts_code, r.trade_date),
                   (list_it for list_it in updated_it))
 
@@ -97,35 +117,25 @@ def impf_get_tradable_securities_by_tushare(trade_date: Text) -> pd.Series:
 
 
 def impf_get_non_st_securities_by_tushare_cache(trade_date: Text) -> pd.DataFrame:
-    df: pd.DataFrame = td.imp_get_records_from_db(f"select * from name_history where start_date <= '{trade_date}' \
-                                                    and (end_date is null or '{trade_date}' <= end_date)")
-    df2 = df[df['name'].apply(lambda c: c.find('ST') < 0)]
-    return df2
+    master: sm.Security_master = sm.imp_security_master()
+    covered, is_st = sm.name_status(master, np.arange(len(master.codes)), int(trade_date))
+    return pd.DataFrame({'ts_code': master.codes[covered & ~is_st]})
 
 
 def impf_get_companies_listed_for_many_years_by_tushare(trade_date: Text) -> pd.DataFrame:
-    def is_over_years(listed_date: Text) -> bool:
-        delta: datetime.timedelta = datetime.datetime.strptime(trade_date, "%Y%m%d") \
-                                    - datetime.datetime.strptime(listed_date, "%Y%m%d")
-        return delta.days > 365 * 2
-
-    def is_still_list(delist_date: Text) -> bool:
-        return delist_date is None or trade_date < delist_date
-
-    df: pd.DataFrame = td.download_list_companies()
-    df2 = df[df['list_date'].map(is_over_years)]
-    df3 = df2[df2['delist_date'].map(is_still_list)]
-    return df3
+    master: sm.Security_master = sm.imp_security_master()
+    listed: np.ndarray = sm.listed_over_years(master, np.arange(len(master.codes)), int(trade_date),
+                                              sample_config().list_years)
+    return pd.DataFrame({'ts_code': master.codes[listed]})
 
 
 def impf_exclude_small_market_value_companies_by_tushare_cache(trade_date: Text) -> pd.DataFrame:
     # index_market_value: float = td.imp_get_records_from_db(f"SELECT total_mv FROM securities_index \
     #                                                         WHERE ts_code='399300.SZ' and trade_date='{trade_date}'")
-    index_market_value: float = ts.pro_api(config.tushare_token).index_dailybasic(trade_date=trade_date,
-                                                                                  ts_code='399300.SZ').iloc[0][
-        'total_mv']
-    df: pd.DataFrame = td.imp_get_records_from_db(f"SELECT * FROM daily_basic WHERE trade_date='{trade_date}'")
-    low_limit: float = index_market_value / (300 * 50 * 10000)
+    index_market_value: float = rc.cached_pro_api('index_dailybasic')(trade_date=trade_date,
+                                                                      ts_code='399300.SZ').iloc[0]['total_mv']
+    df: pd.DataFrame = td.imp_get_records_from_db("SELECT * FROM daily_basic WHERE trade_date=?", (trade_date,))
+    low_limit: float = low_market_value_limit(index_market_value)
     return df[df['total_mv'] >= low_limit]
 
 
@@ -158,11 +168,212 @@ impf_build_samples_by_tushare = partial(build_samples,
                                         impf_exclude_small_market_value_companies_by_tushare_cache)
 
 
+FILTER_KINDS: Tuple = ('tradable', 'listed', 'non_st', 'market_value')
+
+
+def sample_filters(trade_dates: List[Text],
+                   get_security_master: Callable[[], sm.Security_master],
+                   get_daily_trading: Callable[[List[Text]], pd.DataFrame],
+                   get_daily_basic: Callable[[List[Text]], pd.DataFrame],
+                   get_index_total_mv: Callable[[List[Text]], pd.Series],
+                   cfg: Optional[Sample_config] = None,
+                   kinds: Tuple = FILTER_KINDS) -> Dict[Text, Dict[Text, object]]:
+    """ 一次计算所有调仓日的各项样本条件，只计算kinds中列出的条件；上市年限和ST按证券主表的编号查找
+
+    get_daily_trading、get_daily_basic一次返回所有调仓日的trade_date、ts_code、pct_chg和trade_date、ts_code、total_mv；
+    get_index_total_mv返回以整数日期为索引的基准指数总市值(元)。返回{调仓日: {条件: 结果}}，tradable、listed、non_st
+    为满足条件的股票集合，market_value为市值不低于下限的股票的总市值(pd.Series，以ts_code为索引)
+    """
+    dates: List[Text] = list(trade_dates)
+    rows: pd.DataFrame = get_daily_trading(dates)[['trade_date', 'ts_code', 'pct_chg']]
+    rows = rows.assign(date=rows['trade_date'].astype(np.int64))
+    basic: pd.DataFrame = get_daily_basic(dates)[['trade_date', 'ts_code', 'total_mv']]
+    rows = rows.merge(basic.assign(date=basic['trade_date'].astype(np.int64))[['date', 'ts_code', 'total_mv']],
+                      on=['date', 'ts_code'], how='inner')
+    cfg = cfg or sample_config()
+    masks: Dict[Text, np.ndarray] = {}
+    if 'listed' in kinds or 'non_st' in kinds:
+        master: sm.Security_master = get_security_master()
+        ids: np.ndarray = sm.code_ids(master, rows['ts_code'].values)
+
+    if 'tradable' in kinds:
+        # 当日可正常交易：停牌的股票没有日交易数据，涨停的股票买不进
+        masks['tradable'] = (pd.to_numeric(rows['pct_chg'], errors='coerce') < 9.6).values
+
+    if 'listed' in kinds:
+        masks['listed'] = sm.listed_over_years(master, ids, rows['date'].values, cfg.list_years)
+
+    if 'non_st' in kinds:
+        covered, is_st = sm.name_status(master, ids, rows['date'].values)
+        masks['non_st'] = covered & ~is_st
+
+    if 'market_value' in kinds:
+        index_mv: pd.Series = get_index_total_mv(dates)
+        low_limit: pd.Series = low_market_value_limit(rows['date'].map(index_mv), cfg)
+        masks['market_value'] = (pd.to_numeric(rows['total_mv'], errors='coerce') >= low_limit).values
+
+    rtn: Dict[Text, Dict[Text, object]] = {d: {} for d in dates}
+    for kind, mask in masks.items():
+        picked: pd.DataFrame = rows[mask]
+        if kind == 'market_value':
+            groups: Dict = {date: pd.Series(pd.to_numeric(g['total_mv']).values, index=g['ts_code'].values)
+                            for date, g in picked.groupby('date')}
+            for d in dates:
+                rtn[d][kind] = groups.get(int(d), pd.Series([], dtype=np.float64))
+        else:
+            groups = picked.groupby('date')['ts_code'].apply(set).to_dict()
+            for d in dates:
+                rtn[d][kind] = groups.get(int(d), set())
+    return rtn
+
+
+def combine_filters(trade_date: Text, filters: Dict[Text, object]) -> Tuple[Samples_info, Set]:
+    """ 各项条件的交集即当日样本，与build_samples的规则相同
+    """
+    market_value: pd.Series = filters['market_value']
+    samples: Set = filters['tradable'] & filters['listed'] & filters['non_st'] & set(market_value.index)
+    mv: pd.Series = market_value[market_value.index.isin(samples)]
+    if len(mv) == 0:
+        return Samples_info(date=trade_date, mean_mv=np.nan, median_mv=np.nan, min_mv=np.nan, count=0), samples
+    return Samples_info(date=trade_date, mean_mv=mv.mean(), median_mv=mv.median(), min_mv=mv.min(), count=len(mv)), \
+        samples
+
+
+def build_sample_pool(trade_dates: List[Text],
+                      get_security_master: Callable[[], sm.Security_master],
+                      get_daily_trading: Callable[[List[Text]], pd.DataFrame],
+                      get_daily_basic: Callable[[List[Text]], pd.DataFrame],
+                      get_index_total_mv: Callable[[List[Text]], pd.Series],
+                      cfg: Optional[Sample_config] = None) -> Dict[Text, Tuple[Samples_info, Set]]:
+    """ 一次构建所有调仓日的样本，与build_samples逐日构建的规则相同，上市年限和市值下限取自cfg，参数见sample_filters
+    """
+    filters: Dict[Text, Dict[Text, object]] = sample_filters(trade_dates, get_security_master, get_daily_trading,
+                                                             get_daily_basic, get_index_total_mv, cfg)
+    return {d: combine_filters(d, f) for d, f in filters.items()}
+
+
+def imp_get_rows_on_dates(tbl_name: Text, fields: Text, dates: List[Text]) -> pd.DataFrame:
+    return td.imp_get_records_from_db(f"SELECT trade_date, ts_code, {fields} FROM {tbl_name} \
+                                        WHERE trade_date IN ({','.join('?' * len(dates))})", tuple(dates))
+
+
+def date_chunks(start: Text, end: Text, days: int) -> List[Tuple[Text, Text]]:
+    """ 把[start, end]切成每段不超过days个自然日的区间
+    """
+    lo: datetime.date = datetime.datetime.strptime(start, '%Y%m%d').date()
+    hi: datetime.date = datetime.datetime.strptime(end, '%Y%m%d').date()
+    rtn: List[Tuple[Text, Text]] = []
+    while lo <= hi:
+        stop: datetime.date = min(lo + datetime.timedelta(days=days - 1), hi)
+        rtn.append((lo.strftime('%Y%m%d'), stop.strftime('%Y%m%d')))
+        lo = stop + datetime.timedelta(days=1)
+    return rtn
+
+
+def imp_get_index_total_mv_by_tushare(dates: List[Text]) -> pd.Series:
+    """ 基准指数在dates范围内的每日总市值，以整数日期为索引
+
+    index_dailybasic单次最多返回INDEX_MV_ROWS_PER_CALL行，多年的区间一次请求会被截断，按日期分段请求；分段结果中
+    仍缺少的dates再逐日补取
+    """
+    api: Callable[..., pd.DataFrame] = rc.cached_pro_api('index_dailybasic')
+    base_index: Text = sample_config().base_index
+    frames: List[pd.DataFrame] = [api(ts_code=base_index, start_date=lo, end_date=hi)
+                                  for lo, hi in date_chunks(min(dates), max(dates), INDEX_MV_DAYS_PER_CALL)]
+    got: Set[int] = {int(d) for df in frames if df is not None for d in df['trade_date']}
+    frames += [api(ts_code=base_index, trade_date=d) for d in dates if int(d) not in got]
+    df: pd.DataFrame = pd.concat([f for f in frames if f is not None and f.empty is False] +
+                                 [pd.DataFrame(columns=['trade_date', 'total_mv'])], ignore_index=True)
+    df = df.assign(trade_date=df['trade_date'].astype(np.int64)).drop_duplicates('trade_date').sort_values('trade_date')
+    return pd.Series(df['total_mv'].values.astype(np.float64), index=df['trade_date'].values)
+
+
+db_pool_getters: Dict[Text, Callable] = dict(
+    get_security_master=sm.imp_security_master,
+    get_daily_trading=partial(imp_get_rows_on_dates, td.db_config().tbl_daily_trading_data, 'pct_chg'),
+    get_daily_basic=partial(imp_get_rows_on_dates, td.db_config().tbl_daily_basic, 'total_mv'),
+    get_index_total_mv=imp_get_index_total_mv_by_tushare)
+
+impf_build_sample_pool = partial(build_sample_pool, **db_pool_getters)
+impf_sample_filters = partial(sample_filters, **db_pool_getters)
+
+
+def imp_data_stamps(dates: List[Text], index_mv: pd.Series) -> Dict[Text, object]:
+    """ 源数据的版本戳：日交易数据和每日指标为每个交易日的行数和字段合计，名称变更为全表的行数和日期合计，
+    股票列表为内容哈希，基准指数为当日总市值。日表是WITHOUT ROWID表，没有rowid可用；这些聚合走覆盖索引，不读整行
+    """
+    in_dates: Text = ','.join('?' * len(dates))
+    daily: pd.DataFrame = td.imp_get_records_from_db(f"SELECT trade_date, COUNT(*) AS n, TOTAL(pct_chg) AS s FROM \
+        {td.db_config().tbl_daily_trading_data} WHERE trade_date IN ({in_dates}) GROUP BY trade_date", tuple(dates))
+    basic: pd.DataFrame = td.imp_get_records_from_db(f"SELECT trade_date, COUNT(*) AS n, TOTAL(total_mv) AS s FROM \
+        {td.db_config().tbl_daily_basic} WHERE trade_date IN ({in_dates}) GROUP BY trade_date", tuple(dates))
+    names: pd.DataFrame = td.imp_get_records_from_db(f"SELECT COUNT(*) AS n, TOTAL(start_date) AS s, \
+        TOTAL(end_date) AS e, MAX(ann_date) AS a FROM {td.db_config().tbl_name_history}")
+    per_date: Callable[[pd.DataFrame], Dict] = lambda df: {int(r[0]): (int(r[1]), round(float(r[2]), 4))
+                                                          for r in df.itertuples(index=False)}
+    return {'daily': per_date(daily), 'basic': per_date(basic),
+            'name_history': [None if pd.isnull(v) else float(v) for v in names.iloc[0]],
+            'companies': int(pd.util.hash_pandas_object(td.download_list_companies(), index=False).sum()),
+            'index_mv': {int(k): float(v) for k, v in index_mv.items()}}
+
+
+def filter_keys(trade_date: Text, cfg: Sample_config, stamps: Dict[Text, object]) -> Dict[Text, Text]:
+    """ 每项条件只用到它所依赖的参数和源数据的版本戳，改变其他参数时仍能命中；样本池的键由各项条件的键组成
+    """
+    d: int = int(trade_date)
+    rows: List = [stamps['daily'].get(d), stamps['basic'].get(d)]
+    keys: Dict[Text, Text] = {
+        'tradable': scache.cache_key('tradable', trade_date, [], rows),
+        'listed': scache.cache_key('listed', trade_date, [cfg.list_years], rows + [stamps['companies']]),
+        'non_st': scache.cache_key('non_st', trade_date, [], rows + [stamps['name_history']]),
+        'market_value': scache.cache_key('market_value', trade_date, [cfg.base_index, cfg.low_market_to_base_index],
+                                     rows + [stamps['index_mv'].get(d)])}
+    keys['pool'] = scache.cache_key('pool', trade_date, [], [keys[kind] for kind in FILTER_KINDS])
+    return keys
+
+
+def imp_cached_sample_pool(trade_dates: List[Text], cfg: Optional[Sample_config] = None,
+                           cache_cfg: Optional[scache.Sample_cache_config] = None,
+                           get_filters: Optional[Callable] = None) -> Dict[Text, Tuple[Samples_info, Set]]:
+    """ 与impf_build_sample_pool结果相同；源数据未变的调仓日直接从缓存读取，缺少的条件只对缺少的日期计算
+    """
+    cfg = cfg or sample_config()
+    get_filters = get_filters or impf_sample_filters
+    dates: List[Text] = list(trade_dates)
+    index_mv: pd.Series = imp_get_index_total_mv_by_tushare(dates)
+    stamps: Dict[Text, object] = imp_data_stamps(dates, index_mv)
+    keys: Dict[Text, Dict[Text, Text]] = {d: filter_keys(d, cfg, stamps) for d in dates}
+    cached: Dict[Text, object] = scache.imp_lookup_many([key for k in keys.values() for key in k.values()], cache_cfg)
+
+    rtn: Dict[Text, Tuple[Samples_info, Set]] = {}
+    for d in dates:
+        if keys[d]['pool'] in cached:
+            info, codes = cached[keys[d]['pool']]
+            # 早先的条目把Samples_info保存为dict
+            rtn[d] = (info if isinstance(info, Samples_info) else Samples_info(**info), set(codes))
+    missing: List[Text] = [d for d in dates if d not in rtn]
+    kinds: Tuple = tuple(kind for kind in FILTER_KINDS if any(keys[d][kind] not in cached for d in missing))
+    computed: Dict[Text, Dict[Text, object]] = {}
+    if len(missing) > 0 and len(kinds) > 0:
+        computed = get_filters(missing, cfg=cfg, kinds=kinds, get_index_total_mv=lambda _: index_mv)
+
+    entries: List[Tuple] = []
+    for d in missing:
+        filters: Dict[Text, object] = {kind: cached[keys[d][kind]] for kind in FILTER_KINDS if keys[d][kind] in cached}
+        for kind, value in computed.get(d, {}).items():
+            if kind not in filters:
+                filters[kind] = value
+                entries.append((keys[d][kind], kind, d, value))
+        rtn[d] = combine_filters(d, filters)
+        entries.append((keys[d]['pool'], 'pool', d, rtn[d]))
+    scache.imp_store_many(entries, cache_cfg)
+    return {d: rtn[d] for d in dates}
+
+
 if __name__ == "__main__":
     # 获取构建样本的时间序列（每年4月30日，10月31日或其后的第一个交易日）
     updated_date_iter: Iterator[Text] = filter_updated_date(td.imp_get_trade_cal(start=sample_config().start_date,
                                                                                  end=sample_config().end_date))
 
-    for updated_date in updated_date_iter:
-        samples_info, data = impf_build_samples_by_tushare(updated_date)
+    for samples_info, data in imp_cached_sample_pool(list(updated_date_iter)).values():
         print(samples_info)
@@ -0,0 +1,85 @@
+""" 样本池和各项样本条件结果的持久缓存
+缓存的键由条目类型、调仓日、相关的Sample_config参数和数据版本戳组成。数据版本戳取自源数据表当日的行数和字段合计等，
+下载补入或改写了某日的数据后，该日的键随之改变，旧条目不再命中，最终按最久未使用的顺序被淘汰。
+"""
+from typing import Any, Text, NamedTuple, Optional, Dict, List, Iterable, Tuple
+from collections import namedtuple
+from functools import lru_cache
+import hashlib
+import json
+import os
+import pickle
+import time
+import zlib
+
+from src import db_access as dba
+
+Sample_cache_config: NamedTuple = namedtuple('Sample_cache_config', 'db_path, tbl_name, max_bytes')
+
+
+def sample_cache_config() -> Sample_cache_config:
+    return Sample_cache_config(db_path=os.path.join(dba.data_dir(), 'sample_cache.db'), tbl_name='sample_cache',
+                               max_bytes=256 * 1024 ** 2)
+
+
+def cache_key(kind: Text, trade_date: Text, params: Any, stamps: Any) -> Text:
+    return hashlib.sha1(json.dumps([kind, trade_date, params, stamps], default=str).encode('utf-8')).hexdigest()
+
+
+def encode_value(value: Any) -> bytes:
+    return zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 6)
+
+
+def decode_value(blob: bytes) -> Any:
+    return pickle.loads(zlib.decompress(blob))
+
+
+def imp_cache(cfg: Sample_cache_config) -> dba.Db_access:
+    return imp_open_cache(cfg.db_path, cfg.tbl_name)
+
+
+@lru_cache(16)
+def imp_open_cache(db_path: Text, tbl_name: Text) -> dba.Db_access:
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    access: dba.Db_access = dba.imp_db(db_path)
+    access.write(f'''CREATE TABLE IF NOT EXISTS {tbl_name} (key TEXT PRIMARY KEY, kind TEXT, trade_date INTEGER,
+                     created REAL, accessed REAL, size INTEGER, value BLOB)''', wait=True)
+    return access
+
+
+def imp_lookup_many(keys: Iterable[Text], cfg: Optional[Sample_cache_config] = None) -> Dict[Text, Any]:
+    """ 返回缓存中有的键和值，命中的条目更新最近访问时间
+    """
+    cfg = cfg or sample_cache_config()
+    access: dba.Db_access = imp_cache(cfg)
+    wanted: List[Text] = list(keys)
+    found: Dict[Text, Any] = {}
+    for i in range(0, len(wanted), 500):
+        chunk: List[Text] = wanted[i:i + 500]
+        for key, blob in access.execute(f"SELECT key, value FROM {cfg.tbl_name} WHERE key IN \
+                                         ({','.join('?' * len(chunk))})", tuple(chunk)):
+            found[key] = decode_value(blob)
+    if len(found) > 0:
+        now: float = time.time()
+        access.write_many(f'UPDATE {cfg.tbl_name} SET accessed=? WHERE key=?', [(now, key) for key in found])
+    return found
+
+
+def imp_store_many(entries: Iterable[Tuple[Text, Text, Text, Any]], cfg: Optional[Sample_cache_config] = None) -> Any:
+    """ entries为(key, kind, trade_date, value)，写入后超过容量时淘汰
+    """
+    cfg = cfg or sample_cache_config()
+    access: dba.Db_access = imp_cache(cfg)
+    now: float = time.time()
+    rows: List[Tuple] = []
+    for key, kind, trade_date, value in entries:
+        blob: bytes = encode_value(value)
+        rows.append((key, kind, int(trade_date), now, now, len(blob), blob))
+    if len(rows) > 0:
+        access.write_many(f'INSERT OR REPLACE INTO {cfg.tbl_name} VALUES (?, ?, ?, ?, ?, ?, ?)', rows, wait=True)
+        imp_evict(cfg)
+
+
+def imp_evict(cfg: Optional[Sample_cache_config] = None) -> Any:
+    cfg = cfg or sample_cache_config()
+    dba.imp_evict_lru(imp_cache(cfg), cfg.tbl_name, cfg.max_bytes)
@@ -0,0 +1,283 @@
+""" 本地数据库的表结构登记和迁移
+每个表的列名和类型在这里声明：日期保存为YYYYMMDD形式的INTEGER，数值为REAL，代码和名称为TEXT。建库不再需要从tushare
+下载样本数据；数据库的结构版本记在PRAGMA user_version中，按版本顺序执行迁移，已有的无类型表会被改写为有类型的表。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, List
+from collections import namedtuple
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from src import db_access as dba
+
+# columns: ((列名, 类型), ...); indexes: ((列名, ...), ...); without_rowid: 按主键聚簇存储，省去主键的独立索引
+Table_schema: NamedTuple = namedtuple('Table_schema', 'name, columns, primary_key, indexes, without_rowid')
+Migration: NamedTuple = namedtuple('Migration', 'version, description, apply')
+
+DATE_COLUMNS: Tuple = ('trade_date', 'ann_date', 'f_ann_date', 'end_date', 'start_date', 'list_date', 'delist_date')
+TEXT_COLUMNS: Tuple = ('ts_code', 'name', 'change_reason', 'report_type', 'comp_type', 'update_flag')
+
+# 版本1发布时各表的列，迁移1按这些列建表，已发布不再修改；以后增减列时另写列表，在table_schemas中替换并追加迁移
+DAILY_FIELDS_V1: Text = 'ts_code, trade_date, open, high, low, close, pre_close, change, pct_chg, vol, amount'
+DAILY_BASIC_FIELDS_V1: Text = 'ts_code, trade_date, close, turnover_rate, turnover_rate_f, volume_ratio, pe, pe_ttm, \
+    pb, ps, ps_ttm, total_share, float_share, free_share, total_mv, circ_mv'
+NAME_HISTORY_FIELDS_V1: Text = 'ts_code, name, start_date, end_date, ann_date, change_reason'
+INCOME_FIELDS_V1: Text = 'ts_code, ann_date, f_ann_date, end_date, report_type, comp_type, basic_eps, diluted_eps, \
+    total_revenue, revenue, int_income, prem_earned, comm_income, n_commis_income, n_oth_income, n_oth_b_income, \
+    prem_income, out_prem, une_prem_reser, reins_income, n_sec_tb_income, n_sec_uw_income, n_asset_mg_income, \
+    oth_b_income, fv_value_chg_gain, invest_income, ass_invest_income, forex_gain, total_cogs, oper_cost, int_exp, \
+    comm_exp, biz_tax_surchg, sell_exp, admin_exp, fin_exp, assets_impair_loss, prem_refund, compens_payout, \
+    reser_insur_liab, div_payt, reins_exp, oper_exp, compens_payout_refu, insur_reser_refu, reins_cost_refund, \
+    other_bus_cost, operate_profit, non_oper_income, non_oper_exp, nca_disploss, total_profit, income_tax, n_income, \
+    n_income_attr_p, minority_gain, oth_compr_income, t_compr_income, compr_inc_attr_p, compr_inc_attr_m_s, ebit, \
+    ebitda, insurance_exp, undist_profit, distable_profit, update_flag'
+BALANCE_SHEET_FIELDS_V1: Text = 'ts_code, ann_date, f_ann_date, end_date, report_type, comp_type, total_share, \
+    cap_rese, undistr_porfit, surplus_rese, special_rese, money_cap, trad_asset, notes_receiv, accounts_receiv, \
+    oth_receiv, prepayment, div_receiv, int_receiv, inventories, amor_exp, nca_within_1y, sett_rsrv, \
+    loanto_oth_bank_fi, premium_receiv, reinsur_receiv, reinsur_res_receiv, pur_resale_fa, oth_cur_assets, \
+    total_cur_assets, fa_avail_for_sale, htm_invest, lt_eqt_invest, invest_real_estate, time_deposits, oth_assets, \
+    lt_rec, fix_assets, cip, const_materials, fixed_assets_disp, produc_bio_assets, oil_and_gas_assets, intan_assets, \
+    r_and_d, goodwill, lt_amor_exp, defer_tax_assets, decr_in_disbur, oth_nca, total_nca, cash_reser_cb, \
+    depos_in_oth_bfi, prec_metals, deriv_assets, rr_reins_une_prem, rr_reins_outstd_cla, rr_reins_lins_liab, \
+    rr_reins_lthins_liab, refund_depos, ph_pledge_loans, refund_cap_depos, indep_acct_assets, client_depos, \
+    client_prov, transac_seat_fee, invest_as_receiv, total_assets, lt_borr, st_borr, cb_borr, depos_ib_deposits, \
+    loan_oth_bank, trading_fl, notes_payable, acct_payable, adv_receipts, sold_for_repur_fa, comm_payable, \
+    payroll_payable, taxes_payable, int_payable, div_payable, oth_payable, acc_exp, deferred_inc, st_bonds_payable, \
+    payable_to_reinsurer, rsrv_insur_cont, acting_trading_sec, acting_uw_sec, non_cur_liab_due_1y, oth_cur_liab, \
+    total_cur_liab, bond_payable, lt_payable, specific_payables, estimated_liab, defer_tax_liab, \
+    defer_inc_non_cur_liab, oth_ncl, total_ncl, depos_oth_bfi, deriv_liab, depos, agency_bus_liab, oth_liab, \
+    prem_receiv_adva, depos_received, ph_invest, reser_une_prem, reser_outstd_claims, reser_lins_liab, \
+    reser_lthins_liab, indept_acc_liab, pledge_borr, indem_payable, policy_div_payable, total_liab, treasury_share, \
+    ordin_risk_reser, forex_differ, invest_loss_unconf, minority_int, total_hldr_eqy_exc_min_int, \
+    total_hldr_eqy_inc_min_int, total_liab_hldr_eqy, lt_payroll_payable, oth_comp_income, oth_eqt_tools, \
+    oth_eqt_tools_p_shr, lending_funds, acc_receivable, st_fin_payable, payables, hfs_assets, hfs_sales, update_flag'
+CASH_FLOW_FIELDS_V1: Text = 'ts_code, ann_date, f_ann_date, end_date, comp_type, report_type, net_profit, finan_exp, \
+    c_fr_sale_sg, recp_tax_rends, n_depos_incr_fi, n_incr_loans_cb, n_inc_borr_oth_fi, prem_fr_orig_contr, \
+    n_incr_insured_dep, n_reinsur_prem, n_incr_disp_tfa, ifc_cash_incr, n_incr_disp_faas, n_incr_loans_oth_bank, \
+    n_cap_incr_repur, c_fr_oth_operate_a, c_inf_fr_operate_a, c_paid_goods_s, c_paid_to_for_empl, c_paid_for_taxes, \
+    n_incr_clt_loan_adv, n_incr_dep_cbob, c_pay_claims_orig_inco, pay_handling_chrg, pay_comm_insur_plcy, \
+    oth_cash_pay_oper_act, st_cash_out_act, n_cashflow_act, oth_recp_ral_inv_act, c_disp_withdrwl_invest, \
+    c_recp_return_invest, n_recp_disp_fiolta, n_recp_disp_sobu, stot_inflows_inv_act, c_pay_acq_const_fiolta, \
+    c_paid_invest, n_disp_subs_oth_biz, oth_pay_ral_inv_act, n_incr_pledge_loan, stot_out_inv_act, \
+    n_cashflow_inv_act, c_recp_borrow, proc_issue_bonds, oth_cash_recp_ral_fnc_act, stot_cash_in_fnc_act, \
+    free_cashflow, c_prepay_amt_borr, c_pay_dist_dpcp_int_exp, incl_dvd_profit_paid_sc_ms, oth_cashpay_ral_fnc_act, \
+    stot_cashout_fnc_act, n_cash_flows_fnc_act, eff_fx_flu_cash, n_incr_cash_cash_equ, c_cash_equ_beg_period, \
+    c_cash_equ_end_period, c_recp_cap_contrib, incl_cash_rec_saims, uncon_invest_loss, prov_depr_assets, \
+    depr_fa_coga_dpba, amort_intang_assets, lt_amort_deferred_exp, decr_deferred_exp, incr_acc_exp, loss_disp_fiolta, \
+    loss_scr_fa, loss_fv_chg, invest_loss, decr_def_inc_tax_assets, incr_def_inc_tax_liab, decr_inventories, \
+    decr_oper_payable, incr_oper_payable, others, im_net_cashflow_oper_act, conv_debt_into_cap, \
+    conv_copbonds_due_within_1y, fa_fnc_leases, end_bal_cash, beg_bal_cash, end_bal_cash_equ, beg_bal_cash_equ, \
+    im_n_incr_cash_equ, update_flag'
+FINANCE_INDICATOR_FIELDS_V1: Text = 'ts_code, ann_date, end_date, eps, dt_eps, total_revenue_ps, revenue_ps, \
+    capital_rese_ps, surplus_rese_ps, undist_profit_ps, extra_item, profit_dedt, gross_margin, current_ratio, \
+    quick_ratio, cash_ratio, invturn_days, arturn_days, inv_turn, ar_turn, ca_turn, fa_turn, assets_turn, op_income, \
+    valuechange_income, interst_income, daa, ebit, ebitda, fcff, fcfe, current_exint, noncurrent_exint, interestdebt, \
+    netdebt, tangible_asset, working_capital, networking_capital, invest_capital, retained_earnings, diluted2_eps, \
+    bps, ocfps, retainedps, cfps, ebit_ps, fcff_ps, fcfe_ps, netprofit_margin, grossprofit_margin, cogs_of_sales, \
+    expense_of_sales, profit_to_gr, saleexp_to_gr, adminexp_of_gr, finaexp_of_gr, impai_ttm, gc_of_gr, op_of_gr, \
+    ebit_of_gr, roe, roe_waa, roe_dt, roa, npta, roic, roe_yearly, roa2_yearly, roe_avg, opincome_of_ebt, \
+    investincome_of_ebt, n_op_profit_of_ebt, tax_to_ebt, dtprofit_to_profit, salescash_to_or, ocf_to_or, \
+    ocf_to_opincome, capitalized_to_da, debt_to_assets, assets_to_eqt, dp_assets_to_eqt, ca_to_assets, nca_to_assets, \
+    tbassets_to_totalassets, int_to_talcap, eqt_to_talcapital, currentdebt_to_debt, longdeb_to_debt, \
+    ocf_to_shortdebt, debt_to_eqt, eqt_to_debt, eqt_to_interestdebt, tangibleasset_to_debt, tangasset_to_intdebt, \
+    tangibleasset_to_netdebt, ocf_to_debt, ocf_to_interestdebt, ocf_to_netdebt, ebit_to_interest, \
+    longdebt_to_workingcapital, ebitda_to_debt, turn_days, roa_yearly, roa_dp, fixed_assets, profit_prefin_exp, \
+    non_op_profit, op_to_ebt, nop_to_ebt, ocf_to_profit, cash_to_liqdebt, cash_to_liqdebt_withinterest, op_to_liqdebt, \
+    op_to_debt, roic_yearly, profit_to_op, q_opincome, q_investincome, q_dtprofit, q_eps, q_netprofit_margin, \
+    q_gsprofit_margin, q_exp_to_sales, q_profit_to_gr, q_saleexp_to_gr, q_adminexp_to_gr, q_finaexp_to_gr, \
+    q_impair_to_gr_ttm, q_gc_to_gr, q_op_to_gr, q_roe, q_dt_roe, q_npta, q_opincome_to_ebt, q_investincome_to_ebt, \
+    q_dtprofit_to_profit, q_salescash_to_or, q_ocf_to_sales, q_ocf_to_or, basic_eps_yoy, dt_eps_yoy, cfps_yoy, op_yoy, \
+    ebt_yoy, netprofit_yoy, dt_netprofit_yoy, ocf_yoy, roe_yoy, bps_yoy, assets_yoy, eqt_yoy, tr_yoy, or_yoy, \
+    q_gr_yoy, q_gr_qoq, q_sales_yoy, q_sales_qoq, q_op_yoy, q_op_qoq, q_profit_yoy, q_profit_qoq, q_netprofit_yoy, \
+    q_netprofit_qoq, equity_yoy, update_flag'
+# 版本3新增的复权因子表
+ADJ_FACTOR_FIELDS_V3: Text = 'ts_code, trade_date, adj_factor'
+
+
+def column_type(name: Text) -> Text:
+    if name in DATE_COLUMNS:
+        return 'INTEGER'
+    return 'TEXT' if name in TEXT_COLUMNS else 'REAL'
+
+
+def typed_columns(fields: Text) -> Tuple:
+    return tuple((f.strip(), column_type(f.strip())) for f in fields.split(','))
+
+
+def column_names(schema: Table_schema) -> List[Text]:
+    return [name for name, _ in schema.columns]
+
+
+def column_dtypes(schema: Table_schema) -> Dict[Text, Any]:
+    # 读取时各列的NumPy类型：主键中的日期不为空，为int64；其他日期可能为NULL，与数值一样为float64
+    return {name: object if kind == 'TEXT' else np.int64 if kind == 'INTEGER' and name in schema.primary_key
+            else np.float64 for name, kind in schema.columns}
+
+
+def v1_table_schemas(tables: NamedTuple) -> Dict[Text, Table_schema]:
+    """ 版本1发布时的表结构，迁移1、2按它建表和建索引，已发布不再修改
+
+    日交易数据按(ts_code, trade_date)聚簇，另建(trade_date, ts_code, ...)覆盖索引，按日期截面取样本时只读索引；
+    财务报表每行较宽，保留rowid表，按公告日期建索引
+    """
+    statement: Callable[[Text, Text], Table_schema] = lambda tbl, fields: Table_schema(
+        name=tbl, columns=typed_columns(fields),
+        primary_key=('ts_code', 'end_date', 'f_ann_date' if 'f_ann_date' in fields else 'ann_date'),
+        indexes=(('ann_date',), ('end_date', 'ts_code')), without_rowid=False)
+    return {tables.tbl_daily_trading_data: Table_schema(name=tables.tbl_daily_trading_data,
+                                                        columns=typed_columns(DAILY_FIELDS_V1),
+                                                        primary_key=('ts_code', 'trade_date'),
+                                                        indexes=(('trade_date', 'ts_code', 'pct_chg'),),
+                                                        without_rowid=True),
+            tables.tbl_daily_basic: Table_schema(name=tables.tbl_daily_basic,
+                                                 columns=typed_columns(DAILY_BASIC_FIELDS_V1),
+                                                 primary_key=('ts_code', 'trade_date'),
+                                                 indexes=(('trade_date', 'ts_code', 'total_mv'),),
+                                                 without_rowid=True),
+            tables.tbl_index: Table_schema(name=tables.tbl_index, columns=typed_columns(DAILY_FIELDS_V1),
+                                           primary_key=('ts_code', 'trade_date'), indexes=(('trade_date',),),
+                                           without_rowid=True),
+            tables.tbl_name_history: Table_schema(name=tables.tbl_name_history,
+                                                  columns=typed_columns(NAME_HISTORY_FIELDS_V1),
+                                                  primary_key=('ts_code', 'start_date'),
+                                                  indexes=(('start_date', 'ts_code'),), without_rowid=True),
+            tables.tbl_income_statement: statement(tables.tbl_income_statement, INCOME_FIELDS_V1),
+            tables.tbl_balance_sheet: statement(tables.tbl_balance_sheet, BALANCE_SHEET_FIELDS_V1),
+            tables.tbl_cash_flow_statement: statement(tables.tbl_cash_flow_statement, CASH_FLOW_FIELDS_V1),
+            tables.tbl_finance_indicator_statement: statement(tables.tbl_finance_indicator_statement,
+                                                              FINANCE_INDICATOR_FIELDS_V1)}
+
+
+def v3_adj_factor_schema(tables: NamedTuple) -> Table_schema:
+    return Table_schema(name=tables.tbl_adj_factor, columns=typed_columns(ADJ_FACTOR_FIELDS_V3),
+                        primary_key=('ts_code', 'trade_date'), indexes=(('trade_date', 'ts_code', 'adj_factor'),),
+                        without_rowid=True)
+
+
+def table_schemas(tables: NamedTuple) -> Dict[Text, Table_schema]:
+    """ tables为tushare_data.DB_config，返回表名到当前表结构的映射：版本1的表加上之后的迁移新增的表
+    """
+    return {**v1_table_schemas(tables), tables.tbl_adj_factor: v3_adj_factor_schema(tables)}
+
+
+def create_table_sql(schema: Table_schema, name: Optional[Text] = None) -> Text:
+    columns: Text = ', '.join(f'{column} {kind}' for column, kind in schema.columns)
+    return f"CREATE TABLE IF NOT EXISTS {name or schema.name} ({columns}, " \
+           f"PRIMARY KEY ({', '.join(schema.primary_key)}))" + \
+        (' WITHOUT ROWID' if schema.without_rowid is True else '')
+
+
+def index_name(schema: Table_schema, index: Tuple) -> Text:
+    return f"idx_{schema.name}_{'_'.join(index)}"
+
+
+def create_index_sql(schema: Table_schema) -> List[Text]:
+    return [f"CREATE INDEX IF NOT EXISTS {index_name(schema, index)} ON {schema.name} ({', '.join(index)})"
+            for index in schema.indexes]
+
+
+def copy_column_sql(name: Text, kind: Text, existing: List[Text]) -> Text:
+    # 旧表中的日期是'20190430'这样的文本，CAST后为整数；旧表没有的列填NULL
+    if name not in existing:
+        return 'NULL'
+    return f'CAST({name} AS INTEGER)' if kind == 'INTEGER' else (f'CAST({name} AS REAL)' if kind == 'REAL' else name)
+
+
+def conform(data: pd.DataFrame, schema: Table_schema) -> pd.DataFrame:
+    """ 按登记的列顺序重排接口返回的数据，缺少的列填空值，日期转为整数、数值转为浮点数
+    """
+    df: pd.DataFrame = data.reindex(columns=column_names(schema))
+    for name, kind in schema.columns:
+        if kind == 'INTEGER':
+            dates: pd.Series = pd.to_numeric(df[name], errors='coerce')
+            df[name] = np.where(dates.notnull(), dates.fillna(0).astype(np.int64).astype(object), None)
+        elif kind == 'REAL' and df[name].dtype != np.float64:
+            df[name] = pd.to_numeric(df[name], errors='coerce').astype(np.float64)
+    if 'f_ann_date' in df.columns and 'ann_date' in df.columns:
+        # 部分报表接口不返回实际公告日期，以公告日期代替，否则主键含空值，重复下载的行不会被INSERT OR IGNORE去掉
+        df['f_ann_date'] = np.where(df['f_ann_date'].notnull(), df['f_ann_date'], df['ann_date'])
+    return df
+
+
+def imp_table_columns(conn: sqlite3.Connection, tbl_name: Text) -> List[Text]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({tbl_name})').fetchall()]
+
+
+def imp_rebuild_table(conn: sqlite3.Connection, schema: Table_schema) -> Any:
+    """ 把已有的表改写为登记的结构：建新表、转换类型复制数据、删除旧表后改名
+    """
+    existing: List[Text] = imp_table_columns(conn, schema.name)
+    if len(existing) == 0:
+        conn.execute(create_table_sql(schema))
+        return
+    tmp: Text = f'{schema.name}__typed'
+    conn.execute(f'DROP TABLE IF EXISTS {tmp}')
+    conn.execute(create_table_sql(schema, tmp))
+    conn.execute(f"INSERT OR IGNORE INTO {tmp} SELECT "
+                 f"{', '.join(copy_column_sql(name, kind, existing) for name, kind in schema.columns)} "
+                 f"FROM {schema.name}")
+    conn.execute(f'DROP TABLE {schema.name}')
+    conn.execute(f'ALTER TABLE {tmp} RENAME TO {schema.name}')
+
+
+def migrations(tables: NamedTuple) -> List[Migration]:
+    """ 按版本排列的迁移，新的结构变化追加在末尾，已发布的迁移不再修改；每个迁移只用发布时的表结构，
+    不随table_schemas的改动而变化
+    """
+    def typed_tables(conn: sqlite3.Connection) -> Any:
+        for schema in v1_table_schemas(tables).values():
+            imp_rebuild_table(conn, schema)
+
+    def indexes(conn: sqlite3.Connection) -> Any:
+        for schema in v1_table_schemas(tables).values():
+            for sql in create_index_sql(schema):
+                conn.execute(sql)
+
+    def adj_factor(conn: sqlite3.Connection) -> Any:
+        # 日交易数据改为保存未复权价格，复权因子单独成表
+        schema: Table_schema = v3_adj_factor_schema(tables)
+        conn.execute(create_table_sql(schema))
+        for sql in create_index_sql(schema):
+            conn.execute(sql)
+
+    def f_ann_date(conn: sqlite3.Connection) -> Any:
+        # 实际公告日期为空的行以公告日期代替，主键含空值时INSERT OR IGNORE去不掉重复的行，补齐后冲突的是重复行
+        for tbl_name in (tables.tbl_income_statement, tables.tbl_balance_sheet, tables.tbl_cash_flow_statement):
+            conn.execute(f'UPDATE OR IGNORE {tbl_name} SET f_ann_date=ann_date '
+                         f'WHERE f_ann_date IS NULL AND ann_date IS NOT NULL')
+            conn.execute(f'DELETE FROM {tbl_name} WHERE f_ann_date IS NULL AND ann_date IS NOT NULL')
+
+    return [Migration(version=1, description='有类型的表，日期保存为整数', apply=typed_tables),
+            Migration(version=2, description='按交易日和公告日期的索引', apply=indexes),
+            Migration(version=3, description='复权因子表', apply=adj_factor),
+            Migration(version=4, description='财务报表的实际公告日期不为空', apply=f_ann_date)]
+
+
+def imp_migrate(db_path: Text, tables: NamedTuple) -> int:
+    """ tables为tushare_data.DB_config，执行数据库版本之后的全部迁移，每个迁移一个事务，返回迁移后的版本；有迁移执行时整理数据库文件，回收旧表的空间
+    迁移失败时回滚该迁移并抛出错误，数据库停在之前的版本，不在未完成迁移的数据库上继续运行
+    """
+    dba.imp_db(db_path).flush()
+    conn: sqlite3.Connection = dba.imp_connect(db_path, dba.db_access_config())
+    try:
+        version: int = conn.execute('PRAGMA user_version').fetchone()[0]
+        start: int = version
+        for migration in migrations(tables):
+            if migration.version <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration.apply(conn)
+                conn.execute(f'PRAGMA user_version={migration.version}')
+                conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                print(migration.description, e)
+                conn.execute('ROLLBACK')
+                raise
+            version = migration.version
+        if version > start:
+            conn.execute('VACUUM')
+        return version
+    finally:
+        conn.close()
@@ -0,0 +1,179 @@
+""" 证券主表：ts_code到int32编号的映射和按编号存放的上市、退市日期及名称区间
+编号按首次出现的顺序分配，只追加不改变，保存在codes.npy中；面板存储的股票列即按这个编号排列，各面板和样本条件共用
+同一个编号空间。名称区间按(编号, 开始日期)组合成一个int64键排序，"某日是否ST""某日是否上市满N年""某日是否在市"
+对整个股票池都是一次searchsorted，不逐行比较字符串。
+"""
+from typing import Any, Text, NamedTuple, Optional, Tuple, Sequence, Dict
+from collections import namedtuple
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import db_access as dba
+from src import tushare_data as td
+
+Master_config: NamedTuple = namedtuple('Master_config', 'root')
+# codes: 按编号排列的ts_code; sorted_codes, sorted_ids: 按代码排序的ts_code和对应编号，用于二分查找
+# list_date, delist_date: 按编号排列的YYYYMMDD整数，上市日期未知为0，未退市为NEVER
+# name_key: 编号 * KEY_BASE + 名称开始日期，升序; name_end, name_is_st: 与name_key对应的名称结束日期和是否ST
+Security_master: NamedTuple = namedtuple('Security_master', 'codes, sorted_codes, sorted_ids, list_date, delist_date, \
+                                          name_key, name_end, name_is_st')
+
+NEVER: int = 99991231
+KEY_BASE: int = 100000000
+
+
+def master_config(panel_root: Optional[Text] = None) -> Master_config:
+    # 面板的股票列按主表编号排列，主表保存在面板目录下，不同的面板目录各有自己的编号；缺省与panel_config的root相同
+    return Master_config(root=os.path.join(panel_root or os.path.join(dba.data_dir(), 'panel'), 'security_master'))
+
+
+def ymd_to_days(ymd: np.ndarray) -> np.ndarray:
+    """ YYYYMMDD整数转为1970-01-01以来的天数
+    """
+    ymd = np.asarray(ymd, dtype=np.int64)
+    months: np.ndarray = (ymd // 10000 - 1970) * 12 + ymd // 100 % 100 - 1
+    return (months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + ymd % 100 - 1)
+
+
+def ymd_column(values: pd.Series, missing: int) -> np.ndarray:
+    return pd.to_numeric(values, errors='coerce').fillna(missing).values.astype(np.int32)
+
+
+def code_ids(master: Security_master, ts_codes: Sequence) -> np.ndarray:
+    """ ts_code转为编号，主表中没有的为-1
+    """
+    wanted: np.ndarray = np.asarray(ts_codes, dtype=str)
+    if len(master.sorted_codes) == 0:
+        return np.full(len(wanted), -1, dtype=np.int32)
+    pos: np.ndarray = np.minimum(np.searchsorted(master.sorted_codes, wanted), len(master.sorted_codes) - 1)
+    return np.where(master.sorted_codes[pos] == wanted, master.sorted_ids[pos], -1).astype(np.int32)
+
+
+def empty_master(codes: np.ndarray) -> Security_master:
+    """ 只有编号、没有日期和名称信息的主表，可以用于code_ids
+    """
+    codes = np.asarray(codes, dtype=str)
+    order: np.ndarray = np.argsort(codes, kind='mergesort')
+    return Security_master(codes=codes, sorted_codes=codes[order], sorted_ids=order.astype(np.int32),
+                           list_date=np.zeros(len(codes), dtype=np.int32),
+                           delist_date=np.full(len(codes), NEVER, dtype=np.int32),
+                           name_key=np.array([], dtype=np.int64), name_end=np.array([], dtype=np.int32),
+                           name_is_st=np.array([], dtype=bool))
+
+
+def build_security_master(codes: np.ndarray, companies: pd.DataFrame, name_history: pd.DataFrame) -> Security_master:
+    """ codes为按编号排列的ts_code，companies、name_history中不在codes里的股票被忽略
+    """
+    master: Security_master = empty_master(codes)
+
+    listed: pd.DataFrame = companies.drop_duplicates('ts_code')
+    ids: np.ndarray = code_ids(master, listed['ts_code'].values)
+    master.list_date[ids[ids >= 0]] = ymd_column(listed['list_date'], 0)[ids >= 0]
+    master.delist_date[ids[ids >= 0]] = ymd_column(listed['delist_date'], NEVER)[ids >= 0]
+
+    ids = code_ids(master, name_history['ts_code'].values)
+    known: np.ndarray = ids >= 0
+    keys: np.ndarray = ids[known].astype(np.int64) * KEY_BASE + ymd_column(name_history['start_date'], 0)[known]
+    order: np.ndarray = np.argsort(keys, kind='mergesort')
+    is_st: np.ndarray = name_history['name'].fillna('').str.contains('ST', regex=False).values.astype(bool)
+    return master._replace(name_key=keys[order], name_end=ymd_column(name_history['end_date'], NEVER)[known][order],
+                           name_is_st=is_st[known][order])
+
+
+def name_status(master: Security_master, ids: np.ndarray, dates: Any) -> Tuple[np.ndarray, np.ndarray]:
+    """ 返回(当日有名称记录, 当日名称含ST)；dates为YYYYMMDD整数，可以是与ids等长的数组或一个日期
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    dates = np.broadcast_to(np.asarray(dates, dtype=np.int64), ids.shape)
+    if len(master.name_key) == 0:
+        return np.zeros(len(ids), dtype=bool), np.zeros(len(ids), dtype=bool)
+    pos: np.ndarray = np.searchsorted(master.name_key, ids * KEY_BASE + dates, 'right') - 1
+    at: np.ndarray = np.maximum(pos, 0)
+    covered: np.ndarray = (ids >= 0) & (pos >= 0) & (master.name_key[at] // KEY_BASE == ids) \
+        & (dates <= master.name_end[at])
+    return covered, covered & master.name_is_st[at]
+
+
+def is_active(master: Security_master, ids: np.ndarray, dates: Any) -> np.ndarray:
+    """ 当日已上市且未退市
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    dates = np.asarray(dates, dtype=np.int64)
+    at: np.ndarray = np.maximum(ids, 0)
+    return (ids >= 0) & (master.list_date[at] > 0) & (master.list_date[at] <= dates) & (dates < master.delist_date[at])
+
+
+def listed_over_years(master: Security_master, ids: np.ndarray, dates: Any, years: float) -> np.ndarray:
+    """ 当日在市且上市已超过365 * years天
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    dates = np.asarray(dates, dtype=np.int64)
+    at: np.ndarray = np.maximum(ids, 0)
+    return is_active(master, ids, dates) & (ymd_to_days(dates) - ymd_to_days(master.list_date[at]) > 365 * years)
+
+
+def imp_codes(cfg: Optional[Master_config] = None) -> np.ndarray:
+    cfg = cfg or master_config()
+    path: Text = os.path.join(cfg.root, 'codes.npy')
+    return np.load(path) if os.path.exists(path) else np.array([], dtype=str)
+
+
+def imp_intern_codes(ts_codes: Sequence, cfg: Optional[Master_config] = None) -> np.ndarray:
+    """ 返回ts_code的编号，新出现的代码追加在末尾
+    """
+    cfg = cfg or master_config()
+    codes: np.ndarray = imp_codes(cfg)
+    wanted: np.ndarray = np.asarray(ts_codes, dtype=str)
+    unseen: np.ndarray = wanted[~np.isin(wanted, codes)]
+    first: np.ndarray = np.unique(unseen, return_index=True)[1]
+    new_codes: np.ndarray = unseen[np.sort(first)]
+    if len(new_codes) > 0:
+        codes = np.concatenate([codes, new_codes])
+        os.makedirs(cfg.root, exist_ok=True)
+        path: Text = os.path.join(cfg.root, 'codes.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, codes)
+        os.replace(path + '.tmp', path)
+    return code_ids(empty_master(codes), wanted)
+
+
+_masters: Dict[Text, Tuple[Tuple, Security_master]] = {}
+
+
+def imp_data_stamp(cfg: Master_config) -> Tuple:
+    """ 主表依赖的数据的版本：当天的股票列表、名称变更表的行数和最后的开始日期、编号文件的大小和修改时间
+    """
+    path: Text = os.path.join(cfg.root, 'codes.npy')
+    stat: Optional[os.stat_result] = os.stat(path) if os.path.exists(path) else None
+    history: Optional[pd.DataFrame] = td.imp_get_records_from_db(
+        "SELECT COUNT(*) AS n, MAX(start_date) AS last FROM name_history")
+    return (datetime.date.today().isoformat(), (stat.st_size, stat.st_mtime_ns) if stat is not None else None,
+            tuple(history.iloc[0]) if history is not None else None)
+
+
+def imp_security_master(cfg: Optional[Master_config] = None) -> Security_master:
+    """ 返回主表，依赖的数据没有变化时取进程内保存的结果；按日调用时不用每次重读名称变更表
+    """
+    cfg = cfg or master_config()
+    stamp: Tuple = imp_data_stamp(cfg)
+    if cfg.root in _masters and _masters[cfg.root][0] == stamp:
+        return _masters[cfg.root][1]
+    master: Security_master = imp_build_security_master(cfg)
+    # 构建时可能分配了新编号，按构建后的版本保存
+    _masters[cfg.root] = (imp_data_stamp(cfg), master)
+    return master
+
+
+def imp_build_security_master(cfg: Optional[Master_config] = None) -> Security_master:
+    """ 从股票列表和名称变更表构建主表，其中新出现的代码先分配编号
+    """
+    cfg = cfg or master_config()
+    companies: pd.DataFrame = td.download_list_companies()
+    name_history: pd.DataFrame = td.imp_get_records_from_db("SELECT ts_code, name, start_date, end_date FROM \
+                                                            name_history")
+    imp_intern_codes(np.concatenate([companies['ts_code'].values.astype(str),
+                                     name_history['ts_code'].values.astype(str)]), cfg)
+    return build_security_master(imp_codes(cfg), companies, name_history)
@@ -0,0 +1,208 @@
+""" 样本参数和因子权重的批量回测
+行情面板只在主进程准备一次：日交易数据和每日指标本来就是内存映射的面板文件，累计收益矩阵也保存为.npy文件，工作进程
+以只读方式映射，多个进程共用操作系统的页缓存而不各自复制。每组(Sample_config, 因子权重)的结果写入SQLite中的一张表，
+中断后重新运行时跳过已经完成的组合。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Dict, List, Iterable, Iterator
+from collections import namedtuple
+from functools import lru_cache
+from itertools import product
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import backtest as bt
+from src import db_access as dba
+from src import factor_engine as fe
+from src import panel_store as ps
+from src import sample
+from src import security_master as sm
+from src import tushare_data as td
+
+Sweep_config: NamedTuple = namedtuple('Sweep_config', 'db_path, tbl_result, returns_dir, workers, backtest')
+# 工作进程的共享数据：证券主表、基准指数总市值和交易日历都很小，随进程初始化参数传入一次
+Market: NamedTuple = namedtuple('Market', 'root, returns, master, index_mv, trade_cal')
+Cell: NamedTuple = namedtuple('Cell', 'key, sample_cfg, weights')
+
+METRICS: Tuple = ('annual_return', 'annual_vol', 'sharpe', 'max_drawdown', 'mean_turnover', 'ic_mean', 'ic_ir')
+
+_market: Optional[Market] = None
+
+
+def sweep_config() -> Sweep_config:
+    return Sweep_config(db_path=os.path.join(dba.data_dir(), 'sweep.db'), tbl_result='sweep_result',
+                        returns_dir=os.path.join(dba.data_dir(), 'panel', 'returns'), workers=os.cpu_count() or 1,
+                        backtest=bt.backtest_config())
+
+
+def cell_key(sample_cfg: sample.Sample_config, weights: Dict[Text, float], backtest_cfg: bt.Backtest_config) -> Text:
+    return hashlib.sha1(json.dumps([sample_cfg._asdict(), sorted(weights.items()), backtest_cfg._asdict()],
+                                   default=str).encode('utf-8')).hexdigest()
+
+
+def sweep_cells(sample_grid: Dict[Text, List], weight_grid: List[Dict[Text, float]],
+                backtest_cfg: Optional[bt.Backtest_config] = None) -> List[Cell]:
+    """ sample_grid为Sample_config字段到候选值的映射，未列出的字段取sample_config()的值；与weight_grid做笛卡尔积
+    """
+    cfg: bt.Backtest_config = backtest_cfg or sweep_config().backtest
+    names: List[Text] = list(sample_grid.keys())
+    sample_cfgs: List[sample.Sample_config] = [sample.sample_config()._replace(**dict(zip(names, values)))
+                                               for values in product(*[sample_grid[n] for n in names])]
+    return [Cell(key=cell_key(s, w, cfg), sample_cfg=s, weights=w) for s, w in product(sample_cfgs, weight_grid)]
+
+
+def panel_rows(table: Text, field: Text, dates: List[Text], root: Optional[Text]) -> pd.DataFrame:
+    """ 从面板取出若干交易日的(trade_date, ts_code, field)长表，只读取这几行
+    """
+    meta: Optional[ps.Panel_meta] = ps.imp_read_meta(table, root)
+    panel_dates: np.ndarray = ps.imp_dates(table, root, meta)
+    codes: np.ndarray = ps.imp_codes(table, root, meta)
+    wanted: np.ndarray = np.array([int(d) for d in dates], dtype=np.int64)
+    pos: np.ndarray = np.searchsorted(panel_dates, wanted)
+    found: np.ndarray = (pos < len(panel_dates)) & (panel_dates[np.minimum(pos, max(len(panel_dates) - 1, 0))]
+                                                     == wanted) if len(panel_dates) > 0 else np.zeros(0, dtype=bool)
+    pos = pos[found]
+    values: np.ndarray = np.asarray(ps.imp_open_field(table, field, root, meta=meta)[pos, :len(codes)],
+                                    dtype=np.float64)
+    rows: pd.DataFrame = pd.DataFrame({'trade_date': np.repeat(panel_dates[pos], len(codes)),
+                                       'ts_code': np.tile(codes, len(pos)), field: values.ravel()})
+    return rows[rows[field].notnull().values]
+
+
+def imp_init_worker(market: Market) -> Any:
+    global _market
+    _market = market._replace(returns=bt.imp_open_returns(market.returns))
+
+
+@lru_cache(8)
+def worker_pool(sample_cfg: sample.Sample_config) -> Dict:
+    m: Market = _market
+    # 交易日历覆盖所有组合的日期范围，每组只取自己的start_date到end_date
+    trade_cal: List[Tuple] = [r for r in m.trade_cal if sample_cfg.start_date <= r[1] <= sample_cfg.end_date]
+    dates: List[Text] = list(sample.filter_updated_date(iter(trade_cal), sample_cfg))
+    return sample.build_sample_pool(
+        dates, get_security_master=lambda: m.master,
+        get_daily_trading=lambda d: panel_rows(td.db_config().tbl_daily_trading_data, 'pct_chg', d, m.root),
+        get_daily_basic=lambda d: panel_rows(td.db_config().tbl_daily_basic, 'total_mv', d, m.root),
+        get_index_total_mv=lambda d: m.index_mv, cfg=sample_cfg)
+
+
+def combined_score(weights: Dict[Text, float], dates: List[Text], root: Optional[Text]) -> pd.DataFrame:
+    """ 各因子在调仓日的加权和，只读取调仓日所在的行；缺失的因子值不参与加权
+    """
+    total: Optional[pd.DataFrame] = None
+    weight_sum: Optional[pd.DataFrame] = None
+    for name, weight in weights.items():
+        frame: pd.DataFrame = panel_rows(fe.factor_config().table, name, dates, root)\
+            .pivot(index='trade_date', columns='ts_code', values=name)
+        total = frame * weight if total is None else total.add(frame * weight, fill_value=0)
+        present: pd.DataFrame = frame.notnull() * abs(weight)
+        weight_sum = present if weight_sum is None else weight_sum.add(present, fill_value=0)
+    return total / weight_sum.where(weight_sum > 0)
+
+
+def run_cells(sample_cfg: sample.Sample_config, cells: List[Tuple[Text, Dict[Text, float]]],
+              backtest_cfg: bt.Backtest_config) -> List[Tuple[Text, pd.DataFrame]]:
+    """ 在工作进程中运行同一个Sample_config下的若干(key, 因子权重)组合，样本池只构建一次
+    """
+    rtn: List[Tuple[Text, pd.DataFrame]] = []
+    for key, weights in cells:
+        try:
+            pool: Dict = worker_pool(sample_cfg)
+            scores: pd.DataFrame = combined_score(weights, list(pool.keys()), _market.root)
+            rtn.append((key, bt.run_backtest(pool, scores, _market.returns, backtest_cfg).summary))
+        except Exception as e:
+            print(sample_cfg, weights, e)
+    return rtn
+
+
+def run_group(args: Tuple) -> List[Tuple[Text, pd.DataFrame]]:
+    # args: (Sample_config, [(key, 因子权重)], Backtest_config)
+    return run_cells(*args)
+
+
+def imp_create_result_table(cfg: Sweep_config) -> Any:
+    dba.imp_db(cfg.db_path).write(f'''CREATE TABLE IF NOT EXISTS {cfg.tbl_result} (key TEXT, bucket TEXT,
+        sample_config TEXT, weights TEXT, {', '.join(f'{m} REAL' for m in METRICS)}, finished_at TEXT,
+        PRIMARY KEY (key, bucket))''', wait=True)
+
+
+def imp_finished_keys(cfg: Sweep_config) -> set:
+    return {row[0] for row in dba.imp_db(cfg.db_path).execute(f'SELECT DISTINCT key FROM {cfg.tbl_result}')}
+
+
+def imp_persist_result(cell: Cell, summary: pd.DataFrame, cfg: Sweep_config) -> Any:
+    stamp: Text = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    rows: List[Tuple] = [(cell.key, bucket, json.dumps(cell.sample_cfg._asdict()), json.dumps(cell.weights),
+                          *[None if pd.isnull(r[m]) else float(r[m]) for m in METRICS], stamp)
+                         for bucket, r in summary.iterrows()]
+    dba.imp_db(cfg.db_path).write_many(f"INSERT OR REPLACE INTO {cfg.tbl_result} VALUES \
+                                       ({','.join('?' * (len(METRICS) + 5))})", rows)
+
+
+def imp_prepare_market(root: Optional[Text] = None, cfg: Optional[Sweep_config] = None,
+                       cells: Optional[List[Cell]] = None) -> Market:
+    """ 主进程中准备一次共享数据：累计收益矩阵写成.npy文件，其余小表直接读入
+
+    交易日历和基准指数市值取cells中最早的start_date到最晚的end_date，缺省为sample_config()的日期范围
+    """
+    cfg = cfg or sweep_config()
+    bt.imp_save_returns(bt.imp_load_returns(root), cfg.returns_dir)
+    sample_cfgs: List[sample.Sample_config] = [cell.sample_cfg for cell in cells or []] or [sample.sample_config()]
+    start, end = min(s.start_date for s in sample_cfgs), max(s.end_date for s in sample_cfgs)
+    trade_cal: List[Tuple] = [tuple(r) for r in td.imp_get_trade_cal(start, end)]
+    # 按交易日请求，分段结果中缺少的交易日会补取
+    open_days: List[Text] = [r[1] for r in trade_cal if r[2] == 1] or [start, end]
+    return Market(root=root, returns=cfg.returns_dir,
+                  master=sm.imp_security_master(sm.master_config(root)),
+                  index_mv=sample.imp_get_index_total_mv_by_tushare(open_days), trade_cal=trade_cal)
+
+
+def imp_run_sweep(cells: List[Cell], market: Market, cfg: Optional[Sweep_config] = None) -> Iterator[Cell]:
+    """ 跳过结果表中已有的组合，其余按Sample_config分组后交给进程池，完成一组写入一组
+    """
+    cfg = cfg or sweep_config()
+    cal_dates: List[Text] = [r[1] for r in market.trade_cal]
+    first, last = (min(cal_dates), max(cal_dates)) if len(cal_dates) > 0 else ('', '')
+    outside: List[Cell] = [cell for cell in cells
+                           if cell.sample_cfg.start_date < first or cell.sample_cfg.end_date > last]
+    if len(outside) > 0:
+        raise ValueError(f'{len(outside)}个组合的日期范围超出了共享数据的交易日历{first}-{last}，'
+                         f'请用imp_prepare_market(cells=...)准备')
+    imp_create_result_table(cfg)
+    finished: set = imp_finished_keys(cfg)
+    groups: Dict[sample.Sample_config, List[Cell]] = {}
+    for cell in cells:
+        if cell.key not in finished:
+            groups.setdefault(cell.sample_cfg, []).append(cell)
+    print(f'共{len(cells)}个组合，已完成{len(cells) - sum(map(len, groups.values()))}个，待运行{len(groups)}组')
+
+    by_key: Dict[Text, Cell] = {cell.key: cell for cell in cells}
+    tasks: List[Tuple] = [(sample_cfg, [(cell.key, cell.weights) for cell in group], cfg.backtest)
+                          for sample_cfg, group in groups.items()]
+    with multiprocessing.Pool(cfg.workers, initializer=imp_init_worker, initargs=(market,)) as pool:
+        for results in pool.imap_unordered(run_group, tasks):
+            for key, summary in results:
+                imp_persist_result(by_key[key], summary, cfg)
+                yield by_key[key]
+            dba.imp_db(cfg.db_path).flush()
+
+
+def imp_get_results(cfg: Optional[Sweep_config] = None) -> pd.DataFrame:
+    cfg = cfg or sweep_config()
+    return dba.imp_db(cfg.db_path).read_frame(f'SELECT * FROM {cfg.tbl_result}')
+
+
+if __name__ == '__main__':
+    sweep: List[Cell] = sweep_cells({'low_market_to_base_index': [1 / 100, 1 / 50, 1 / 20],
+                                     'list_years': [1, 2, 3],
+                                     'updated_date1': ['0430', '0501'], 'updated_date2': ['1031', '0831']},
+                                    [{'z_momentum_12_1': 1.0}, {'z_reversal_20': 1.0}, {'z_ep': 1.0, 'z_bp': 1.0},
+                                     {'z_ep': 1.0, 'z_size': -1.0}, {'z_volatility_20': -1.0, 'z_turnover_20': -1.0}])
+    for finished_cell in imp_run_sweep(sweep, imp_prepare_market(cells=sweep)):
+        print(finished_cell.sample_cfg, finished_cell.weights)
@@ -0,0 +1,375 @@
+""" 增量同步任务规划
+一次分组查询取得每只股票在数据库中的覆盖范围，与交易日历和上市、退市日期比较，生成补齐内部缺口和延伸尾部所需的
+最少下载任务。已经下载过但服务器没有数据的区间（例如停牌）记在fetch_log表中，不会被反复下载。
+"""
+from typing import Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, List, Iterable, Iterator
+from collections import namedtuple
+from functools import partial
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from src import db_access as dba
+from src import tushare_data as td
+from src import access_scheduler as sch
+
+Fetch_task: NamedTuple = namedtuple('Fetch_task', 'tbl_name, code, start_date, end_date')
+Sync_config: NamedTuple = namedtuple('Sync_config', 'merge_within, in_clause_size, tbl_fetch_log, tbl_fetch_error, \
+                                     rows_per_call, index_codes, publish_lag_days')
+Run = Tuple[int, int]  # 日历数组中的左闭右开位置区间
+
+
+def sync_config() -> Sync_config:
+    # rows_per_call: 支持按日期截面下载的表，按股票下载时单次访问最多返回的行数。财务报表按股票下载时一次访问返回
+    # 整个区间，按公告日期截面用vip接口下载，夜间同步只需取新的公告日，不必每家公司访问一次
+    # tbl_fetch_error: 下载、清洗或写入失败的任务，任务以后成功写入时删除; index_codes: 同步的指数
+    # publish_lag_days: 最近这些自然日的数据可能还没有发布，服务器返回空数据时不记入fetch_log
+    return Sync_config(merge_within=5, in_clause_size=500, tbl_fetch_log='fetch_log', tbl_fetch_error='fetch_error',
+                       rows_per_call={td.db_config().tbl_daily_trading_data: 5000,
+                                      td.db_config().tbl_daily_basic: 5000,
+                                      td.db_config().tbl_adj_factor: 5000,
+                                      **{tbl: 10 ** 6 for tbl in statement_tables()}},
+                       index_codes=('399300.SZ',), publish_lag_days=3)
+
+
+def trade_date_tables() -> Tuple:
+    return td.db_config().tbl_daily_trading_data, td.db_config().tbl_daily_basic, td.db_config().tbl_index, \
+           td.db_config().tbl_adj_factor
+
+
+def statement_tables() -> Tuple:
+    return td.db_config().tbl_balance_sheet, td.db_config().tbl_income_statement, \
+           td.db_config().tbl_cash_flow_statement, td.db_config().tbl_finance_indicator_statement
+
+
+def coverage_field(tbl_name: Text) -> Optional[Text]:
+    # tushare财务报表接口的start_date/end_date参数按公告日期过滤
+    if tbl_name in trade_date_tables():
+        return 'trade_date'
+    return 'ann_date' if tbl_name in statement_tables() else None
+
+
+def calendar_days(trade_cal_iter: Iterable[NamedTuple], only_open: bool = True) -> np.ndarray:
+    return np.array(sorted(int(r.cal_date) for r in trade_cal_iter if only_open is False or r.is_open == 1),
+                    dtype=np.int64)
+
+
+def listing_windows(companies: pd.DataFrame, start: int, end: int) -> pd.DataFrame:
+    list_date: pd.Series = companies['list_date'].fillna(start).astype(np.int64).clip(lower=start)
+    delist_date: pd.Series = companies['delist_date'].fillna(end).astype(np.int64).clip(upper=end)
+    return pd.DataFrame({'lo': list_date.values, 'hi': delist_date.values}, index=companies['ts_code'].values)
+
+
+def positions_to_runs(positions: np.ndarray) -> List[Run]:
+    if len(positions) == 0:
+        return []
+    breaks: np.ndarray = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts: np.ndarray = np.concatenate([positions[:1], positions[breaks]])
+    ends: np.ndarray = np.concatenate([positions[breaks - 1], positions[-1:]]) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def subtract_runs(runs: List[Run], covered: List[Run]) -> List[Run]:
+    """ 从runs中去掉covered覆盖的部分，按起点顺序返回；covered排序合并一次后与runs一起线性扫描
+    """
+    merged: List[Run] = merge_runs([(c, d) for c, d in covered if c < d], 0)
+    rtn: List[Run] = []
+    j: int = 0
+    for a, b in sorted(runs):
+        # runs按起点排序，结束于当前起点之前的覆盖区间以后也用不到
+        while j < len(merged) and merged[j][1] <= a:
+            j += 1
+        k: int = j
+        while k < len(merged) and merged[k][0] < b:
+            if a < merged[k][0]:
+                rtn.append((a, merged[k][0]))
+            a = max(a, merged[k][1])
+            k += 1
+        if a < b:
+            rtn.append((a, b))
+    return rtn
+
+
+def merge_runs(runs: List[Run], merge_within: int) -> List[Run]:
+    """ 相隔不超过merge_within个日历位置的缺口合并成一次下载，多下载几天数据换取更少的访问次数
+    """
+    merged: List[Run] = []
+    for a, b in sorted(runs):
+        if len(merged) > 0 and a - merged[-1][1] <= merge_within:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+
+
+def missing_runs(days: np.ndarray, lo: int, hi: int, coverage: Optional[NamedTuple],
+                 present_dates: Optional[np.ndarray], interior_gaps: bool) -> List[Run]:
+    i_lo, i_hi = int(np.searchsorted(days, lo, 'left')), int(np.searchsorted(days, hi, 'right'))
+    if i_lo >= i_hi:
+        return []
+    if coverage is None:
+        return [(i_lo, i_hi)]
+    if present_dates is not None:
+        present_pos: np.ndarray = np.searchsorted(days, present_dates, 'left')
+        return positions_to_runs(np.setdiff1d(np.arange(i_lo, i_hi), present_pos))
+
+    i_first = int(np.searchsorted(days, coverage.first_date, 'left'))
+    i_last = int(np.searchsorted(days, coverage.last_date, 'right'))
+    runs: List[Run] = [(max(i_last, i_lo), i_hi)]
+    if interior_gaps is True:
+        runs.append((i_lo, min(i_first, i_hi)))
+    return [r for r in runs if r[0] < r[1]]
+
+
+def has_interior_gap(days: np.ndarray, coverage: NamedTuple) -> bool:
+    expected: int = int(np.searchsorted(days, coverage.last_date, 'right')
+                        - np.searchsorted(days, coverage.first_date, 'left'))
+    return coverage.rows < expected
+
+
+def find_gaps(tbl_name: Text,
+              days: np.ndarray,
+              windows: pd.DataFrame,
+              coverage: pd.DataFrame,
+              get_present_dates: Callable[[List[Text]], pd.DataFrame],
+              fetch_log: pd.DataFrame) -> Dict[Text, List[Run]]:
+    """ 找出每只股票缺失的日历区间
+
+    days: 升序的日历数组（交易表为交易日，财务报表为自然日），整数形式的日期
+    windows: 以ts_code为索引，lo、hi为该股票应有数据的起止日期
+    coverage: 以ts_code为索引，first_date、last_date、rows为数据库中已有数据的范围和行数
+    get_present_dates: 一次取得多只股票已有的全部日期，返回ts_code、date两列
+    fetch_log: 已经完成的下载任务，ts_code、start_date、end_date三列，ts_code为''的是按日期截面下载的任务
+    """
+    def logged_runs(log: pd.DataFrame) -> List[Run]:
+        return list(zip(np.searchsorted(days, log['start_date'].values, 'left').tolist(),
+                        np.searchsorted(days, log['end_date'].values, 'right').tolist()))
+
+    interior_gaps: bool = tbl_name in trade_date_tables()
+    # 早先的记录中按日期截面下载的ts_code为NULL
+    by_date: np.ndarray = (fetch_log['ts_code'].isnull() | (fetch_log['ts_code'] == '')).values
+    covered: Dict[Text, List[Run]] = {code: logged_runs(log) for code, log in fetch_log[~by_date].groupby('ts_code')}
+    covered_by_date: List[Run] = logged_runs(fetch_log[by_date])
+    coverage_of: Dict[Text, NamedTuple] = {r.Index: r for r in coverage.itertuples()}
+
+    gap_codes: List[Text] = [code for code in windows.index
+                             if interior_gaps is True and code in coverage_of
+                             and has_interior_gap(days, coverage_of[code])]
+    present: Dict[Text, np.ndarray] = {code: df['date'].values.astype(np.int64)
+                                       for code, df in get_present_dates(gap_codes).groupby('ts_code')} \
+        if len(gap_codes) > 0 else {}
+
+    gaps: Dict[Text, List[Run]] = {}
+    for code, lo, hi in windows[['lo', 'hi']].itertuples():
+        runs: List[Run] = missing_runs(days, lo, hi, coverage_of.get(code), present.get(code), interior_gaps)
+        runs = subtract_runs(runs, covered.get(code, []) + covered_by_date) if len(runs) > 0 else runs
+        if len(runs) > 0:
+            gaps[code] = runs
+    return gaps
+
+
+def code_axis_calls(runs: List[Run], rows_per_call: int) -> int:
+    return sum(-(-(b - a) // rows_per_call) for a, b in runs)
+
+
+def code_axis_tasks(tbl_name: Text, days: np.ndarray, gaps: Dict[Text, List[Run]],
+                    merge_within: int) -> List[Fetch_task]:
+    return [Fetch_task(tbl_name, code, str(days[a]), str(days[b - 1]))
+            for code, runs in gaps.items() for a, b in merge_runs(runs, merge_within)]
+
+
+def date_axis_positions(days: np.ndarray, gaps: Dict[Text, List[Run]], merge_within: int,
+                        rows_per_call: int) -> np.ndarray:
+    """ 估算每个交易日按股票下载分摊到的访问次数，合计不少于1次的交易日改为按日期截面下载更省
+
+    按股票下载一个长度为n的缺口需要ceil(n/rows_per_call)次访问，平均到缺口内的每一天；按日期下载一天只需1次访问
+    """
+    weight: np.ndarray = np.zeros(len(days) + 1)
+    for runs in gaps.values():
+        for a, b in merge_runs(runs, merge_within):
+            w: float = -(-(b - a) // rows_per_call) / (b - a)
+            weight[a] += w
+            weight[b] -= w
+    return np.flatnonzero(np.cumsum(weight)[:-1] >= 1.0 - 1e-9)
+
+
+def plan_sync_tasks(tbl_name: Text,
+                    days: np.ndarray,
+                    gaps: Dict[Text, List[Run]],
+                    merge_within: int,
+                    rows_per_call: Optional[int] = None) -> List[Fetch_task]:
+    """ 把缺口转换成下载任务；rows_per_call不为None的表支持按日期截面下载，对每个缺口选择访问次数更少的方式
+    """
+    by_code: List[Fetch_task] = code_axis_tasks(tbl_name, days, gaps, merge_within)
+    if rows_per_call is None or len(gaps) == 0:
+        return by_code
+
+    date_pos: np.ndarray = date_axis_positions(days, gaps, merge_within, rows_per_call)
+    date_runs: List[Run] = positions_to_runs(date_pos)
+    rest: Dict[Text, List[Run]] = {code: subtract_runs(runs, date_runs) for code, runs in gaps.items()}
+    mixed: List[Fetch_task] = [Fetch_task(tbl_name, None, str(d), str(d)) for d in days[date_pos]] + \
+        code_axis_tasks(tbl_name, days, {code: runs for code, runs in rest.items() if len(runs) > 0}, merge_within)
+
+    # 整表比较两种方式的估算访问次数
+    code_calls: int = sum(code_axis_calls(merge_runs(runs, merge_within), rows_per_call) for runs in gaps.values())
+    mixed_calls: int = len(date_pos) + sum(code_axis_calls(merge_runs(runs, merge_within), rows_per_call)
+                                           for runs in rest.values())
+    return mixed if mixed_calls < code_calls else by_code
+
+
+def imp_create_fetch_log() -> Any:
+    td.imp_create_sqlite_table(sync_config().tbl_fetch_log,
+                               'tbl_name, ts_code, start_date, end_date, fetched_at, \
+                               PRIMARY KEY (tbl_name, ts_code, start_date, end_date)')
+    # 主键中的NULL互不相等，INSERT OR IGNORE不能去重；按日期截面下载的任务ts_code记为''，早先的记录一并改正
+    access: dba.Db_access = dba.imp_db(td.db_config().db_path)
+    access.write(f"UPDATE OR IGNORE {sync_config().tbl_fetch_log} SET ts_code='' WHERE ts_code IS NULL")
+    access.write(f"DELETE FROM {sync_config().tbl_fetch_log} WHERE ts_code IS NULL", wait=True)
+
+
+def imp_get_fetch_log(tbl_name: Text) -> pd.DataFrame:
+    imp_create_fetch_log()
+    df: Optional[pd.DataFrame] = td.imp_get_records_from_db(f"SELECT ts_code, start_date, end_date FROM \
+                                                             {sync_config().tbl_fetch_log} WHERE tbl_name=?",
+                                                             (tbl_name,))
+    if df is None or df.empty is True:
+        return pd.DataFrame(columns=['ts_code', 'start_date', 'end_date'])
+    return df.astype({'start_date': np.int64, 'end_date': np.int64})
+
+
+def fetch_log_statements(task: Tuple, log_task: bool = True) -> List[Tuple]:
+    """ 记录任务已经下载、清除以前失败记录的(sql, 参数)；按日期截面下载的任务ts_code记为''
+    """
+    key: Tuple = (task[0], task[1] or '', task[2], task[3])
+    return ([(f'INSERT OR IGNORE INTO {sync_config().tbl_fetch_log} VALUES (?, ?, ?, ?, ?)',
+              key + (datetime.datetime.now().strftime('%Y%m%d%H%M%S'),))] if log_task is True else []) + \
+        [(f'DELETE FROM {sync_config().tbl_fetch_error} WHERE tbl_name=? AND ts_code=? AND start_date=? \
+          AND end_date=?', key)]
+
+
+def final_empty_task(task: Tuple, today: datetime.date) -> Optional[Tuple]:
+    """ 服务器没有数据的任务中可以确定没有数据的部分，即发布延迟之前的区间；没有这样的部分时返回None
+    """
+    cutoff: int = int((today - datetime.timedelta(days=sync_config().publish_lag_days)).strftime('%Y%m%d'))
+    if int(task[2]) > cutoff:
+        return None
+    return task[0], task[1], task[2], str(min(int(task[3]), cutoff))
+
+
+def imp_log_empty_task(task: Tuple) -> Any:
+    """ 停牌、没有公告等确定没有数据的区间记入fetch_log，以后不再下载；最近的交易日可能只是数据还没有发布，
+    不做记录，下次同步重新下载
+    """
+    final: Optional[Tuple] = final_empty_task(task, datetime.date.today())
+    statements: List[Tuple] = (fetch_log_statements(final)[:1] if final is not None else []) + \
+        fetch_log_statements(task, log_task=False)
+    for sql, params in statements:
+        dba.imp_db(td.db_config().db_path).write(sql, params)
+
+
+def imp_create_fetch_error() -> Any:
+    td.imp_create_sqlite_table(sync_config().tbl_fetch_error,
+                               'tbl_name, ts_code, start_date, end_date, stage, error, failed_at, \
+                               PRIMARY KEY (tbl_name, ts_code, start_date, end_date)')
+    access: dba.Db_access = dba.imp_db(td.db_config().db_path)
+    access.write(f"UPDATE OR IGNORE {sync_config().tbl_fetch_error} SET ts_code='' WHERE ts_code IS NULL")
+    access.write(f"DELETE FROM {sync_config().tbl_fetch_error} WHERE ts_code IS NULL", wait=True)
+
+
+def imp_log_failed_tasks(failures: List[Tuple]) -> Any:
+    """ failures为(task, 阶段名, 错误)；失败的任务没有下载记录，下次同步会重新规划，这里记下失败的原因
+    """
+    imp_create_fetch_error()
+    now: Text = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    rows: List[Tuple] = [(task[0], task[1] or '', task[2], task[3], stage, str(e), now)
+                         for task, stage, e in failures if task is not None]
+    if len(rows) > 0:
+        td.imp_persist_data(rows, sync_config().tbl_fetch_error)
+    td.imp_flush_db()
+    if len(failures) > 0:
+        print(f'{len(failures)}个任务失败，见{sync_config().tbl_fetch_error}表')
+
+
+def imp_get_fetch_errors(tbl_name: Optional[Text] = None) -> pd.DataFrame:
+    imp_create_fetch_error()
+    return td.imp_get_records_from_db(f"SELECT * FROM {sync_config().tbl_fetch_error} \
+                                      {'WHERE tbl_name=?' if tbl_name else ''}", (tbl_name,) if tbl_name else ())
+
+
+def imp_get_present_dates(tbl_name: Text, field_name: Text, codes: List[Text]) -> pd.DataFrame:
+    size: int = sync_config().in_clause_size
+    chunks: Iterator[pd.DataFrame] = (td.imp_get_records_from_db(
+        f"SELECT ts_code, {field_name} AS date FROM {tbl_name} WHERE ts_code IN \
+        ({','.join('?' * len(codes[i:i + size]))})", tuple(codes[i:i + size])) for i in range(0, len(codes), size))
+    return pd.concat([df for df in chunks if df is not None and df.empty is False] +
+                     [pd.DataFrame(columns=['ts_code', 'date'])], ignore_index=True)
+
+
+def imp_plan_sync_tasks(tbl_name: Text,
+                        start_date: Optional[Text] = None,
+                        end_date: Optional[Text] = None,
+                        codes: Optional[List[Text]] = None) -> List[Fetch_task]:
+    start: Text = start_date or td.sampling_config().start_date
+    end: Text = end_date or td.sampling_config().end_date
+    field_name: Optional[Text] = coverage_field(tbl_name)
+    days: np.ndarray = calendar_days(td.imp_get_trade_cal(start, end), only_open=tbl_name in trade_date_tables())
+
+    # 指数不在股票列表中，按指数代码同步
+    companies: pd.DataFrame = td.download_list_companies() if tbl_name != td.db_config().tbl_index \
+        else pd.DataFrame({'ts_code': list(codes or sync_config().index_codes), 'list_date': None, 'delist_date': None})
+    if codes is not None:
+        companies = companies[companies['ts_code'].isin(codes)]
+        companies = pd.concat([companies, pd.DataFrame({'ts_code': [c for c in codes
+                                                                    if c not in set(companies['ts_code'])]})],
+                              ignore_index=True, sort=False)
+    windows: pd.DataFrame = listing_windows(companies, int(start), int(end))
+
+    if field_name is None:
+        coverage: pd.DataFrame = pd.DataFrame(columns=['first_date', 'last_date', 'rows'])
+        known: Optional[pd.DataFrame] = td.imp_get_records_from_db(f'SELECT DISTINCT ts_code FROM {tbl_name}')
+        windows = windows[~windows.index.isin(known['ts_code'] if known is not None and known.empty is False else [])]
+        # 没有日期维度的表只按股票下载一次
+        days = np.array([int(start), int(end)], dtype=np.int64)
+        windows = pd.DataFrame({'lo': int(start), 'hi': int(end)}, index=windows.index)
+    else:
+        coverage = td.imp_get_coverage_in_db(tbl_name, field_name)
+
+    gaps: Dict[Text, List[Run]] = find_gaps(tbl_name, days, windows, coverage,
+                                            partial(imp_get_present_dates, tbl_name, field_name),
+                                            imp_get_fetch_log(tbl_name))
+    return plan_sync_tasks(tbl_name, days, gaps, sync_config().merge_within,
+                           sync_config().rows_per_call.get(tbl_name))
+
+
+# persist a planned task after it is fetched, cleaned and transferred
+def persist_task(cleaned: Tuple, persistence: Callable[..., Any], failures: List[Tuple]) -> Any:
+    task, batch = cleaned
+    if batch is None:
+        imp_log_empty_task(task)
+        return
+    # 下载记录与数据在同一个保存点中提交，写入失败时不留下记录，下次同步重新下载
+    persistence(batch, task[0], after=fetch_log_statements(task),
+                on_error=lambda e: failures.append((task, 'persist', e)))
+
+
+def imp_sync_table(tbl_name: Text,
+                   access_per_minute: int = 80,
+                   end_date: Optional[Text] = None,
+                   getter: Callable[[Tuple], Any] = td.imp_get_data_from_tushare,
+                   persistence: Callable[..., Any] = td.imp_persist_data) -> Any:
+    """ persistence除数据和表名外还接收after和on_error，见tushare_data.imp_persist_data
+    """
+    tasks: List[Fetch_task] = imp_plan_sync_tasks(tbl_name, end_date=end_date)
+    by_date: int = len([t for t in tasks if t.code is None])
+    print(f'{tbl_name}: {len(tasks)}个下载任务，其中按日期截面{by_date}个，按股票{len(tasks) - by_date}个')
+    quota: sch.Quota = sch.tushare_quota(td.tbl_endpoint()[tbl_name], access_per_minute)
+    failures: List[Tuple] = []
+    imp_create_fetch_error()
+    stats: List[Dict] = td.imp_run_gctp_pipeline(
+        tasks, getter, partial(persist_task, persistence=persistence, failures=failures), quota,
+        on_error=lambda task, stage, e: failures.append((task, stage, e)))
+    # 等写线程处理完，写入失败的任务都已经交给on_error
+    td.imp_flush_db()
+    imp_log_failed_tasks(failures)
+    return stats
@@ -1,21 +1,28 @@
 """ 下载tushare提供的股票数据
 """
-from typing import List, Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, Iterator
-from functools import reduce, lru_cache
+from typing import List, Any, Text, NamedTuple, Tuple, Optional, Callable, Dict, Iterator, Iterable, Sequence
+from functools import reduce, partial, lru_cache
 import sqlite3
 from collections import namedtuple
-import time
 import datetime
+import os
 
 import tushare as ts
 import pandas as pd
 
 from src import config
-
-Sampling_config: NamedTuple = namedtuple('sampling_config', 'start_date, end_date')
-DB_config: NamedTuple = namedtuple('db_config', "db_path, tbl_daily_trading_data, tbl_balance_sheet, \
+from src import access_scheduler as sch
+from src import db_access as dba
+from src import pipeline as pl
+from src import response_cache as rc
+from src import schema as sc
+
+Sampling_config: NamedTuple = namedtuple('Sampling_config', 'start_date, end_date')
+DB_config: NamedTuple = namedtuple('DB_config', "db_path, tbl_daily_trading_data, tbl_balance_sheet, \
         tbl_income_statement, tbl_cash_flow_statement, tbl_finance_indicator_statement, tbl_daily_basic, \
-        tbl_index, tbl_name_history")
+        tbl_index, tbl_name_history, tbl_adj_factor")
+# 待写入的一批数据：列名和与之对应的列数组
+Column_batch: NamedTuple = namedtuple('Column_batch', 'columns, arrays')
 
 
 def sampling_config() -> Sampling_config:
@@ -23,7 +30,7 @@ def sampling_config() -> Sampling_config:
 
 
 def db_config() -> DB_config:
-    return DB_config(db_path='..\\data\\a_data.db',
+    return DB_config(db_path=os.path.join(dba.data_dir(), 'a_data.db'),
                      tbl_daily_trading_data='daily_trading_data',
                      tbl_balance_sheet='balance_sheet',
                      tbl_income_statement='income_statement',
@@ -31,67 +38,98 @@ def db_config() -> DB_config:
                      tbl_finance_indicator_statement='finance_indicator',
                      tbl_daily_basic='daily_basic',
                      tbl_index='securities_index',
-                     tbl_name_history='name_history')
+                     tbl_name_history='name_history',
+                     tbl_adj_factor='adj_factor')
+
+
+def schemas() -> Dict[Text, sc.Table_schema]:
+    return sc.table_schemas(db_config())
+
+
+def request_fields(tbl_name: Text) -> Text:
+    # 按登记的列向接口请求字段，接口默认返回的字段以后增减时不影响入库
+    return ','.join(sc.column_names(schemas()[tbl_name]))
+
 
+def conform_data(data: pd.DataFrame, tbl_name: Text) -> pd.DataFrame:
+    schema: Optional[sc.Table_schema] = schemas().get(tbl_name)
+    return sc.conform(data, schema) if schema is not None else data
 
-@lru_cache(128)
-def download_list_companies(call_date: datetime.datetime = datetime.datetime.now()) -> pd.DataFrame:
-    download = lambda status: ts.pro_api(config.tushare_token).\
-        stock_basic(exchange='', list_status=status, fields='ts_code, symbol,name,area,industry,list_date, delist_date')
+
+def download_list_companies() -> pd.DataFrame:
+    # 进程内按自然日和缓存目录保留一份，同一天内反复调用不再读缓存和反序列化
+    return memo_list_companies(datetime.date.today().isoformat(), rc.cache_config().root)
+
+
+@lru_cache(4)
+def memo_list_companies(call_date: Text, cache_root: Text) -> pd.DataFrame:
+    # 经过本地缓存，缓存有效期见response_cache.cache_config
+    download = lambda status: rc.cached_pro_api('stock_basic')(
+        exchange='', list_status=status, fields='ts_code, symbol,name,area,industry,list_date, delist_date')
     list_companies = [download(s) for s in ['L', 'D', 'P']]
-    return reduce(lambda x, y: x.append(y, ignore_index=True), list_companies)
+    return pd.concat(list_companies, ignore_index=True)
 
 
 def imp_create_sqlite_table(table_name: Text, column_def: Text) -> Any:
-    conn = sqlite3.connect('..\\data\\a_data.db')
-    c = conn.cursor()
-    c.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} ({column_def})''')
-    conn.commit()
-    conn.close()
+    dba.imp_db(db_config().db_path).write(f'''CREATE TABLE IF NOT EXISTS {table_name} ({column_def})''', wait=True)
 
 
 def imp_get_extreme_value_in_db(table_name: Text, field_name: Text, code: Text) -> Tuple:
     trading_date_range: Tuple = (None,)
-    conn = sqlite3.connect(db_config().db_path)
-    c = conn.cursor()
     try:
-        c.execute(f"SELECT MIN({field_name}), MAX({field_name}) FROM {table_name} WHERE ts_code='{code}'")
-        trading_date_range = c.fetchone()
+        trading_date_range = dba.imp_db(db_config().db_path).execute(
+            f"SELECT MIN({field_name}), MAX({field_name}) FROM {table_name} WHERE ts_code=?", (code,))[0]
     except sqlite3.Error as e:
         print(e)
-    finally:
-        c.close()
-        conn.close()
     return trading_date_range
 
 
-def imp_get_records_from_db(sql_str: Text) -> Optional[pd.DataFrame]:
-    conn = sqlite3.connect(db_config().db_path)
-    c = conn.cursor()
-    records = None
-    names = None
+def imp_get_coverage_in_db(table_name: Text, field_name: Text) -> pd.DataFrame:
+    """ 一次分组查询取得每只股票的最早、最晚日期和行数，以ts_code为索引
+    """
+    df: Optional[pd.DataFrame] = imp_get_records_from_db(f"SELECT ts_code, MIN({field_name}) AS first_date, \
+                                                          MAX({field_name}) AS last_date, COUNT(*) AS rows \
+                                                          FROM {table_name} GROUP BY ts_code")
+    if df is None or df.empty is True:
+        return pd.DataFrame(columns=['first_date', 'last_date', 'rows'])
+    return df.set_index('ts_code').astype('int64')
+
+
+def imp_get_records_from_db(sql_str: Text, params: Tuple = (),
+                            columns: Optional[List[Text]] = None) -> Optional[pd.DataFrame]:
     try:
-        c.execute(sql_str)
-        names = [description[0] for description in c.description]
-        records = c.fetchall()
+        return dba.imp_db(db_config().db_path).read_frame(sql_str, params, columns)
     except sqlite3.Error as e:
         print(e)
-    finally:
-        c.close()
-        conn.close()
-    return db_tuples_to_dataframe(records, names) if names is not None else None
+    return None
+
 
+def imp_iter_records_from_db(sql_str: Text, params: Tuple = (),
+                             chunk_rows: Optional[int] = None,
+                             columns: Optional[List[Text]] = None,
+                             dtypes: Optional[Dict[Text, Any]] = None) -> Iterator[pd.DataFrame]:
+    """ 分批读取查询结果，每批最多chunk_rows行，用于全表扫描；dtypes以外的列按第一批数据确定类型
+    """
+    return dba.imp_db(db_config().db_path).iter_frames(sql_str, params, chunk_rows, columns, dtypes)
 
-def db_tuples_to_dataframe(data: List[Tuple], names: List[Text]) -> pd.DataFrame:
-    SQLiteTable = namedtuple('sqlitetable', names)
-    return pd.DataFrame([SQLiteTable(*d) for d in data])
+
+def imp_scan_table(tbl_name: Text,
+                   columns: Optional[List[Text]] = None,
+                   where: Text = '',
+                   params: Tuple = (),
+                   chunk_rows: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    select: Text = ', '.join(columns) if columns is not None else '*'
+    # 登记过的表按声明的类型读取，每一批的列类型相同
+    dtypes: Optional[Dict[Text, Any]] = sc.column_dtypes(schemas()[tbl_name]) if tbl_name in schemas() else None
+    return imp_iter_records_from_db(f"SELECT {select} FROM {tbl_name} {'WHERE ' + where if where else ''}", params,
+                                    chunk_rows, dtypes=dtypes)
 
 
 def create_gctp_task(code: Text, tbl_name: Text) -> Optional[Tuple]:
     task: Optional[Tuple] = None
     field_name: Text = 'trade_date' \
         if tbl_name == db_config().tbl_daily_trading_data or tbl_name == db_config().tbl_daily_basic \
-           or tbl_name == db_config().tbl_index \
+           or tbl_name == db_config().tbl_index or tbl_name == db_config().tbl_adj_factor \
         else 'end_date'
     trading_date_range: Tuple = imp_get_extreme_value_in_db(tbl_name, field_name, code)
 
@@ -104,27 +142,51 @@ def create_gctp_task(code: Text, tbl_name: Text) -> Optional[Tuple]:
 def imp_get_data_from_tushare(task: Tuple) -> Optional[pd.DataFrame]:
     if task is None:
         return None
+    if task[1] is None:
+        return imp_get_data_by_trade_date_from_tushare(task)
 
     ts.set_token(config.tushare_token)
+    # 日交易数据保存未复权价格，复权价格由adj_factor表在读取时计算，见adjust
     func: Dict = {db_config().tbl_finance_indicator_statement: ts.pro_api().fina_indicator,
                   db_config().tbl_income_statement: ts.pro_api().income,
                   db_config().tbl_balance_sheet: ts.pro_api().balancesheet,
                   db_config().tbl_cash_flow_statement: ts.pro_api().cashflow,
-                  db_config().tbl_daily_basic: ts.pro_api().daily_basic}
+                  db_config().tbl_daily_basic: ts.pro_api().daily_basic,
+                  db_config().tbl_daily_trading_data: ts.pro_api().daily,
+                  db_config().tbl_adj_factor: ts.pro_api().adj_factor}
 
     tbl_name = task[0]
     if tbl_name in func:
-        return func[tbl_name](ts_code=task[1], start_date=task[2], end_date=task[3])
-    elif tbl_name == db_config().tbl_daily_trading_data:
-        return ts.pro_bar(ts_code=task[1], start_date=task[2], end_date=task[3], adj='qfq')
+        return func[tbl_name](ts_code=task[1], start_date=task[2], end_date=task[3], fields=request_fields(tbl_name))
     elif tbl_name == db_config().tbl_name_history:
         return ts.pro_api().namechange(ts_code=task[1])
+    elif tbl_name == db_config().tbl_index:
+        return imp_get_trade_data_from_tushare(task)
     else:
         return None
 
 
+def imp_get_data_by_trade_date_from_tushare(task: Tuple) -> Optional[pd.DataFrame]:
+    """ 按日期截面下载，task为(tbl_name, None, date, date)，一次访问返回全市场当日数据
+
+    交易表按交易日取全市场当日数据；财务报表用vip接口按公告日期取当日公告的全部报表
+    """
+    ts.set_token(config.tushare_token)
+    # daily接口返回未复权价格，与按股票下载(imp_get_data_from_tushare)相同，表中只有一种价格口径
+    func: Dict = {db_config().tbl_daily_trading_data: ts.pro_api().daily,
+                  db_config().tbl_daily_basic: ts.pro_api().daily_basic,
+                  db_config().tbl_adj_factor: ts.pro_api().adj_factor}
+    by_ann_date: Dict = {db_config().tbl_finance_indicator_statement: ts.pro_api().fina_indicator_vip,
+                         db_config().tbl_income_statement: ts.pro_api().income_vip,
+                         db_config().tbl_balance_sheet: ts.pro_api().balancesheet_vip,
+                         db_config().tbl_cash_flow_statement: ts.pro_api().cashflow_vip}
+    if task[0] in by_ann_date:
+        return by_ann_date[task[0]](ann_date=task[2], fields=request_fields(task[0]))
+    return func[task[0]](trade_date=task[2], fields=request_fields(task[0])) if task[0] in func else None
+
+
 def imp_get_index_daily_basic_from_tushare(ts_code: Text, trade_date: Text) -> NamedTuple:
-    df: pd.DataFrame = ts.pro_api(config.tushare_token).index_dailybasic(ts_code=ts_code, trade_date=trade_date)
+    df: pd.DataFrame = rc.cached_pro_api('index_dailybasic')(ts_code=ts_code, trade_date=trade_date)
     return list(df.itertuples(index=False, name='index_daily_basic'))[0]
 
 
@@ -132,46 +194,152 @@ def imp_get_trade_data_from_tushare(task: Tuple) -> Optional[pd.DataFrame]:
     ts.set_token(config.tushare_token)
     asset: Dict = {db_config().tbl_daily_trading_data: 'E',
                    db_config().tbl_index: 'I'}
-    return ts.pro_bar(ts_code=task[1], asset=asset[task[0]], start_date=task[2], end_date=task[3], adj='qfq') \
+    # 不复权，股票的复权价格见adjust
+    return ts.pro_bar(ts_code=task[1], asset=asset[task[0]], start_date=task[2], end_date=task[3]) \
         if task is not None else None
 
 
+def statement_version_field(columns: List[Text]) -> Optional[Text]:
+    """ 财务报表的版本字段：同一报告期更正后的报表实际公告日期不同
+    """
+    return 'f_ann_date' if 'f_ann_date' in columns else ('ann_date' if 'ann_date' in columns else None)
+
+
 def clean_statement2(data: pd.DataFrame) -> pd.DataFrame:
-    return data.drop_duplicates(['end_date'], keep='first') if 'end_date' in list(data.columns.values) else data
+    # 保留同一报告期不同公告日期的各个版本，供时点索引使用
+    if 'end_date' not in list(data.columns.values):
+        return data
+    version: Optional[Text] = statement_version_field(list(data.columns.values))
+    return data.drop_duplicates(['end_date'] if version is None else ['end_date', version], keep='first')
 
 
-def transfer_statement(data: pd.DataFrame) -> List:
-    return list(data.values)
+def transfer_columns(data: pd.DataFrame) -> Column_batch:
+    """ 按列转换后交给写线程，写入时才逐行组合，不先转成逐行的对象数组
 
+    sqlite3绑定NumPy标量要走适配的慢路径，int64不能绑定，每列一次tolist转为Python的int、float和str
+    """
+    return Column_batch(columns=list(data.columns), arrays=[data[c].values.tolist() for c in data.columns])
 
-def imp_persist_data(data: List, tbl_name: Text) -> Any:
-    conn = sqlite3.connect(db_config().db_path)
-    c = conn.cursor()
 
-    # Insert list data
+def transfer_statement(data: pd.DataFrame) -> List:
+    return list(zip(*transfer_columns(data).arrays))
+
+
+def imp_persist_data(data: Any, tbl_name: Text, after: Sequence[Tuple] = (),
+                     on_error: Optional[Callable[[Exception], Any]] = None) -> Any:
+    """ data为行的列表或Column_batch，交给写线程，与其他批次合并在一个事务中提交
+
+    返回时数据只是进入了写队列，写入失败的错误交给on_error，没有on_error时在imp_flush_db时抛出；
+    after为与这批数据一起提交的(sql, 参数)，例如下载记录
+    """
+    if isinstance(data, Column_batch):
+        if len(data.arrays) == 0 or len(data.arrays[0]) == 0:
+            for sql, params in after:
+                dba.imp_db(db_config().db_path).write(sql, params, on_error=on_error)
+            return None
+        insert_txt: Text = f'INSERT OR IGNORE INTO {tbl_name} ({", ".join(data.columns)}) \
+                           VALUES ({", ".join("?" * len(data.columns))})'
+        dba.imp_db(db_config().db_path).write_many(insert_txt, zip(*data.arrays), after=after, on_error=on_error)
+        return True
     fields_len: int = len(data[0])
-    insert_txt: Text = f'INSERT OR IGNORE INTO {tbl_name} VALUES ({"?," * (fields_len - 1) + "?"})'
-    c.executemany(insert_txt, data)
+    insert_txt = f'INSERT OR IGNORE INTO {tbl_name} VALUES ({"?," * (fields_len - 1) + "?"})'
+    dba.imp_db(db_config().db_path).write_many(insert_txt, data, after=after, on_error=on_error)
+    return True
 
-    # Save (commit) the changes
-    conn.commit()
 
-    # We can also close the connection if we are done with it.
-    # Just be sure any changes have been committed or they will be lost.
-    c.close()
-    conn.close()
-    return True
+def imp_flush_db() -> Any:
+    """ 等待已提交的写操作全部落盘
+    """
+    dba.imp_db(db_config().db_path).flush()
 
 
 # get, clean, transfer and persist data, gctp
 def gctp(code: Text, tbl_name: Text,
          getter: Callable[[Tuple], Any],
-         persistence: Callable[[pd.DataFrame, Text], Any]) -> Optional[bool]:
+         persistence: Callable[[Any, Text], Any]) -> Optional[bool]:
     data = getter((tbl_name, code, sampling_config().start_date, sampling_config().end_date))
-    return persistence(transfer_statement(clean_statement2(data)), tbl_name) \
+    return persistence(transfer_columns(clean_statement2(conform_data(data, tbl_name))), tbl_name) \
         if data is not None and data.empty is False else None
 
 
+def fetch_task(task: Tuple, getter: Callable[[Tuple], Any]) -> Tuple:
+    return task, getter(task)
+
+
+def clean_fetched(fetched: Tuple) -> Tuple:
+    """ 清洗转换阶段：(task, 下载的数据)转为(task, Column_batch)，服务器返回空表时为(task, None)
+
+    getter返回None表示这个表没有可用的接口或下载失败，不能当作没有数据，作为失败的任务抛出
+    """
+    task, data = fetched
+    if data is None:
+        raise ValueError(f'{task}没有取得数据')
+    if data.empty is True:
+        return task, None
+    return task, transfer_columns(clean_statement2(conform_data(data, task[0])))
+
+
+def batch_rows(item: Tuple) -> int:
+    data: Any = item[1]
+    if data is None:
+        return 0
+    return len(data) if isinstance(data, pd.DataFrame) else len(data.arrays[0]) if len(data.arrays) > 0 else 0
+
+
+def imp_run_gctp_pipeline(tasks: Iterable[Tuple],
+                          getter: Callable[[Tuple], Any],
+                          persist: Callable[[Tuple], Any],
+                          quota: sch.Quota,
+                          workers: Optional[int] = None,
+                          cfg: Optional[pl.Pipeline_config] = None,
+                          on_error: Optional[Callable[[Tuple, Text, Exception], Any]] = None) -> List[Dict[Text, Any]]:
+    """ 下载、清洗转换、写入三个阶段同时进行：下载按配额并发，清洗转换和写入各一个线程
+
+    persist接收(task, Column_batch或None)；写入阶段只把列数组交给数据库的写线程，由写线程合并事务。返回各阶段的统计。
+    下载、清洗或写入阶段失败的任务交给on_error(task, 阶段名, 错误)
+    """
+    stage_error: Optional[Callable[[Text, Any, Exception], Any]] = None if on_error is None \
+        else lambda stage, item, e: on_error(failed_task(stage, item), stage, e)
+    fetched: Iterator[Tuple] = sch.imp_run_scheduled(tasks, partial(fetch_task, getter=getter), quota, workers,
+                                                     on_error=None if on_error is None
+                                                     else lambda task, e: on_error(task, 'fetch', e))
+    return pl.imp_run_pipeline(fetched, batch_rows,
+                               [pl.Stage('clean', clean_fetched, batch_rows),
+                                pl.Stage('persist', partial(persist_stage, persist=persist), lambda rtn: rtn[1])], cfg,
+                               on_error=stage_error)
+
+
+def failed_task(stage: Text, item: Any) -> Optional[Tuple]:
+    # 下载阶段的数据就是任务本身，之后各阶段的数据为(task, ...)
+    return item if stage == 'fetch' or item is None else item[0]
+
+
+def persist_stage(cleaned: Tuple, persist: Callable[[Tuple], Any]) -> Tuple:
+    persist(cleaned)
+    return cleaned[0], batch_rows(cleaned)
+
+
+def persist_cleaned(cleaned: Tuple, persistence: Callable[[Any, Text], Any]) -> Any:
+    task, batch = cleaned
+    return persistence(batch, task[0]) if batch is not None else None
+
+
+def imp_gctp_pipeline(code_set: List,
+                      tbl_name: Text,
+                      getter: Callable[[Tuple], Any],
+                      persistence: Callable[[Any, Text], Any] = imp_persist_data,
+                      access_per_minute: int = 80,
+                      exists_in_db: Optional[Callable[[Text], bool]] = None,
+                      workers: Optional[int] = None) -> List[Dict[Text, Any]]:
+    """ 与imp_limit_access(gctp_func=partial(gctp, ...))相同的下载，改为流水线执行
+    """
+    codes: Iterator[Text] = filter(lambda c: exists_in_db is None or exists_in_db(c) is not True, code_set)
+    tasks: Iterator[Tuple] = ((tbl_name, code, sampling_config().start_date, sampling_config().end_date)
+                              for code in codes)
+    return imp_run_gctp_pipeline(tasks, getter, partial(persist_cleaned, persistence=persistence),
+                                 sch.tushare_quota(tbl_endpoint()[tbl_name], access_per_minute), workers)
+
+
 def impf_gctp_daily_trade_data(ts_code: Text) -> Optional[Text]:
     rtn: Text = (ts_code, f"日交易数据没有成功缓存到本地 ")
 
@@ -184,7 +352,8 @@ def impf_gctp_daily_trade_data(ts_code: Text) -> Optional[Text]:
 
     if df is not None and df.empty is not True:
         # TODO: 避免重复插入
-        imp_persist_data(list(df.values), db_config().tbl_daily_trading_data)
+        imp_persist_data(transfer_statement(conform_data(df, db_config().tbl_daily_trading_data)),
+                         db_config().tbl_daily_trading_data)
         rtn = (ts_code, f"日交易数据缓存到本地数据库的{db_config().tbl_daily_trading_data}表格成功")
 
     return rtn
@@ -192,7 +361,7 @@ def impf_gctp_daily_trade_data(ts_code: Text) -> Optional[Text]:
 
 def impf_name_is_in_db(ts_code: Text) -> bool:
     rtn: bool = False
-    df: pd.DataFrame = imp_get_records_from_db(f"SELECT * FROM name_history WHERE ts_code='{ts_code}'")
+    df: pd.DataFrame = imp_get_records_from_db("SELECT * FROM name_history WHERE ts_code=?", (ts_code,))
     if df is not None and df.empty is False:
         rtn = True
     return rtn
@@ -204,54 +373,46 @@ def impf_gctp_name_history(ts_code: Text) -> Optional[Text]:
     df: pd.DataFrame = ts.pro_api(config.tushare_token).namechange(ts_code=ts_code)
     if df is not None and df.empty is not True:
         # TODO: 避免重复插入
-        imp_persist_data(list(df.values), db_config().tbl_name_history)
+        imp_persist_data(transfer_statement(conform_data(df, db_config().tbl_name_history)),
+                         db_config().tbl_name_history)
         rtn = (ts_code, f"股票名称信息缓存到本地数据库的{db_config().tbl_name_history}表格成功")
 
     return rtn
 
 
+def tbl_endpoint() -> Dict[Text, Text]:
+    return {db_config().tbl_daily_trading_data: 'daily',
+            db_config().tbl_daily_basic: 'daily_basic',
+            db_config().tbl_income_statement: 'income',
+            db_config().tbl_balance_sheet: 'balancesheet',
+            db_config().tbl_cash_flow_statement: 'cashflow',
+            db_config().tbl_finance_indicator_statement: 'fina_indicator',
+            db_config().tbl_name_history: 'namechange',
+            db_config().tbl_index: 'index_daily',
+            db_config().tbl_adj_factor: 'adj_factor'}
+
+
 def imp_limit_access(access_per_minute: int,
                      code_set: List,
                      gctp_func: Callable[[Text], Optional[bool]],
-                     exists_in_db: Optional[Callable[[Text], bool]] = None) -> Any:
-    for code in code_set:
-        if exists_in_db is not None and exists_in_db(code) is True:
-            continue
-
-        start = time.time()
-        rtn = gctp_func(code)
-        end = time.time()
-        lapse = end - start
-        min_lapse = 60 / access_per_minute
-        if lapse <= min_lapse:
-            time.sleep(min_lapse - lapse + 0.002)
+                     exists_in_db: Optional[Callable[[Text], bool]] = None,
+                     tbl_name: Optional[Text] = None,
+                     workers: Optional[int] = None,
+                     rows_quota: Optional[sch.Quota] = None,
+                     row_count: Optional[Callable[[Any], int]] = None) -> Any:
+    """ 按tbl_name对应接口的配额下载，不同表的下载各用各的令牌桶，没有给出tbl_name时共用default令牌桶
+    给出rows_quota(如sch.row_budget_quota())时，每次下载完成后按row_count(结果)扣除行数配额
+    """
+    codes: Iterator[Text] = filter(lambda c: exists_in_db is None or exists_in_db(c) is not True, code_set)
+    quota: sch.Quota = sch.tushare_quota(tbl_endpoint().get(tbl_name, 'default'), access_per_minute)
+    for rtn in sch.imp_run_scheduled(codes, gctp_func, quota, workers, rows_quota=rows_quota, row_count=row_count):
         print(rtn)
 
 
-# TODO: daily_trading_data table需要建立trade_date INDEX
-
-def imp_create_fina_tables() -> Optional:
-    tbl_list: List[Text] = [db_config().tbl_cash_flow_statement, db_config().tbl_balance_sheet,
-                            db_config().tbl_income_statement, db_config().tbl_finance_indicator_statement,
-                            db_config().tbl_daily_basic, db_config().tbl_daily_trading_data]
-    for item in tbl_list:
-        df: pd.DataFrame = imp_get_data_from_tushare((item, '600000.SH', '20170101', '20180801'))
-        query_str = reduce(lambda x, y: f"{x}, {y}", df.columns.to_list())
-        query_str = query_str + ", PRIMARY KEY (ts_code, end_date)" \
-            if item != db_config().tbl_daily_trading_data and item != db_config().tbl_daily_basic \
-            else query_str + ", PRIMARY KEY (ts_code, trade_date)"
-        imp_create_sqlite_table(item, query_str)
-
-
-def imp_create_trade_tables() -> Optional:
-    tbl_list: List[Text] = [db_config().tbl_index, ]
-
-    for item in tbl_list:
-        sample_code: Callable[[Text], Text] = lambda t: '399300.SZ' if t == db_config().tbl_index else '600000.SH'
-        df: pd.DataFrame = imp_get_trade_data_from_tushare((item, sample_code(item), '20170101', '20170301'))
-        query_str = reduce(lambda x, y: f"{x}, {y}", df.columns.to_list())
-        query_str = query_str + ", PRIMARY KEY (ts_code, trade_date)"
-        imp_create_sqlite_table(item, query_str)
+def imp_create_db_schema() -> int:
+    """ 按schema中登记的表结构建表、建索引，已有的数据库执行尚未执行的迁移，返回数据库结构版本
+    """
+    return sc.imp_migrate(db_config().db_path, db_config())
 
 
 def create_sqlite_table(sample: pd.DataFrame,
@@ -268,48 +429,49 @@ def create_db_tables(tbl_name: Text,
 
 
 def imp_get_trade_cal(start: Text, end: Text) -> Iterator[Tuple[Text, int]]:
-    return ts.pro_api(config.tushare_token).trade_cal(exchange='', start_date=start, end_date=end)\
+    return rc.cached_pro_api('trade_cal')(exchange='', start_date=start, end_date=end)\
         .itertuples(index=False, name='Trade_cal')
 
 
 if __name__ == '__main__':
-    # create_db_tables(db_config().tbl_name_history,
-    #                  lambda s: 'ts_code, name, start_date, end_date, ann_date, change_reason \
-    #                             PRIMARY KEY (ts_code, start_date) ',
-    #                  imp_create_sqlite_table)
-    # imp_create_fina_tables()
-    # imp_create_trade_tables()
-    create_sqlite_table(ts.pro_api(config.tushare_token).namechange(ts_code='600848.SH'),
-                        tbl_name='name_history',
-                        primary_keys='ts_code, start_date')
+    imp_create_db_schema()
     code_list: List = [record[0] for record in list(download_list_companies().values)]
     # imp_limit_access(80, code_set=code_list, gctp_func=partial(gctp2,
     #                                                            tbl_name=db_config().tbl_finance_indicator_statement,
     #                                                            getter=imp_get_data_from_tushare,
-    #                                                            persistence=imp_persist_data))
+    #                                                            persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_finance_indicator_statement)
     # imp_limit_access(80, code_set=code_list, gctp_func=partial(gctp2,
     #                                                            tbl_name=db_config().tbl_income_statement,
     #                                                            getter=imp_get_data_from_tushare,
-    #                                                            persistence=imp_persist_data))
+    #                                                            persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_income_statement)
     # imp_limit_access(80, code_set=code_list, gctp_func=partial(gctp2,
     #                                                            tbl_name=db_config().tbl_balance_sheet,
     #                                                            getter=imp_get_data_from_tushare,
-    #                                                            persistence=imp_persist_data))
+    #                                                            persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_balance_sheet)
     # imp_limit_access(80, code_set=code_list, gctp_func=partial(gctp,
     #                                                            tbl_name=db_config().tbl_daily_trading_data,
     #                                                            getter=imp_get_data_from_tushare,
-    #                                                            persistence=imp_persist_data))
+    #                                                            persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_daily_trading_data)
     # imp_limit_access(80, code_set=code_list, gctp_func=partial(gctp,
     #                                                            tbl_name=db_config().tbl_daily_basic,
     #                                                            getter=imp_get_data_from_tushare,
-    #                                                            persistence=imp_persist_data))
+    #                                                            persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_daily_basic)
     # imp_limit_access(80, code_set=['399300.SZ', ], gctp_func=partial(gctp,
     #                                                                  tbl_name=db_config().tbl_index,
     #                                                                  getter=imp_get_trade_data_from_tushare,
-    #                                                                  persistence=imp_persist_data))
+    #                                                                  persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_index)
     # imp_limit_access(100, code_set=code_list, gctp_func=partial(gctp,
     #                                                            tbl_name=db_config().tbl_name_history,
     #                                                            getter=imp_get_data_from_tushare,
-    #                                                            persistence=imp_persist_data))
-    # imp_limit_access(200, code_set=['600018.SH', ], gctp_func=impf_gctp_daily_trade_data)
-    imp_limit_access(78, code_set=code_list, gctp_func=impf_gctp_name_history, exists_in_db=impf_name_is_in_db)
+    #                                                            persistence=imp_persist_data),
+    #                  tbl_name=db_config().tbl_name_history)
+    # imp_limit_access(200, code_set=['600018.SH', ], gctp_func=impf_gctp_daily_trade_data,
+    #                  tbl_name=db_config().tbl_daily_trading_data)
+    imp_limit_access(78, code_set=code_list, gctp_func=impf_gctp_name_history, exists_in_db=impf_name_is_in_db,
+                     tbl_name=db_config().tbl_name_history)
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """ 每个测试使用自己的数据目录，离线运行
+    """
+    monkeypatch.setenv('AQF_DATA_DIR', str(tmp_path))
+    monkeypatch.setenv('AQF_TUSHARE_OFFLINE', '1')
+    return tmp_path
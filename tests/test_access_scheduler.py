@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from src import access_scheduler as sch
+
+
+def quiet_config(tmp_path):
+    return sch.scheduler_config()._replace(state_path=str(tmp_path / 'quota.db'), backoff_base=0.01,
+                                           backoff_cap=0.01, max_retries=2)
+
+
+def tokens_left(quota, state_path):
+    return sch.imp_update_bucket(quota, state_path, lambda tokens, now: (tokens, tokens))
+
+
+def test_rate_refill_is_capped_by_burst():
+    quota = sch.Quota('daily', limit=60, period=60, burst=5, mode='rate')
+    assert sch.refill(quota, 0.0, 100.0, 102.0) == pytest.approx(2.0)
+    assert sch.refill(quota, 0.0, 100.0, 1000.0) == 5.0
+    # 时钟回拨不扣令牌
+    assert sch.refill(quota, 1.0, 100.0, 90.0) == 1.0
+    assert sch.seconds_until_available(quota, 0.25, 1.0, 0.0) == pytest.approx(0.75)
+
+
+def test_window_resets_at_the_next_period():
+    quota = sch.row_budget_quota(rows_per_day=100)
+    start = sch.window_index(quota, time.time()) * quota.period + time.timezone
+    assert sch.refill(quota, -20.0, start + 10, start + quota.period - 1) == -20.0
+    assert sch.refill(quota, -20.0, start + 10, start + quota.period) == 100.0
+    assert sch.seconds_until_available(quota, -20.0, 0.0, start + 10) == pytest.approx(quota.period - 10)
+
+
+def test_acquire_shares_the_bucket_per_endpoint(tmp_path):
+    state_path = str(tmp_path / 'quota.db')
+    daily = sch.Quota('daily', limit=6000, period=60, burst=2, mode='rate')
+    assert sch.imp_acquire(daily, 1.0, state_path) == 0.0
+    assert sch.imp_acquire(daily, 1.0, state_path) == 0.0
+    assert tokens_left(daily, state_path) < 1.0
+    # 别的接口有自己的令牌桶
+    assert tokens_left(daily._replace(endpoint='namechange'), state_path) == 2.0
+    start = time.time()
+    sch.imp_acquire(daily, 1.0, state_path)
+    assert time.time() - start < 1.0
+
+
+def test_run_scheduled_debits_rows_and_reports_failures(tmp_path):
+    cfg = quiet_config(tmp_path)
+    quota = sch.Quota('daily', limit=60000, period=60, burst=10, mode='rate')
+    rows_quota = sch.row_budget_quota(rows_per_day=100)
+    failed = []
+
+    def fetch(item):
+        if item == 3:
+            raise ValueError('bad code')
+        return [item] * item
+
+    out = sch.imp_run_scheduled(range(5), fetch, quota, 2, rows_quota=rows_quota, row_count=len, sch_config=cfg,
+                                on_error=lambda item, e: failed.append(item))
+    assert sorted(len(rtn) for rtn in out) == [0, 1, 2, 4]
+    assert failed == [3]
+    assert tokens_left(rows_quota, cfg.state_path) == 100 - 7
+
+
+def test_rate_limited_calls_are_retried(tmp_path):
+    cfg = quiet_config(tmp_path)
+    quota = sch.Quota('income', limit=60000, period=60, burst=1, mode='rate')
+    calls = []
+
+    def fetch(item):
+        calls.append(item)
+        if len(calls) < 3:
+            raise Exception('抱歉，您每分钟最多访问该接口80次')
+        return item
+
+    assert list(sch.imp_run_scheduled(['a'], fetch, quota, sch_config=cfg)) == ['a']
+    assert calls == ['a', 'a', 'a']
+
+
+def test_backoff_is_waited_once(tmp_path, monkeypatch):
+    class Clock:
+        timezone = time.timezone
+
+        def __init__(self):
+            self.now, self.slept = 1e9, []
+
+        def time(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.now += seconds
+            self.slept.append(seconds)
+    clock = Clock()
+    monkeypatch.setattr(sch, 'time', clock)
+    monkeypatch.setattr(sch.random, 'random', lambda: 1.0)
+    cfg = quiet_config(tmp_path)._replace(backoff_base=3.0, backoff_cap=3.0)
+    quota = sch.Quota('income', limit=60, period=60, burst=1, mode='rate')
+    calls = []
+
+    def fetch(item):
+        calls.append(clock.now)
+        if len(calls) < 2:
+            raise Exception('抱歉，您每分钟最多访问该接口80次')
+        return item
+
+    assert sch.imp_call_with_retry(fetch, 'a', quota, sch_config=cfg) == 'a'
+    # 退避3秒清空令牌桶，再等1秒补充一个令牌
+    assert calls[1] - calls[0] == pytest.approx(4.0)
+    assert clock.slept == [pytest.approx(4.0)]
+
+
+def test_limit_access_keeps_the_old_positional_order(monkeypatch):
+    pytest.importorskip('tushare')
+    from src import tushare_data as td
+    runs = []
+    monkeypatch.setattr(sch, 'imp_run_scheduled', lambda items, func, quota, workers, **kwargs:
+                        runs.append((list(items), quota.endpoint)) or iter([]))
+    td.imp_limit_access(80, ['a', 'b'], str, lambda code: code == 'a')
+    td.imp_limit_access(80, ['a', 'b'], str, tbl_name=td.db_config().tbl_daily_basic)
+    assert runs == [(['b'], 'default'), (['a', 'b'], 'daily_basic')]
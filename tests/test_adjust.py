@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import adjust  # noqa: E402
+from src import panel_store as ps  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+# a在20190104除权，复权因子翻倍；b在20190103缺一个复权因子
+DATES = [20190102, 20190103, 20190104, 20190107]
+DAILY = pd.DataFrame({'ts_code': ['a'] * 4 + ['b'] * 4, 'trade_date': DATES * 2,
+                      'close': [10.0, 10.4, 5.3, 5.5, 20.0, 21.0, 22.0, 23.0],
+                      'pre_close': [9.8, 10.0, 5.2, 5.3, 19.0, 20.0, 21.0, 22.0],
+                      'change': [0.2, 0.4, 0.1, 0.2, 1.0, 1.0, 1.0, 1.0],
+                      'vol': [100.0] * 8})
+FACTORS = pd.DataFrame({'ts_code': ['a'] * 4 + ['b'] * 4, 'trade_date': DATES * 2,
+                        'adj_factor': [1.0, 1.0, 2.0, 2.0, 3.0, np.nan, 3.0, 3.0]})
+
+
+def test_rows_backward_and_forward_adjusted():
+    rows = DAILY.merge(FACTORS, on=['ts_code', 'trade_date']).iloc[::-1]
+    hfq = adjust.adjust_rows(rows, 'hfq')
+    np.testing.assert_allclose(hfq['close'].values[:4], [10.0, 10.4, 10.6, 11.0])
+    np.testing.assert_allclose(hfq['close'].values[4:], [60.0, 63.0, 66.0, 69.0])
+    qfq = adjust.adjust_rows(rows)
+    np.testing.assert_allclose(qfq['close'].values[:4], [5.0, 5.2, 5.3, 5.5])
+    np.testing.assert_allclose(qfq['change'].values[:4], qfq['close'].values[:4] - qfq['pre_close'].values[:4])
+    assert qfq['vol'].tolist() == [100.0] * 8
+    # 以除权前为基准时，除权后的价格放大
+    np.testing.assert_allclose(adjust.adjust_rows(rows, as_of=20190103)['close'].values[:4], [10.0, 10.4, 10.6, 11.0])
+    with pytest.raises(ValueError):
+        adjust.adjust_rows(rows, 'none')
+
+
+def test_panel_matches_rows():
+    prices = DAILY.pivot(index='trade_date', columns='ts_code', values='close')
+    # 复权因子面板从价格之前的交易日开始，向后填充缺失的值
+    factors = pd.concat([pd.DataFrame({'a': [1.0], 'b': [3.0]}, index=[20181228]),
+                         FACTORS.pivot(index='trade_date', columns='ts_code', values='adj_factor')])
+    rows = DAILY.merge(FACTORS, on=['ts_code', 'trade_date'])
+    for how, as_of in (('hfq', None), ('qfq', None), ('qfq', 20190103)):
+        expected = adjust.adjust_rows(rows, how, as_of).pivot(index='trade_date', columns='ts_code', values='close')
+        np.testing.assert_allclose(adjust.adjust_panel(prices, factors, how, as_of).values, expected.values)
+
+
+def test_adjusted_daily_from_db_uses_later_base(data_dir):
+    td.imp_create_db_schema()
+    for tbl, frame in ((td.db_config().tbl_daily_trading_data, DAILY),
+                       (td.db_config().tbl_adj_factor, FACTORS.dropna())):
+        td.imp_persist_data(td.transfer_columns(td.conform_data(frame, tbl)), tbl)
+    td.imp_flush_db()
+    # 只取除权前的价格，前复权的基准仍是最后一个复权因子
+    got = adjust.imp_adjusted_daily(['a'], '20190102', '20190103')
+    assert got['trade_date'].tolist() == [20190102, 20190103]
+    np.testing.assert_allclose(got['close'].values, [5.0, 5.2])
+    np.testing.assert_allclose(adjust.imp_adjusted_daily(['a'], '20190102', '20190103', as_of=20190103)['close'].values,
+                               [10.0, 10.4])
+    np.testing.assert_allclose(adjust.imp_adjusted_daily(['a'], '20190104', '20190107', 'hfq')['close'].values,
+                               [10.6, 11.0])
+
+
+def test_adjusted_frame_from_panels(data_dir):
+    ps.imp_write_rows(td.db_config().tbl_daily_trading_data, DAILY[['trade_date', 'ts_code', 'close']], ('close',))
+    ps.imp_write_rows(td.db_config().tbl_adj_factor, FACTORS[['trade_date', 'ts_code', 'adj_factor']],
+                      ('adj_factor',))
+    frame = adjust.imp_adjusted_frame('close', start_date=20190103, end_date=20190104)
+    assert frame.index.tolist() == [20190103, 20190104]
+    np.testing.assert_allclose(frame['a'].values, [5.2, 5.3], rtol=1e-6)
+    np.testing.assert_allclose(frame['b'].values, [21.0, 22.0], rtol=1e-6)
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import backtest as bt  # noqa: E402
+
+DATES = [20190102, 20190103, 20190104, 20190107, 20190108]
+# c在20190103停牌，d在20190104之后退市，没有数据的日子收益按0计
+PCT_CHG = pd.DataFrame({'a': [1.0, 10.0, 0.0, -10.0, 0.0],
+                        'b': [2.0, 0.0, 10.0, 0.0, 0.0],
+                        'c': [3.0, np.nan, 10.0, 0.0, 10.0],
+                        'd': [4.0, 20.0, 0.0, np.nan, np.nan]}, index=DATES)
+SCORES = pd.DataFrame({'a': [1.0, 3.0], 'b': [2.0, 1.0], 'c': [3.0, 2.0], 'd': [4.0, np.nan]},
+                      index=[20190102, 20190104])
+POOL = {'20190102': (None, {'a', 'b', 'c', 'd'}), '20190104': (None, {'a', 'b', 'c'})}
+
+
+def config(**kwargs):
+    return bt.backtest_config()._replace(quantiles=2, periods_per_year=4, **kwargs)
+
+
+def test_prepare_returns_holds_suspended_and_delisted_codes_flat():
+    returns = bt.prepare_returns(PCT_CHG)
+    growth = np.exp(returns.log_cum - returns.log_cum[0])
+    np.testing.assert_allclose(growth[:, 2], [1.0, 1.0, 1.1, 1.1, 1.21])
+    np.testing.assert_allclose(growth[:, 3], [1.0, 1.2, 1.2, 1.2, 1.2])
+    assert returns.codes.tolist() == ['a', 'b', 'c', 'd']
+
+
+def test_bucket_returns_ic_and_turnover():
+    result = bt.run_backtest(POOL, SCORES, bt.prepare_returns(PCT_CHG), config())
+    # 20190102: q1={a, b}, q2={c, d}；20190104: d不在样本池中，q1={b, c}, q2={a}
+    assert result.returns.index.tolist() == DATES[1:]
+    np.testing.assert_allclose(result.returns['q1'].values, [0.05, 1.1 / 1.05 - 1, 0.0, 0.05])
+    np.testing.assert_allclose(result.returns['q2'].values, [0.1, 1.15 / 1.1 - 1, -0.1, 0.0])
+    np.testing.assert_allclose(result.returns['spread'].values,
+                               result.returns['q2'].values - result.returns['q1'].values)
+    np.testing.assert_allclose(result.nav['q1'].values, [1.05, 1.1, 1.1, 1.155])
+    np.testing.assert_allclose(result.ic.values, [3 / np.sqrt(15), -0.5])
+    # 第二次调仓时q2原来持有c、d，漂移后的权重为1.1/2.3和1.2/2.3，全部换成a
+    np.testing.assert_allclose(result.turnover.loc[20190102].values, [1.0, 1.0])
+    np.testing.assert_allclose(result.turnover.loc[20190104].values, [0.5, 1.0])
+
+
+def test_cost_is_charged_on_the_first_day_of_each_period():
+    free = bt.run_backtest(POOL, SCORES, bt.prepare_returns(PCT_CHG), config())
+    charged = bt.run_backtest(POOL, SCORES, bt.prepare_returns(PCT_CHG), config(cost=0.01))
+    np.testing.assert_allclose((free.returns - charged.returns)[['q1', 'q2']].values,
+                               [[0.01, 0.01], [0.0, 0.0], [0.005, 0.01], [0.0, 0.0]], atol=1e-12)
+
+
+def test_summary_statistics():
+    result = bt.run_backtest(POOL, SCORES, bt.prepare_returns(PCT_CHG), config())
+    summary = result.summary
+    # 4个交易日、每年4个交易日，年化收益即区间收益
+    np.testing.assert_allclose(summary.loc[['q1', 'q2'], 'annual_return'].values, [0.155, 0.035])
+    np.testing.assert_allclose(summary.loc[['q1', 'q2'], 'max_drawdown'].values, [0.0, 1.035 / 1.15 - 1])
+    np.testing.assert_allclose(summary.loc[['q1', 'q2'], 'mean_turnover'].values, [0.75, 1.0])
+    np.testing.assert_allclose(summary['annual_vol'].values, result.returns.std().values * 2)
+    np.testing.assert_allclose(summary['ic_mean'].values, (3 / np.sqrt(15) - 0.5) / 2)
+
+
+def test_top_n_holds_the_highest_scores():
+    result = bt.run_backtest(POOL, SCORES, bt.prepare_returns(PCT_CHG), config(top_n=1))
+    assert result.returns.columns.tolist() == ['top']
+    np.testing.assert_allclose(result.returns['top'].values, [0.2, 0.0, -0.1, 0.0])
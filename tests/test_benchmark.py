@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import benchmark as bm  # noqa: E402
+
+
+def test_small_benchmark_restores_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv('AQF_DATA_DIR', str(tmp_path / 'mine'))
+    monkeypatch.delenv('AQF_TUSHARE_OFFLINE', raising=False)
+    cfg = bm.bench_config()._replace(n_codes=20, n_days=300, persist_codes=20)
+    result = bm.imp_run_benchmark(cfg, str(tmp_path / 'results.jsonl'), str(tmp_path))
+    assert os.environ['AQF_DATA_DIR'] == str(tmp_path / 'mine')
+    assert 'AQF_TUSHARE_OFFLINE' not in os.environ
+    assert result['metrics']['db_size_mb'] > 0
+
+
+def test_db_size_counts_the_wal_file(tmp_path):
+    path = str(tmp_path / 'a.db')
+    for suffix, size in (('', 1024 ** 2), ('-wal', 2 * 1024 ** 2)):
+        with open(path + suffix, 'wb') as f:
+            f.write(b'\0' * size)
+    assert bm.db_size_mb(path) == 3
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+
+import pytest
+
+from src import db_access as dba
+
+
+@pytest.fixture
+def access(tmp_path):
+    access = dba.Db_access(str(tmp_path / 'test.db'))
+    access.write('CREATE TABLE t (k INTEGER PRIMARY KEY, v REAL)', wait=True)
+    return access
+
+
+def test_write_many_commits_and_reads_back(access):
+    access.write_many('INSERT INTO t VALUES (?, ?)', [(i, i / 2) for i in range(1000)])
+    access.flush()
+    frame = access.read_frame('SELECT k, v FROM t ORDER BY k')
+    assert len(frame) == 1000
+    assert frame['v'].iloc[-1] == 999 / 2
+
+
+def test_failed_batch_is_rolled_back_alone_and_raised_at_flush(access):
+    access.write_many('INSERT INTO t VALUES (?, ?)', [(1, 1.0)])
+    access.write_many('INSERT INTO t VALUES (?, ?)', [(2, 2.0), (2, 2.0)])
+    access.write_many('INSERT INTO t VALUES (?, ?)', [(3, 3.0)])
+    with pytest.raises(sqlite3.DatabaseError):
+        access.flush()
+    assert access.failures == 1
+    assert [row[0] for row in access.execute('SELECT k FROM t ORDER BY k')] == [1, 3]
+    # 错误只报告一次
+    access.flush()
+
+
+def test_wait_raises_error_of_its_own_batch(access):
+    with pytest.raises(sqlite3.IntegrityError):
+        access.write_many('INSERT INTO t VALUES (?, ?)', [(1, 1.0), (1, 1.0)], wait=True)
+    access.write_many('INSERT INTO t VALUES (?, ?)', [(1, 1.0)], wait=True)
+    assert access.execute('SELECT COUNT(*) FROM t') == [(1,)]
+
+
+def test_busy_begin_fails_items_without_hanging(tmp_path):
+    path = str(tmp_path / 'busy.db')
+    cfg = dba.db_access_config()._replace(busy_timeout_ms=50, begin_retries=1)
+    access = dba.Db_access(path, cfg)
+    access.write('CREATE TABLE t (k INTEGER)', wait=True)
+    holder = sqlite3.connect(path, isolation_level=None)
+    holder.execute('BEGIN IMMEDIATE')
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            access.write('INSERT INTO t VALUES (1)', wait=True)
+    finally:
+        holder.execute('ROLLBACK')
+        holder.close()
+    access.write('INSERT INTO t VALUES (2)', wait=True)
+    assert access.execute('SELECT k FROM t') == [(2,)]
+
+
+def test_write_raises_when_writer_is_dead(tmp_path):
+    access = dba.Db_access(str(tmp_path / 'dead.db'))
+    access.writer = threading.Thread(target=lambda: None)
+    access.writer.start()
+    access.writer.join()
+    with pytest.raises(sqlite3.OperationalError):
+        access.write('SELECT 1')
+
+
+def test_iter_frames_chunks_keep_column_types(access):
+    access.write_many('INSERT INTO t VALUES (?, ?)', [(i, None if i % 2 else float(i)) for i in range(10)],
+                      wait=True)
+    chunks = list(access.iter_frames('SELECT k, v FROM t ORDER BY k', chunk_rows=4))
+    assert [len(c) for c in chunks] == [4, 4, 2]
+    assert chunks[0]['k'].dtype.kind == 'i'
+    assert chunks[0]['v'].dtype.kind == 'f'
+
+
+def test_every_chunk_has_the_type_of_the_first(access):
+    access.write('CREATE TABLE u (k INTEGER, d INTEGER, v REAL, s TEXT)', wait=True)
+    # 第二批v、s全为NULL，第三批d有NULL
+    access.write_many('INSERT INTO u VALUES (?, ?, ?, ?)',
+                      [(0, 20190102, 1.5, 'a'), (1, 20190103, 2.5, 'b'), (2, 20190104, None, None),
+                       (3, 20190107, None, None), (4, None, 3.5, 'c')], wait=True)
+    sql = 'SELECT k, d, v, s FROM u ORDER BY k'
+    chunks = list(access.iter_frames(sql, chunk_rows=2, dtypes={'d': 'float64'}))
+    for name, kind in (('k', 'i'), ('d', 'f'), ('v', 'f'), ('s', 'O')):
+        assert [c[name].dtype.kind for c in chunks] == [kind] * 3
+    assert chunks[1]['v'].isnull().all() and chunks[2]['d'].isnull().all()
+    # 按第一批判断为int64的列出现NULL时不悄悄换成float64
+    with pytest.raises(ValueError):
+        list(access.iter_frames(sql, chunk_rows=2))
+    with access.reader() as conn:
+        frame = dba.read_frame(conn, sql, chunk_rows=2)
+    assert frame['d'].dtype.kind == 'f' and frame['v'].dtype.kind == 'f' and frame['s'].tolist()[-1] == 'c'
+
+
+def test_evict_lru_keeps_most_recently_accessed(tmp_path):
+    access = dba.Db_access(str(tmp_path / 'cache.db'))
+    access.write('CREATE TABLE c (key TEXT PRIMARY KEY, accessed REAL, size INTEGER)', wait=True)
+    access.write_many('INSERT INTO c VALUES (?, ?, ?)', [('old', 1.0, 40), ('mid', 2.0, 40), ('new', 3.0, 40)],
+                      wait=True)
+    assert dba.imp_evict_lru(access, 'c', 100) == ['old']
+    assert dba.imp_evict_lru(access, 'c', 100) == []
+    assert sorted(row[0] for row in access.execute('SELECT key FROM c')) == ['mid', 'new']
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import factor_engine as fe  # noqa: E402
+from src import panel_store as ps  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+CODES = ['000001.SZ', '000002.SZ', '600000.SH']
+DATES = pd.bdate_range('2019-01-02', periods=40).strftime('%Y%m%d').astype(int).tolist()
+TARGETS = ('reversal_20', 'volatility_20', 'turnover_20', 'size', 'z_ep')
+
+
+def daily(dates, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(dates) * len(CODES)
+    rows = pd.DataFrame({'trade_date': np.repeat(dates, len(CODES)), 'ts_code': np.tile(CODES, len(dates)),
+                         'pct_chg': rng.normal(0, 2, n), 'turnover_rate': rng.uniform(0.5, 3, n),
+                         'total_mv': rng.uniform(1e5, 1e6, n), 'pe_ttm': rng.uniform(-20, 60, n),
+                         'pb': rng.uniform(0.5, 5, n), 'ps_ttm': rng.uniform(0.5, 5, n)})
+    # 000002.SZ停牌两天
+    rows.loc[(rows['ts_code'] == '000002.SZ') & rows['trade_date'].isin(dates[5:7]), ['pct_chg', 'turnover_rate']] = \
+        np.nan
+    return rows
+
+
+def imp_write_base(rows):
+    for table in (td.db_config().tbl_daily_trading_data, td.db_config().tbl_daily_basic):
+        fields = tuple(f for f in ps.panel_config().fields[table] if f in rows.columns)
+        ps.imp_write_rows(table, rows[['trade_date', 'ts_code', *fields]], fields)
+
+
+def frames():
+    return {name: fe.factor_frame(name) for name in TARGETS}
+
+
+@pytest.fixture
+def small_blocks(data_dir, monkeypatch):
+    monkeypatch.setattr(fe, 'factor_config', lambda cfg=fe.factor_config(): cfg._replace(dates_per_block=7))
+
+
+def test_incremental_update_matches_full_rebuild(small_blocks):
+    rows = daily(DATES)
+    imp_write_base(rows[rows['trade_date'] < DATES[30]])
+    fe.imp_update_factors(TARGETS)
+    imp_write_base(rows[rows['trade_date'] >= DATES[30]])
+    fe.imp_update_factors(TARGETS)
+    incremental = frames()
+    assert incremental['size'].index.tolist() == DATES
+    fe.imp_update_factors(TARGETS, since=0)
+    for name, frame in frames().items():
+        pd.testing.assert_frame_equal(incremental[name], frame, check_exact=False, rtol=1e-6)
+
+
+def test_rolling_values_at_block_and_panel_edges(small_blocks):
+    rows = daily(DATES)
+    imp_write_base(rows)
+    fe.imp_update_factors(TARGETS)
+    ret = rows.pivot(index='trade_date', columns='ts_code', values='pct_chg').astype(np.float32) / 100
+    expected = ret.astype(np.float64).rolling(20, min_periods=16).std()
+    got = fe.factor_frame('volatility_20')
+    # 前15个交易日不足min_periods，之后每个块的开头都用到了前一块的数据
+    assert got.iloc[:15].isnull().all().all()
+    np.testing.assert_allclose(got.values, expected[got.columns].values, rtol=1e-5)
+    reversal = -np.log1p(ret.astype(np.float64)).rolling(20, min_periods=16).sum()
+    np.testing.assert_allclose(fe.factor_frame('reversal_20').values, reversal[got.columns].values, rtol=1e-4,
+                               atol=1e-6)
+
+
+def test_lookback_accumulates_through_the_graph():
+    graph = fe.factor_graph()
+    assert fe.lookback(graph, 'ret') == 0
+    assert fe.lookback(graph, 'reversal_20') == 19
+    assert fe.lookback(graph, 'z_momentum_12_1') == 249
+    assert fe.lookback(graph, 'turnover_ratio_20_250') == 249
+    chain = {'a': fe.Factor('a', ('close',), 3, None), 'b': fe.Factor('b', ('a', 'close'), 5, None),
+             'c': fe.Factor('c', ('b', 'a'), 1, None)}
+    assert fe.lookback(chain, 'c') == 6
+    assert fe.topo_order(chain, ['c']) == ['a', 'b', 'c']
+
+
+def test_recomputed_nan_overwrites_the_stored_value(data_dir):
+    targets = ('size', 'z_ep')
+    rows = daily(DATES)
+    imp_write_base(rows)
+    fe.imp_update_factors(targets)
+    assert fe.factor_frame('size').loc[DATES[-1]].notnull().all()
+    # 更正后市值为0、没有市盈率，这只股票当日的全部因子为空，原来的值要被覆盖
+    fixed = (rows['trade_date'] == DATES[-1]) & (rows['ts_code'] == '600000.SH')
+    rows.loc[fixed, 'total_mv'] = 0.0
+    rows.loc[fixed, 'pe_ttm'] = np.nan
+    imp_write_base(rows[rows['trade_date'] == DATES[-1]])
+    fe.imp_update_factors(targets, since=DATES[-1])
+    for name in targets:
+        assert np.isnan(fe.factor_frame(name).loc[DATES[-1], '600000.SH'])
+    assert fe.factor_frame('size').loc[DATES[-1]].notnull().sum() == 2
@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import db_access as dba  # noqa: E402
+from src import panel_store as ps  # noqa: E402
+from src import schema as sc  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+TBL = 'adj_factor'
+
+
+def rows(dates, codes, value=lambda d, c: d % 100 + c / 10):
+    return pd.DataFrame([(d, code, value(d, i)) for d in dates for i, code in enumerate(codes)],
+                        columns=['trade_date', 'ts_code', 'adj_factor'])
+
+
+def imp_fill_db(frame):
+    access = dba.imp_db(td.db_config().db_path)
+    access.write(sc.create_table_sql(td.schemas()[TBL]), wait=True)
+    access.write_many(f'INSERT OR REPLACE INTO {TBL} (trade_date, ts_code, adj_factor) VALUES (?, ?, ?)',
+                      frame.values.tolist(), wait=True)
+
+
+def test_append_and_reopen(data_dir):
+    ps.imp_write_rows(TBL, rows([20190102, 20190103], ['a', 'b']), ('adj_factor',))
+    meta = ps.imp_write_rows(TBL, rows([20190104], ['b', 'c']), ('adj_factor',))
+    assert (meta.n_dates, meta.n_codes) == (3, 3)
+    frame = ps.panel_frame(TBL, 'adj_factor')
+    assert frame.index.tolist() == [20190102, 20190103, 20190104]
+    assert frame.columns.tolist() == ['a', 'b', 'c']
+    np.testing.assert_allclose(frame.loc[20190104].values, [np.nan, 4.0, 4.1], rtol=1e-6)
+    # 已有的交易日原地覆盖
+    ps.imp_write_rows(TBL, rows([20190102], ['a'], lambda d, c: 9.0), ('adj_factor',))
+    assert ps.date_row(TBL, 'adj_factor', 20190102)['a'] == 9.0
+    assert ps.code_column(TBL, 'adj_factor', 'b').tolist() == pytest.approx([2.1, 3.1, 4.0])
+
+
+def test_uncommitted_tail_is_truncated_before_append(data_dir):
+    meta = ps.imp_write_rows(TBL, rows([20190102], ['a']), ('adj_factor',))
+    path = ps.field_path(TBL, 'adj_factor', meta)
+    # 模拟上次追加写了数据文件、没有写meta.json就中断
+    with open(path, 'ab') as f:
+        f.write(np.full(meta.capacity, 7.0, dtype=meta.dtype).tobytes())
+    ps.imp_write_rows(TBL, rows([20190103], ['a']), ('adj_factor',))
+    assert os.path.getsize(path) == 2 * meta.capacity * np.dtype(meta.dtype).itemsize
+    assert ps.code_column(TBL, 'adj_factor', 'a').tolist() == pytest.approx([2.0, 3.0])
+
+
+def test_grow_capacity_keeps_existing_rows(data_dir, monkeypatch):
+    monkeypatch.setattr(ps, 'panel_config', lambda cfg=ps.panel_config(): cfg._replace(code_block=2))
+    ps.imp_write_rows(TBL, rows([20190102, 20190103], ['a', 'b']), ('adj_factor',))
+    meta = ps.imp_write_rows(TBL, rows([20190103], ['c', 'a'], lambda d, c: 5.0 + c), ('adj_factor',))
+    assert meta.capacity == 4
+    frame = ps.panel_frame(TBL, 'adj_factor')
+    np.testing.assert_allclose(frame.values, [[2.0, 2.1, np.nan], [6.0, 3.1, 5.0]], rtol=1e-6)
+
+
+def test_sync_fills_interior_gaps(data_dir):
+    imp_fill_db(rows([20190102, 20190104, 20190107], ['a', 'b']))
+    ps.imp_sync_panel(TBL)
+    assert ps.imp_dates(TBL).tolist() == [20190102, 20190104, 20190107]
+    # 补录面板中间的交易日
+    imp_fill_db(rows([20190103], ['a', 'b']))
+    meta = ps.imp_sync_panel(TBL)
+    assert meta.n_dates == 4
+    frame = ps.panel_frame(TBL, 'adj_factor')
+    assert frame.index.tolist() == [20190102, 20190103, 20190104, 20190107]
+    np.testing.assert_allclose(frame['b'].values, [2.1, 3.1, 4.1, 7.1], rtol=1e-6)
+    # since落在面板中间时重新写入之后的交易日
+    imp_fill_db(rows([20190104], ['a'], lambda d, c: 8.0))
+    ps.imp_sync_panel(TBL, since=20190104)
+    assert ps.date_row(TBL, 'adj_factor', 20190104)['a'] == 8.0
+    assert ps.imp_sync_panel(TBL).n_dates == 4
+
+
+def crash_before_meta(monkeypatch):
+    def fail(*args):
+        raise OSError('crashed before meta.json')
+    monkeypatch.setattr(ps, 'imp_write_meta', fail)
+
+
+@pytest.mark.parametrize('update', [rows([20190103], ['c'], lambda d, c: 5.0),
+                                    rows([20190102], ['a'], lambda d, c: 5.0)])
+def test_crash_before_meta_keeps_the_committed_panel(data_dir, monkeypatch, update):
+    # 第一种更新扩容，第二种在面板中间插入交易日，两者都重写全部字段文件
+    monkeypatch.setattr(ps, 'panel_config', lambda cfg=ps.panel_config(): cfg._replace(code_block=2))
+    ps.imp_write_rows(TBL, rows([20190103, 20190104], ['a', 'b']), ('adj_factor',))
+    before = ps.panel_frame(TBL, 'adj_factor')
+    with monkeypatch.context() as m:
+        crash_before_meta(m)
+        with pytest.raises(OSError):
+            ps.imp_write_rows(TBL, update, ('adj_factor',))
+    pd.testing.assert_frame_equal(ps.panel_frame(TBL, 'adj_factor'), before)
+    meta = ps.imp_write_rows(TBL, update, ('adj_factor',))
+    frame = ps.panel_frame(TBL, 'adj_factor')
+    assert frame.loc[update['trade_date'][0], update['ts_code'][0]] == 5.0
+    np.testing.assert_allclose(frame.loc[[20190103, 20190104], ['a', 'b']].values, before.values, rtol=1e-6)
+    assert meta.generation == 1
+    # 新的一代提交后只保留上一代，表目录下第0代的文件已删除
+    assert ps.imp_write_rows(TBL, rows([20190101], ['a']), ('adj_factor',)).generation == 2
+    assert sorted(os.listdir(ps.panel_path(TBL, ''))) == ['g1', 'g2', 'meta.json']
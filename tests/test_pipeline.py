@@ -0,0 +1,70 @@
+import threading
+import time
+
+from src import pipeline as pl
+
+
+def quiet_config():
+    return pl.pipeline_config()._replace(queue_size=2, report_seconds=0)
+
+
+def test_items_pass_through_all_stages_in_order():
+    out = []
+    stats = pl.imp_run_pipeline(range(20), lambda item: 1,
+                                [pl.Stage('double', lambda x: x * 2, lambda rtn: 1),
+                                 pl.Stage('sink', out.append, lambda rtn: 1)], quiet_config(), report=None)
+    assert out == [x * 2 for x in range(20)]
+    assert [s['items'] for s in stats] == [20, 20, 20]
+    assert all(s['depth'] == 0 for s in stats)
+
+
+def test_failed_items_are_reported_and_skipped():
+    failed = []
+
+    def check(x):
+        if x % 5 == 0:
+            raise ValueError(x)
+        return x
+
+    out = []
+    stats = pl.imp_run_pipeline(range(10), lambda item: 1,
+                                [pl.Stage('check', check, lambda rtn: 1), pl.Stage('sink', out.append, lambda rtn: 1)],
+                                quiet_config(), report=None, on_error=lambda stage, item, e: failed.append((stage, item)))
+    assert failed == [('check', 0), ('check', 5)]
+    assert out == [1, 2, 3, 4, 6, 7, 8, 9]
+    assert stats[1]['errors'] == 2
+
+
+def test_source_error_still_shuts_down_every_stage():
+    def source():
+        yield 1
+        raise RuntimeError('network')
+
+    failed = []
+    stats = pl.imp_run_pipeline(source(), lambda item: 1, [pl.Stage('sink', lambda x: x, lambda rtn: 1)],
+                                quiet_config(), report=None, on_error=lambda stage, item, e: failed.append(stage))
+    assert failed == ['fetch']
+    assert stats[1]['items'] == 1
+    assert [t for t in threading.enumerate() if t.name.startswith('pipeline-')] == []
+
+
+def test_bounded_queues_hold_back_the_source():
+    pulled = []
+
+    def source():
+        for i in range(50):
+            pulled.append(i)
+            yield i
+
+    leads = []
+
+    def slow(x):
+        time.sleep(0.01)
+        leads.append(len(pulled) - x)
+        return x
+
+    pl.imp_run_pipeline(source(), lambda item: 1, [pl.Stage('a', lambda x: x, lambda rtn: 1),
+                                                  pl.Stage('slow', slow, lambda rtn: 1)], quiet_config(), report=None)
+    assert len(pulled) == 50
+    # 源最多领先两个队列的长度加上各线程手中的几条
+    assert max(leads) <= 2 * quiet_config().queue_size + 3
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import pit_index as pit  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+# 000001.SZ：一季报4月25日公告，4月28日更正，半年报8月20日公告，9月1日又更正了一季报
+STATEMENTS = pd.DataFrame({'ts_code': ['000001.SZ'] * 4 + ['600000.SH'],
+                           'ann_date': ['20190425', '20190425', '20190820', '20190425', '20190430'],
+                           'f_ann_date': ['20190425', '20190428', '20190820', '20190901', None],
+                           'end_date': ['20190331', '20190331', '20190630', '20190331', '20190331'],
+                           'basic_eps': [0.38, 0.39, 0.77, 0.40, 0.10]})
+DATES = [20190424, 20190425, 20190429, 20190430, 20190820, 20190902]
+
+
+def test_as_of_uses_only_announced_versions():
+    index = pit.build_pit_index(STATEMENTS)
+    got = pit.pit_as_of(index, DATES, ['basic_eps', 'end_date', 'known_date'])
+    eps = got['basic_eps']
+    assert eps.index.tolist() == DATES and eps.columns.tolist() == ['000001.SZ', '600000.SH']
+    # 公告日当天可用，更正后替换同一报告期的版本
+    np.testing.assert_allclose(eps['000001.SZ'].values, [np.nan, 0.38, 0.39, 0.39, 0.77, 0.77])
+    # 半年报公告后，更早报告期的更正不替换最新的报告期
+    assert got['end_date'].loc[20190902, '000001.SZ'] == 20190630
+    # 没有实际公告日期时以公告日期为准
+    np.testing.assert_allclose(eps['600000.SH'].values, [np.nan] * 3 + [0.10] * 3)
+    assert got['known_date'].loc[20190430, '600000.SH'] == 20190430
+
+
+def test_unknown_codes_and_empty_index():
+    index = pit.build_pit_index(STATEMENTS)
+    pos = pit.pit_positions(index, [20190902], ['000000.SZ', '600000.SH', '999999.SH'])
+    assert pos[0, 0] == -1 and pos[0, 2] == -1 and pos[0, 1] >= 0
+    got = pit.pit_as_of(index, [20190902], ['basic_eps'], codes=['999999.SH', '000001.SZ'])['basic_eps']
+    np.testing.assert_allclose(got.values, [[np.nan, 0.77]])
+    empty = pit.build_pit_index(STATEMENTS.iloc[:0])
+    assert pit.pit_as_of(empty, [20190902], ['basic_eps'], codes=['000001.SZ'])['basic_eps'].isnull().all().all()
+
+
+def test_index_built_from_the_database(data_dir):
+    td.imp_create_db_schema()
+    tbl = td.db_config().tbl_income_statement
+    td.imp_persist_data(td.transfer_columns(td.conform_data(STATEMENTS, tbl)), tbl)
+    td.imp_flush_db()
+    index = pit.imp_build_pit_index(tbl, ['basic_eps'])
+    got = pit.pit_as_of(index, DATES, ['basic_eps'])['basic_eps']
+    np.testing.assert_allclose(got.values, pit.pit_as_of(pit.build_pit_index(STATEMENTS), DATES,
+                                                         ['basic_eps'])['basic_eps'].values)
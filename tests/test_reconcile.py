@@ -0,0 +1,90 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import reconcile as rec  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+TBL = 'daily_trading_data'
+ROWS = [(code, date, 10.0 + i, 11.0, 9.0, 10.5, 10.0, 0.5, 5.0, 1000.0, 10000.0)
+        for code in ('000001.SZ', '600000.SH')
+        for i, date in enumerate([20181228, 20190102, 20190103, 20190104])]
+
+
+def make_db(path, rows, typed=True):
+    # typed=False时列没有声明类型，日期以文本保存，与另一个来源导出的库相同
+    columns = [name for name, _ in td.schemas()[TBL].columns]
+    column_def = ', '.join(f'{name} {kind}' if typed else name for name, kind in td.schemas()[TBL].columns)
+    conn = sqlite3.connect(path)
+    conn.execute(f'CREATE TABLE {TBL} ({column_def}, PRIMARY KEY (ts_code, trade_date))')
+    conn.executemany(f'INSERT INTO {TBL} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                     [r if typed else (r[0], str(r[1])) + r[2:] for r in rows])
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def cfg(data_dir):
+    return rec.reconcile_config()
+
+
+def test_block_sums_merge_across_chunks_and_ignore_row_order():
+    codes = np.array(['a', 'a', 'a', 'b'])
+    years = np.array([2018, 2019, 2019, 2019])
+    hashes = np.array([1, 2, 3, 2 ** 63], dtype=np.uint64)
+    whole = rec.block_sums(codes, years, hashes)
+    parts = rec.merge_summaries([rec.block_sums(codes[:2], years[:2], hashes[:2]),
+                                 rec.block_sums(codes[2:], years[2:], hashes[2:])])
+    for field in rec.Block_summary._fields:
+        assert getattr(whole, field).tolist() == getattr(parts, field).tolist()
+    assert whole.n_rows.tolist() == [1, 2, 1]
+    assert whole.row_hash.tolist() == [1, 5, 2 ** 63]
+    assert rec.changed_blocks(whole, parts).empty
+
+
+def test_diff_rows_respects_tolerances(cfg):
+    schema = td.schemas()[TBL]
+    columns = ['close', 'vol']
+    left = rec.pd.DataFrame({'ts_code': ['a', 'a', 'a'], 'trade_date': [1, 2, 3], 'close': [1.0, 2.0, 3.0],
+                             'vol': [10.0, 20.0, None]})
+    right = rec.pd.DataFrame({'ts_code': ['a', 'a', 'a'], 'trade_date': [1, 2, 4], 'close': [1.004, 2.1, 4.0],
+                              'vol': [10.5, 20.0, 1.0]})
+    found = sorted(rec.diff_rows(left, right, schema, columns, cfg), key=lambda r: (r[1], r[3]))
+    assert found == [('a', '2', 'close', 'mismatch', '2.0', '2.1'),
+                     ('a', '3', None, 'missing_right', None, None),
+                     ('a', '4', None, 'missing_left', None, None)]
+
+
+def test_reconcile_untyped_source_logs_differences_once(tmp_path, cfg):
+    left_db = make_db(str(tmp_path / 'left.db'), ROWS)
+    changed = [r[:5] + (r[5] + 1.0,) + r[6:] if r[:2] == ('600000.SH', 20190103) else r for r in ROWS]
+    right_db = make_db(str(tmp_path / 'right.db'), changed[:-1], typed=False)
+
+    first = rec.imp_reconcile_table(TBL, left_db, right_db, cfg)
+    assert first == {'blocks': 4, 'changed_blocks': 1, 'diffed_blocks': 1, 'logged_rows': 2}
+    log = rec.imp_get_reconcile_log(TBL, cfg).sort_values('kind')
+    assert log[['ts_code', 'row_key', 'kind']].values.tolist() == \
+        [['600000.SH', '20190103', 'mismatch'], ['600000.SH', '20190104', 'missing_right']]
+    assert log['field'].iloc[0] == 'close' and rec.pd.isnull(log['field'].iloc[1])
+
+    # 两边都没有变化时不再逐行比较，日志保持不变
+    again = rec.imp_reconcile_table(TBL, left_db, right_db, cfg)
+    assert again['changed_blocks'] == 1 and again['diffed_blocks'] == 0
+    assert len(rec.imp_get_reconcile_log(TBL, cfg)) == 2
+
+
+def test_reconcile_clears_log_when_sources_agree(tmp_path, cfg):
+    left_db = make_db(str(tmp_path / 'left.db'), ROWS)
+    right_db = make_db(str(tmp_path / 'right.db'), ROWS[:-1], typed=False)
+    assert rec.imp_reconcile_table(TBL, left_db, right_db, cfg)['logged_rows'] == 1
+    conn = sqlite3.connect(right_db)
+    conn.execute(f'INSERT INTO {TBL} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (ROWS[-1][0], str(ROWS[-1][1])) + ROWS[-1][2:])
+    conn.commit()
+    conn.close()
+    assert rec.imp_reconcile_table(TBL, left_db, right_db, cfg)['changed_blocks'] == 0
+    assert len(rec.imp_get_reconcile_log(TBL, cfg)) == 0
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import response_cache as rc  # noqa: E402
+
+
+@pytest.fixture
+def cfg(data_dir):
+    return rc.cache_config()._replace(offline=False)
+
+
+def fetcher(frames):
+    calls = []
+
+    def fetch(**params):
+        calls.append(params)
+        return frames.pop(0)
+    return fetch, calls
+
+
+def test_call_is_recorded_and_replayed(cfg):
+    fetch, calls = fetcher([pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})])
+    first = rc.imp_cached_call('stock_basic', fetch, {'list_status': 'L'}, cfg)
+    again = rc.imp_cached_call('stock_basic', fetch, {'list_status': 'L'}, cfg)
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, again)
+    replay = rc.imp_cached_call('stock_basic', fetch, {'list_status': 'L'}, cfg._replace(offline=True))
+    pd.testing.assert_frame_equal(first, replay)
+
+
+def test_empty_response_uses_short_ttl(cfg):
+    fetch, calls = fetcher([pd.DataFrame({'pe': []}), pd.DataFrame({'pe': [12.5]})])
+    params = {'ts_code': '000300.SH', 'trade_date': '20190102'}
+    assert len(rc.imp_cached_call('index_dailybasic', fetch, params, cfg)) == 0
+    # 空结果在接口的有效期内也会过期，数据发布后重新下载
+    short = cfg._replace(empty_ttl=-1)
+    assert rc.imp_cached_call('index_dailybasic', fetch, params, short)['pe'].tolist() == [12.5]
+    assert len(calls) == 2
+    assert rc.imp_cached_call('index_dailybasic', fetch, params, short)['pe'].tolist() == [12.5]
+    assert len(calls) == 2
+
+
+def test_none_is_not_recorded(cfg):
+    fetch, calls = fetcher([None, pd.DataFrame({'a': [1]})])
+    assert rc.imp_cached_call('trade_cal', fetch, {}, cfg) is None
+    assert rc.imp_cached_call('trade_cal', fetch, {}, cfg)['a'].tolist() == [1]
+    with pytest.raises(LookupError):
+        rc.imp_cached_call('namechange', fetch, {}, cfg._replace(offline=True))
+
+
+def test_evict_keeps_most_recently_used(cfg):
+    frames = [pd.DataFrame({'v': range(1000 * i, 1000 * (i + 1))}) for i in range(3)]
+    fetch, _ = fetcher(list(frames))
+    for i in range(3):
+        rc.imp_cached_call('daily', fetch, {'i': i}, cfg)
+    size = rc.imp_index(cfg).execute('SELECT MAX(size) FROM cache_entry')[0][0]
+    rc.imp_evict(cfg._replace(max_bytes=size * 2))
+    assert rc.imp_lookup('daily', {'i': 0}, cfg) is None
+    assert rc.imp_lookup('daily', {'i': 2}, cfg)['v'].tolist() == frames[2]['v'].tolist()
@@ -0,0 +1,140 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import db_access as dba  # noqa: E402
+from src import sample  # noqa: E402
+from src import security_master as sm  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+# 基准指数总市值300万亿元，成分股平均1万亿元即1亿万元
+INDEX_MV = 300 * 1e12
+
+
+def test_low_limit_is_a_ratio_to_the_average_constituent():
+    cfg = sample.sample_config()._replace(low_market_to_base_index=1 / 50)
+    assert sample.low_market_value_limit(INDEX_MV, cfg) == pytest.approx(2e6)
+    limits = sample.low_market_value_limit(pd.Series([INDEX_MV, INDEX_MV / 2]), cfg)
+    assert limits.tolist() == pytest.approx([2e6, 1e6])
+
+
+def test_all_builders_share_the_low_limit(monkeypatch):
+    monkeypatch.setattr(sample, 'sample_config', lambda: sample.Sample_config(
+        '20180101', '20181231', '0430', '1031', '399300.SZ', 1 / 50, 2))
+    Row = namedtuple('Row', 'ts_code, trade_date, total_mv')
+    mvs = {'a': 1.9e6, 'b': 2.1e6}
+    legacy = sample.market_value_exceeds_low_limit(
+        [Row('a', '20180502', 0), Row('b', '20180502', 0)],
+        lambda code, date: namedtuple('Index', 'total_mv')(INDEX_MV),
+        lambda sql: iter([Row(c, '20180502', mvs[c]) for c in mvs if f"'{c}'" in sql]))
+    assert [r.ts_code for r in legacy] == ['b']
+
+    master = sm.empty_master(np.array(['a', 'b']))
+    filters = sample.sample_filters(
+        ['20180502'], lambda: master,
+        lambda d: pd.DataFrame({'trade_date': ['20180502'] * 2, 'ts_code': ['a', 'b'], 'pct_chg': [1.0, 1.0]}),
+        lambda d: pd.DataFrame({'trade_date': ['20180502'] * 2, 'ts_code': ['a', 'b'], 'total_mv': [1.9e6, 2.1e6]}),
+        lambda d: pd.Series([INDEX_MV], index=[20180502]), kinds=('market_value',))
+    assert filters['20180502']['market_value'].index.tolist() == ['b']
+
+
+def test_cached_pool_round_trips(data_dir, monkeypatch):
+    master = sm.empty_master(np.array(['a', 'b']))
+    dates = ['20180502', '20181031']
+    monkeypatch.setattr(sample, 'imp_get_index_total_mv_by_tushare',
+                        lambda d: pd.Series([INDEX_MV] * 2, index=[int(x) for x in dates]))
+    monkeypatch.setattr(sample, 'imp_data_stamps', lambda d, mv: {'daily': {}, 'basic': {}, 'name_history': [],
+                                                                  'companies': 0, 'index_mv': {}})
+    calls = []
+
+    def get_filters(missing, **kwargs):
+        calls.append(missing)
+        return {d: {'tradable': {'a', 'b'}, 'listed': {'a', 'b'}, 'non_st': {'a'},
+                    'market_value': pd.Series([3e6, 4e6], index=['a', 'b'])} for d in missing}
+    first = sample.imp_cached_sample_pool(dates, get_filters=get_filters)
+    again = sample.imp_cached_sample_pool(dates, get_filters=get_filters)
+    assert calls == [dates]
+    assert again == first
+    assert isinstance(again['20180502'][0], sample.Samples_info) and again['20180502'][1] == {'a'}
+
+
+class Index_api:
+    """ 模拟index_dailybasic：按区间请求时最多返回最近的row_cap行，skipped中的日期只能按日请求到
+    """
+    def __init__(self, days, row_cap, skipped=()):
+        self.frame = pd.DataFrame({'ts_code': '399300.SZ', 'trade_date': [str(d) for d in days],
+                                   'total_mv': [INDEX_MV + d for d in days]}).iloc[::-1]
+        self.row_cap, self.skipped, self.calls = row_cap, set(skipped), []
+
+    def __call__(self, ts_code, start_date=None, end_date=None, trade_date=None):
+        self.calls.append(trade_date or (start_date, end_date))
+        if trade_date is not None:
+            return self.frame[self.frame['trade_date'] == trade_date]
+        days = self.frame['trade_date'].astype(int)
+        picked = self.frame[(days >= int(start_date)) & (days <= int(end_date)) & ~days.isin(self.skipped)]
+        return picked.head(self.row_cap)
+
+
+def test_index_mv_is_fetched_in_chunks(monkeypatch):
+    days = pd.bdate_range('2005-01-04', '2019-04-30').strftime('%Y%m%d').astype(int).tolist()
+    api = Index_api(days, row_cap=sample.INDEX_MV_ROWS_PER_CALL, skipped=[days[100]])
+    monkeypatch.setattr(sample.rc, 'cached_pro_api', lambda endpoint: api)
+    index_mv = sample.imp_get_index_total_mv_by_tushare([str(d) for d in days])
+    assert index_mv.index.tolist() == days
+    np.testing.assert_allclose(index_mv.values, [INDEX_MV + d for d in days])
+    assert all(len(c) == 2 for c in api.calls[:-1]) and api.calls[-1] == str(days[100])
+    # 两个端点之间的交易日也都取到
+    assert len(sample.imp_get_index_total_mv_by_tushare(['20050104', '20190430'])) == len(days) - 1
+
+
+CODES = [f'{i:06d}.SZ' for i in range(1, 13)]
+DATES = ['20180502', '20181031']
+
+
+@pytest.fixture
+def universe(data_dir, monkeypatch):
+    """ 12只股票：000010、000011上市不满两年，000012在第二个调仓日满两年，000003在第一个调仓日为ST，000004没有名称
+    记录，000005第一个调仓日涨停，000006第二个调仓日停牌，000007市值低于下限
+    """
+    list_dates = {c: '20100104' for c in CODES}
+    list_dates.update({'000010.SZ': '20170601', '000011.SZ': '20170601', '000012.SZ': '20160601'})
+    monkeypatch.setattr(td, 'download_list_companies', lambda: pd.DataFrame(
+        {'ts_code': CODES, 'list_date': [list_dates[c] for c in CODES], 'delist_date': None}))
+    history = [(c, f'股票{c[:6]}', list_dates[c], None) for c in CODES if c not in ('000003.SZ', '000004.SZ')] + \
+        [('000003.SZ', '股票3', '20100104', '20171231'), ('000003.SZ', 'ST股票3', '20180101', '20180801'),
+         ('000003.SZ', '股票3', '20180802', None)]
+    daily = pd.DataFrame([(d, c, 10.0 if (c, d) == ('000005.SZ', DATES[0]) else 1.0 + i / 10)
+                          for d in DATES for i, c in enumerate(CODES) if (c, d) != ('000006.SZ', DATES[1])],
+                         columns=['trade_date', 'ts_code', 'pct_chg'])
+    basic = pd.DataFrame([(d, c, 1.5e6 if c == '000007.SZ' else 3e6 + i * 1e5 + int(d) % 7 * 1e4)
+                          for d in DATES for i, c in enumerate(CODES)], columns=['trade_date', 'ts_code', 'total_mv'])
+    access = dba.imp_db(td.db_config().db_path)
+    access.write('CREATE TABLE name_history (ts_code TEXT, name TEXT, start_date TEXT, end_date TEXT)', wait=True)
+    access.write_many('INSERT INTO name_history VALUES (?, ?, ?, ?)', history, wait=True)
+    access.write('CREATE TABLE daily_trading_data (trade_date TEXT, ts_code TEXT, pct_chg REAL)', wait=True)
+    access.write_many('INSERT INTO daily_trading_data VALUES (?, ?, ?)', daily.values.tolist(), wait=True)
+    access.write('CREATE TABLE daily_basic (trade_date TEXT, ts_code TEXT, total_mv REAL)', wait=True)
+    access.write_many('INSERT INTO daily_basic VALUES (?, ?, ?)', basic.values.tolist(), wait=True)
+
+    class Pro:
+        def daily(self, trade_date):
+            return daily[daily['trade_date'] == trade_date]
+    monkeypatch.setattr(sample.ts, 'pro_api', lambda *args: Pro())
+    monkeypatch.setattr(sample.rc, 'cached_pro_api', lambda endpoint: Index_api([int(d) for d in DATES], 3000))
+
+
+def test_pool_matches_per_date_samples(universe):
+    pool = sample.impf_build_sample_pool(DATES)
+    assert pool['20180502'][1] == set(CODES) - {'000003.SZ', '000004.SZ', '000005.SZ', '000007.SZ', '000010.SZ',
+                                                '000011.SZ', '000012.SZ'}
+    assert pool['20181031'][1] == set(CODES) - {'000004.SZ', '000006.SZ', '000007.SZ', '000010.SZ', '000011.SZ'}
+    for d in DATES:
+        info, samples = sample.impf_build_samples_by_tushare(d)
+        assert samples == pool[d][1]
+        assert info.count == pool[d][0].count
+        np.testing.assert_allclose([info.mean_mv, info.median_mv, info.min_mv],
+                                   [pool[d][0].mean_mv, pool[d][0].median_mv, pool[d][0].min_mv])
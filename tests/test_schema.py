@@ -0,0 +1,76 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import db_access as dba  # noqa: E402
+from src import schema as sc  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+TBL = 'income_statement'
+
+
+def income(f_ann_dates):
+    return pd.DataFrame({'ts_code': ['000001.SZ'] * len(f_ann_dates), 'ann_date': ['20190425'] * len(f_ann_dates),
+                         'f_ann_date': f_ann_dates, 'end_date': ['20190331'] * len(f_ann_dates),
+                         'basic_eps': [0.38] * len(f_ann_dates)})
+
+
+def rows(sql):
+    return dba.imp_db(td.db_config().db_path).execute(sql)
+
+
+def test_missing_f_ann_date_falls_back_to_ann_date():
+    df = td.conform_data(income([None, '', '20190426']), TBL)
+    assert df['f_ann_date'].tolist() == [20190425, 20190425, 20190426]
+    assert df['ann_date'].tolist() == [20190425] * 3
+
+
+def test_repeated_downloads_without_f_ann_date_are_ignored(data_dir):
+    assert td.imp_create_db_schema() == len(sc.migrations(td.db_config()))
+    for _ in range(2):
+        td.imp_persist_data(td.transfer_columns(td.conform_data(income([None]), TBL)), TBL)
+    td.imp_flush_db()
+    assert rows(f'SELECT f_ann_date FROM {TBL}') == [(20190425,)]
+
+
+def test_migration_fills_f_ann_date_and_drops_duplicates(data_dir):
+    td.imp_create_db_schema()
+    access = dba.imp_db(td.db_config().db_path)
+    access.write_many(f'INSERT INTO {TBL} (ts_code, ann_date, f_ann_date, end_date) VALUES (?, ?, ?, ?)',
+                      [('000001.SZ', 20190425, None, 20190331)] * 2 + [('000001.SZ', 20190425, 20190425, 20181231),
+                                                                       ('000001.SZ', 20190425, None, 20181231)],
+                      wait=True)
+    access.write('PRAGMA user_version=3', wait=True)
+    assert td.imp_create_db_schema() == 4
+    assert rows(f'SELECT end_date, f_ann_date FROM {TBL} ORDER BY end_date') == \
+        [(20181231, 20190425), (20190331, 20190425)]
+
+
+def test_migrations_do_not_follow_the_live_registry(data_dir, monkeypatch):
+    # 当前的表结构以后改动时，已发布的迁移仍按发布时的结构建表
+    monkeypatch.setattr(sc, 'table_schemas', lambda tables: pytest.fail('migration read the live registry'))
+    access = dba.imp_db(td.db_config().db_path)
+    access.write(f'CREATE TABLE {TBL} (ts_code, ann_date, f_ann_date, end_date, basic_eps)', wait=True)
+    access.write(f'INSERT INTO {TBL} VALUES (?, ?, ?, ?, ?)', ('000001.SZ', '20190425', None, '20190331', '0.38'),
+                 wait=True)
+    assert sc.imp_migrate(td.db_config().db_path, td.db_config()) == 4
+    v1 = sc.v1_table_schemas(td.db_config())[TBL]
+    assert [r[1] for r in rows(f'PRAGMA table_info({TBL})')] == sc.column_names(v1)
+    assert rows(f'SELECT f_ann_date, basic_eps FROM {TBL}') == [(20190425, 0.38)]
+    assert rows("SELECT name FROM sqlite_master WHERE name='adj_factor'") == [('adj_factor',)]
+
+
+def test_failed_migration_raises_and_keeps_the_previous_version(data_dir, monkeypatch):
+    def broken(conn):
+        conn.execute(f'ALTER TABLE {TBL} ADD COLUMN half_done INTEGER')
+        conn.execute('SELECT * FROM no_such_table')
+    done = sc.migrations(td.db_config())
+    monkeypatch.setattr(sc, 'migrations', lambda tables: done + [sc.Migration(version=5, description='broken',
+                                                                              apply=broken)])
+    with pytest.raises(sqlite3.Error):
+        td.imp_create_db_schema()
+    assert rows('PRAGMA user_version') == [(4,)]
+    assert 'half_done' not in [r[1] for r in rows(f'PRAGMA table_info({TBL})')]
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import db_access as dba  # noqa: E402
+from src import panel_store as ps  # noqa: E402
+from src import security_master as sm  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+COMPANIES = pd.DataFrame({'ts_code': ['000001.SZ', '600000.SH', '000002.SZ'],
+                          'list_date': ['19910403', '19991110', '20180105'],
+                          'delist_date': [None, None, '20190301']})
+HISTORY = [('000001.SZ', '深发展A', '19910403', '20070619'), ('000001.SZ', '平安银行', '20120801', None),
+           ('000002.SZ', 'ST万科', '20180105', '20181231')]
+
+
+@pytest.fixture
+def history(data_dir, monkeypatch):
+    monkeypatch.setattr(td, 'download_list_companies', lambda: COMPANIES)
+    access = dba.imp_db(td.db_config().db_path)
+    access.write('CREATE TABLE name_history (ts_code TEXT, name TEXT, start_date TEXT, end_date TEXT)', wait=True)
+    access.write_many('INSERT INTO name_history VALUES (?, ?, ?, ?)', HISTORY, wait=True)
+    return access
+
+
+def test_point_in_time_lookups(history):
+    master = sm.imp_security_master()
+    ids = sm.code_ids(master, ['000001.SZ', '000002.SZ', '600000.SH', '999999.SZ'])
+    assert ids[-1] == -1
+    covered, is_st = sm.name_status(master, ids, 20181015)
+    assert covered.tolist() == [True, True, False, False]
+    assert is_st.tolist() == [False, True, False, False]
+    # 名称区间之间的空档没有名称记录
+    assert sm.name_status(master, ids[:1], 20100101)[0].tolist() == [False]
+    assert sm.is_active(master, ids, 20190401).tolist() == [True, False, True, False]
+    assert sm.listed_over_years(master, ids, np.array([20190104, 20190104, 20000301, 20190104]), 1).tolist() == \
+        [True, False, False, False]
+
+
+def test_master_is_memoized_until_data_changes(history, monkeypatch):
+    reads = []
+    build = sm.imp_build_security_master
+    monkeypatch.setattr(sm, 'imp_build_security_master', lambda cfg=None: reads.append(1) or build(cfg))
+    first = sm.imp_security_master()
+    assert sm.imp_security_master() is first
+    assert len(reads) == 1
+    history.write('INSERT INTO name_history VALUES (?, ?, ?, ?)', ('600000.SH', '浦发银行', '19991110', None),
+                  wait=True)
+    assert sm.name_status(sm.imp_security_master(), [1], 20181015)[0].tolist() == [True]
+    assert len(reads) == 2
+
+
+def test_master_follows_panel_root(history, tmp_path):
+    root = str(tmp_path / 'other_panel')
+    rows = pd.DataFrame({'trade_date': [20190102, 20190102], 'ts_code': ['600000.SH', '000001.SZ'],
+                         'adj_factor': [1.0, 2.0]})
+    ps.imp_write_rows('adj_factor', rows, ('adj_factor',), root)
+    # 面板按自己目录下的主表编号排列，缺省目录的主表不受影响
+    assert sm.imp_codes(sm.master_config(root)).tolist() == ['600000.SH', '000001.SZ']
+    assert len(sm.imp_codes()) == 0
+    master = sm.imp_security_master(sm.master_config(root))
+    assert master.codes.tolist()[:2] == ps.imp_codes('adj_factor', root).tolist()
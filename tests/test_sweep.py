@@ -0,0 +1,36 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import sample  # noqa: E402
+from src import security_master as sm  # noqa: E402
+from src import sweep  # noqa: E402
+
+
+def test_sweep_honors_sample_date_range(monkeypatch):
+    trade_cal = [('SSE', d, 1) for d in ['20170502', '20171031', '20180502', '20181031', '20190430']]
+    monkeypatch.setattr(sweep, '_market', sweep.Market(root=None, returns=None, master=None, index_mv=None,
+                                                       trade_cal=trade_cal))
+    monkeypatch.setattr(sample, 'build_sample_pool', lambda dates, **kwargs: dates)
+    cfg = sample.sample_config()._replace(start_date='20180101', end_date='20181231', updated_date1='0502')
+    assert sweep.worker_pool.__wrapped__(cfg) == ['20180502', '20181031']
+
+
+def test_sweep_rejects_cells_outside_the_prepared_calendar(data_dir):
+    market = sweep.Market(root=None, returns=None, master=None, index_mv=None,
+                          trade_cal=[('SSE', '20180502', 1), ('SSE', '20181031', 1)])
+    cells = sweep.sweep_cells({'start_date': ['20180101'], 'end_date': ['20181231', '20191231']}, [{'z_ep': 1.0}])
+    with pytest.raises(ValueError):
+        next(sweep.imp_run_sweep(cells, market))
+
+
+def test_sweep_arguments_pickle(data_dir):
+    master = sm.empty_master(np.array(['a', 'b']))
+    market = sweep.Market(root=None, returns='returns', master=master, index_mv=pd.Series([1.0]), trade_cal=[])
+    cell = sweep.sweep_cells({'list_years': [1]}, [{'z_ep': 1.0}])[0]
+    for value in (market, cell, (cell.sample_cfg, [(cell.key, cell.weights)], sweep.sweep_config().backtest)):
+        assert repr(pickle.loads(pickle.dumps(value))) == repr(value)
@@ -0,0 +1,169 @@
+from collections import namedtuple
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+
+from src import db_access as dba  # noqa: E402
+from src import sync_planner as sp  # noqa: E402
+from src import tushare_data as td  # noqa: E402
+
+
+def daily_batch(code, dates):
+    data = pd.DataFrame({'ts_code': [code] * len(dates), 'trade_date': [str(d) for d in dates],
+                         'close': [10.0] * len(dates)})
+    return td.transfer_columns(td.conform_data(data, td.db_config().tbl_daily_trading_data))
+
+
+def fetch_log():
+    return td.imp_get_records_from_db(f'SELECT * FROM {sp.sync_config().tbl_fetch_log}')
+
+
+def test_task_is_logged_only_after_its_rows_commit(data_dir):
+    td.imp_create_db_schema()
+    sp.imp_create_fetch_log()
+    sp.imp_create_fetch_error()
+    failures = []
+    good = ('daily_trading_data', '000001.SZ', '20190102', '20190103')
+    sp.persist_task((good, daily_batch('000001.SZ', [20190102, 20190103])), td.imp_persist_data, failures)
+    bad = ('daily_trading_data', '000002.SZ', '20190102', '20190103')
+    broken = td.Column_batch(columns=['ts_code', 'no_such_column'], arrays=[['000002.SZ'], [1.0]])
+    sp.persist_task((bad, broken), td.imp_persist_data, failures)
+    td.imp_flush_db()
+    assert list(fetch_log()['ts_code']) == ['000001.SZ']
+    assert [(task, stage) for task, stage, _ in failures] == [(bad, 'persist')]
+    sp.imp_log_failed_tasks(failures)
+    assert list(sp.imp_get_fetch_errors('daily_trading_data')['ts_code']) == ['000002.SZ']
+
+
+def test_successful_retry_clears_the_failure(data_dir):
+    td.imp_create_db_schema()
+    sp.imp_create_fetch_log()
+    task = ('daily_trading_data', '000001.SZ', '20190102', '20190102')
+    sp.imp_log_failed_tasks([(task, 'fetch', RuntimeError('timeout'))])
+    sp.persist_task((task, daily_batch('000001.SZ', [20190102])), td.imp_persist_data, [])
+    td.imp_flush_db()
+    assert sp.imp_get_fetch_errors('daily_trading_data').empty
+    assert len(fetch_log()) == 1
+
+
+def test_date_slice_tasks_are_logged_once(data_dir):
+    td.imp_create_db_schema()
+    sp.imp_create_fetch_log()
+    access = dba.imp_db(td.db_config().db_path)
+    # 早先按日期截面下载的记录ts_code为NULL，重复的记录没有被去重
+    access.write_many(f'INSERT INTO {sp.sync_config().tbl_fetch_log} VALUES (?, ?, ?, ?, ?)',
+                      [('daily_trading_data', None, '20190102', '20190102', '0')] * 2, wait=True)
+    sp.imp_create_fetch_log()
+    task = ('daily_trading_data', None, '20190102', '20190102')
+    for _ in range(2):
+        sp.persist_task((task, daily_batch('000001.SZ', [20190102])), td.imp_persist_data, [])
+    td.imp_flush_db()
+    assert fetch_log()['ts_code'].tolist() == ['']
+    assert sp.imp_get_fetch_log('daily_trading_data')['ts_code'].tolist() == ['']
+
+
+def test_both_axes_fetch_unadjusted_daily_prices(monkeypatch):
+    calls = []
+
+    class Daily:
+        def __getattr__(self, name):
+            return lambda **kwargs: calls.append((name, kwargs.get('adj'))) or pd.DataFrame()
+    monkeypatch.setattr(td.ts, 'pro_api', lambda *args: Daily())
+    monkeypatch.setattr(td.ts, 'pro_bar', lambda **kwargs: calls.append(('pro_bar', kwargs.get('adj'))))
+    td.imp_get_data_from_tushare(('daily_trading_data', '000001.SZ', '20190102', '20190131'))
+    td.imp_get_data_from_tushare(('daily_trading_data', None, '20190102', '20190102'))
+    td.imp_get_trade_data_from_tushare(('daily_trading_data', '000001.SZ', '20190102', '20190131'))
+    assert calls == [('daily', None), ('daily', None), ('pro_bar', None)]
+
+
+def test_positions_to_runs():
+    assert sp.positions_to_runs(np.array([0, 1, 2, 5, 7, 8])) == [(0, 3), (5, 6), (7, 9)]
+    assert sp.positions_to_runs(np.array([], dtype=np.int64)) == []
+
+
+def test_subtract_runs():
+    assert sp.subtract_runs([(0, 10)], [(2, 4), (6, 7)]) == [(0, 2), (4, 6), (7, 10)]
+    assert sp.subtract_runs([(0, 10)], [(0, 10)]) == []
+    assert sp.subtract_runs([(3, 5)], [(0, 1), (8, 9)]) == [(3, 5)]
+    # 覆盖区间无序、重叠、相接，runs有重叠时各自计算
+    assert sp.subtract_runs([(12, 20), (0, 10), (5, 15)], [(6, 7), (2, 4), (3, 5), (7, 8), (14, 14), (13, 30)]) == \
+        [(0, 2), (5, 6), (8, 10), (5, 6), (8, 13), (12, 13)]
+
+
+def test_merge_runs():
+    assert sp.merge_runs([(10, 12), (0, 2), (4, 5)], 2) == [(0, 5), (10, 12)]
+    assert sp.merge_runs([(0, 2), (5, 6)], 2) == [(0, 2), (5, 6)]
+
+
+def test_missing_runs_tail_head_and_interior():
+    days = np.array([1, 2, 3, 4, 5, 6, 7, 8])
+    assert sp.missing_runs(days, 2, 7, None, None, True) == [(1, 7)]
+    coverage = next(pd.DataFrame({'first_date': [3], 'last_date': [5], 'rows': [3]}).itertuples())
+    assert sp.missing_runs(days, 2, 7, coverage, None, False) == [(5, 7)]
+    assert sorted(sp.missing_runs(days, 2, 7, coverage, None, True)) == [(1, 2), (5, 7)]
+    assert sp.missing_runs(days, 1, 8, coverage, np.array([3, 5]), True) == [(0, 2), (3, 4), (5, 8)]
+
+
+def test_find_gaps_skips_logged_ranges():
+    days = np.arange(1, 11)
+    windows = pd.DataFrame({'lo': [1, 1], 'hi': [10, 10]}, index=['a', 'b'])
+    coverage = pd.DataFrame({'first_date': [1], 'last_date': [5], 'rows': [5]}, index=['a'])
+    log = pd.DataFrame({'ts_code': ['b', ''], 'start_date': [1, 9], 'end_date': [4, 10]})
+    gaps = sp.find_gaps(td.db_config().tbl_daily_trading_data, days, windows, coverage,
+                        lambda codes: pd.DataFrame(columns=['ts_code', 'date']), log)
+    assert gaps == {'a': [(5, 8)], 'b': [(4, 8)]}
+
+
+def test_statement_tail_gaps_are_planned_by_announcement_date():
+    tbl = td.db_config().tbl_income_statement
+    days = np.arange(20190101, 20190104)
+    gaps = {f'{i:06d}.SZ': [(1, 3)] for i in range(100)}
+    tasks = sp.plan_sync_tasks(tbl, days, gaps, 0, sp.sync_config().rows_per_call[tbl])
+    assert [(t.code, t.start_date) for t in tasks] == [(None, '20190102'), (None, '20190103')]
+
+
+class Api:
+    def __getattr__(self, name):
+        return lambda **kwargs: None
+
+
+def test_index_is_fetched_through_pro_bar(monkeypatch):
+    seen = []
+    monkeypatch.setattr(td, 'imp_get_trade_data_from_tushare', lambda task: seen.append(task) or pd.DataFrame())
+    monkeypatch.setattr(td.ts, 'pro_api', lambda *args: Api())
+    task = (td.db_config().tbl_index, '399300.SZ', '20190101', '20190131')
+    td.imp_get_data_from_tushare(task)
+    assert seen == [task]
+
+
+def test_missing_endpoint_is_a_failure_not_an_empty_fetch():
+    with pytest.raises(ValueError):
+        td.clean_fetched((('no_such_table', '000001.SZ', '20190101', '20190131'), None))
+    assert td.clean_fetched((('daily_trading_data', '000001.SZ', '20190101', '20190131'), pd.DataFrame()))[1] is None
+
+
+CODES = ['000001.SZ', '000002.SZ', '600000.SH', '600004.SH']
+
+
+def test_recent_empty_date_slice_is_refetched(data_dir, monkeypatch):
+    today = datetime.date.today()
+    old, mid, new = [int((today - datetime.timedelta(days=n)).strftime('%Y%m%d')) for n in (10, 9, 0)]
+    Trade_cal = namedtuple('Trade_cal', 'exchange, cal_date, is_open')
+    monkeypatch.setattr(td, 'imp_get_trade_cal', lambda start, end: iter([Trade_cal('SSE', str(d), 1)
+                                                                          for d in (old, mid, new)]))
+    monkeypatch.setattr(td, 'download_list_companies', lambda: pd.DataFrame(
+        {'ts_code': CODES, 'list_date': ['19910403'] * 4, 'delist_date': [None] * 4}))
+    td.imp_create_db_schema()
+    for code in CODES:
+        td.imp_persist_data(daily_batch(code, [mid]), 'daily_trading_data')
+    td.imp_flush_db()
+    tbl = 'daily_trading_data'
+    assert [(t.code, t.start_date) for t in sp.imp_plan_sync_tasks(tbl, str(old), str(new))] == \
+        [(None, str(d)) for d in (old, mid, new)]
+    sp.imp_sync_table(tbl, end_date=str(new), getter=lambda task: pd.DataFrame())
+    # 早已发布的交易日确实没有数据，不再下载；当天的数据可能还没有发布，下次同步重新下载
+    assert [(t.code, t.start_date) for t in sp.imp_plan_sync_tasks(tbl, str(old), str(new))] == [(None, str(new))]